@@ -95,6 +95,27 @@ DATABASES = {
     # }
 }
 
+# Cache
+# https://docs.djangoproject.com/en/3.0/topics/cache/
+# Rendered configuration is cached by producers (see slam_core.producer.cache). A file based
+# cache can be shared by all processes.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'OPTIONS': {
+            'MAX_ENTRIES': 10000
+        }
+    }
+    # 'default': {
+    #     'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+    #     'LOCATION': os.path.join(BASE_DIR, 'cache'),
+    #     'OPTIONS': {
+    #         'MAX_ENTRIES': 10000
+    #     }
+    # }
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.0/ref/settings/#auth-password-validators
@@ -0,0 +1,5 @@
+"""
+slam_core provide common tools (producers, change journal, jobs, search index) for all SLAM
+applications.
+"""
+default_app_config = 'slam_core.apps.SlamCoreConfig'
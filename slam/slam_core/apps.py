@@ -2,8 +2,40 @@
 As this is a django internal template, we disable pylint
 """
 # pylint: disable=C0115
-from django.apps import AppConfig
+from django.apps import AppConfig, apps
+from django.db.models.signals import post_save, post_delete
+
+
+def search_index_save(sender, instance, **kwargs):
+    # pylint: disable=W0613
+    """
+    This function (re)index a object in search index when it's saved
+    """
+    from slam_core.models import SearchToken  # pylint: disable=C0415
+    SearchToken.index(instance)
+
+
+def search_index_delete(sender, instance, **kwargs):
+    # pylint: disable=W0613
+    """
+    This function remove a object from search index when it's deleted
+    """
+    from slam_core.models import SearchToken  # pylint: disable=C0415
+    SearchToken.unindex(sender.SEARCH_KIND, instance.id)
 
 
 class SlamCoreConfig(AppConfig):
     name = 'slam_core'
+
+    def ready(self):
+        """
+        We maintain search index (see slam_core.models.SearchToken) for all models which
+        provide a SEARCH_KIND
+        """
+        for model in apps.get_models():
+            if hasattr(model, 'SEARCH_KIND'):
+                post_save.connect(search_index_save, sender=model,
+                                  dispatch_uid='search_index_save_{}'.format(model.SEARCH_KIND))
+                post_delete.connect(search_index_delete, sender=model,
+                                    dispatch_uid='search_index_delete_{}'.format(
+                                        model.SEARCH_KIND))
@@ -0,0 +1,97 @@
+"""
+This module provide a per process read-through cache for objects which rarely change (like
+domains and networks) but are looked up by name on almost every operation. Models declare their
+cache (per example slam_domain.models.DOMAIN_CACHE) and drop it from post_save and post_delete
+signals. As other process can also update objects, a object is kept at most ttl seconds.
+
+A object read inside a transaction is only cached once the transaction is committed, so we never
+cache a object which has been rolled back. Cached objects are shared, so get return a copy that
+the caller can modify. Objects we want to update must still be read from database.
+"""
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+from django.db import transaction
+
+CACHE_TTL = 60
+CACHE_SIZE = 1000
+
+
+class ObjectCache:
+    """
+    This class is a LRU cache of objects of a model indexed by a unique field (name by default).
+    """
+    def __init__(self, model, field='name', ttl=CACHE_TTL, size=CACHE_SIZE):
+        """
+        Just a constructor
+
+        :param model: the model of cached objects
+        :param field: the unique field used to look up objects
+        :param ttl: how long (in seconds) a object is kept
+        :param size: the maximum number of objects we keep
+        """
+        self.model = model
+        self.field = field
+        self.ttl = ttl
+        self.size = size
+        self.objects = OrderedDict()
+        self.lock = threading.Lock()
+        # Increased on each invalidation, so a object read before a invalidation is not cached
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+        This method return a copy of the object, from cache if we have it or from database. Like
+        objects.get, model.DoesNotExist is raised if the object doesn't exist.
+
+        :param key: the value of the unique field (per example a domain name)
+        :return:
+        """
+        with self.lock:
+            cached = self.objects.get(key)
+            if cached is not None and cached[0] > time.monotonic():
+                self.objects.move_to_end(key)
+                self.hits += 1
+                return copy.copy(cached[1])
+            generation = self.generation
+            self.misses += 1
+        instance = self.model.objects.get(**{self.field: key})
+
+        def store():
+            with self.lock:
+                if generation != self.generation:
+                    return
+                self.objects[key] = (time.monotonic() + self.ttl, instance)
+                self.objects.move_to_end(key)
+                while len(self.objects) > self.size:
+                    self.objects.popitem(last=False)
+
+        transaction.on_commit(store)
+        return copy.copy(instance)
+
+    def invalidate(self):
+        """
+        This method drop all cached objects
+
+        :return:
+        """
+        with self.lock:
+            self.generation += 1
+            self.objects.clear()
+
+    def stats(self):
+        """
+        This method return the number of cached objects, hits and misses
+
+        :return:
+        """
+        with self.lock:
+            return {
+                'size': len(self.objects),
+                'hits': self.hits,
+                'misses': self.misses
+            }
@@ -0,0 +1,62 @@
+"""
+This module provide a django command to (re)build the search index (see
+slam_core.models.SearchToken) and search columns used by operators (see slam_core.search):
+reversed names of hosts and entries, integer MAC addresses of interfaces. They are maintained on
+save and delete, but they must be built once after upgrading a existing database:
+
+    python manage.py reindex_search
+"""
+# As we use django models.Model, pylint fail to find objects method. We must disable pylint
+# test E1101 (no-member)
+# pylint: disable=E1101
+from django.apps import apps
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from slam_core.models import SearchToken
+from slam_core.utils import reversed_name, mac_key
+from slam_domain.models import DomainEntry
+from slam_hardware.models import Interface
+from slam_host.models import Host
+
+BATCH_SIZE = 1000
+
+
+class Command(BaseCommand):
+    """
+    reindex_search command
+    """
+    help = 'Rebuild the search index'
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            hosts = list(Host.objects.all())
+            for host in hosts:
+                host.reversed_name = reversed_name(host.name)
+            Host.objects.bulk_update(hosts, ['reversed_name'], batch_size=BATCH_SIZE)
+            entries = list(DomainEntry.objects.select_related('domain'))
+            for entry in entries:
+                entry.reversed_fqdn = reversed_name('{}.{}'.format(entry.name, entry.domain.name))
+            DomainEntry.objects.bulk_update(entries, ['reversed_fqdn'], batch_size=BATCH_SIZE)
+            interfaces = list(Interface.objects.all())
+            for interface in interfaces:
+                interface.mac_key = mac_key(interface.mac_address)
+            Interface.objects.bulk_update(interfaces, ['mac_key'], batch_size=BATCH_SIZE)
+            SearchToken.objects.all().delete()
+            for model in apps.get_models():
+                if not hasattr(model, 'SEARCH_KIND'):
+                    continue
+                objects = model.objects.all()
+                if model is DomainEntry:
+                    # fqdn of a entry is built from its domain
+                    objects = objects.select_related('domain')
+                tokens = []
+                count = 0
+                for instance in objects.iterator(chunk_size=BATCH_SIZE):
+                    tokens.extend(SearchToken.tokens(instance))
+                    count += 1
+                    if len(tokens) >= BATCH_SIZE:
+                        SearchToken.objects.bulk_create(tokens)
+                        tokens = []
+                SearchToken.objects.bulk_create(tokens)
+                self.stdout.write('{} {} indexed'.format(count, model.SEARCH_KIND))
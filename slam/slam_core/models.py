@@ -1,3 +1,659 @@
 """
-This module provide models from slam_core.
+This module provide models from slam_core. There are 5 models
+  - Change: which represent a modification which require to produce configuration again
+  - ChangeVersion: which represent the version of the configuration of a domain, a network or
+    freeradius
+  - ZoneSerial: which represent the SOA serial of a DNS zone
+  - Job: which represent a commit, a publish or a dynamic update run in background
+  - SearchToken: which represent a entry of the search index
+
+As we use django models.Model, pylint fail to find objects method. We must disable pylint
+test E1101 (no-member)
 """
+# pylint: disable=E1101
+import json
+import re
+import threading
+import uuid
+from contextlib import contextmanager
+from datetime import date, timedelta
+
+from django.db import models, connections, transaction
+from django.db.models import Max, Sum, Case, When, Value, F, Q, IntegerField
+from django.core.exceptions import ObjectDoesNotExist
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+
+from slam_core.utils import error_message
+
+CHANGE_TARGET = (
+    ('domain', 'DNS zone of a domain'),
+    ('network', 'Reverse DNS zone and DHCP configuration of a network'),
+    ('freeradius', 'Freeradius configuration')
+)
+
+JOB_STATUS = (
+    ('pending', 'Job is waiting to be run'),
+    ('running', 'Job is running'),
+    ('done', 'Job is done'),
+    ('failed', 'Job failed'),
+    ('cancelled', 'Job has been cancelled')
+)
+
+JOB_HISTORY = 50
+# A running job store a heartbeat every JOB_HEARTBEAT seconds, a job w/o heartbeat since
+# JOB_HEARTBEAT_TIMEOUT seconds has been stopped (per example if its process has been restarted)
+JOB_HEARTBEAT = 30
+JOB_HEARTBEAT_TIMEOUT = 120
+
+SEARCH_LIMIT = 50
+SEARCH_TOKEN_LENGTH = 150
+# The greatest character of the Basic Multilingual Plane, every token starting with a prefix is
+# between prefix and prefix + SEARCH_TOKEN_END
+SEARCH_TOKEN_END = '\uffff'
+SEARCH_BATCH_SIZE = 500
+
+# Objects removed from search index are collected here (per thread) inside
+# SearchToken.bulk_unindex
+SEARCH_DEFERRED = threading.local()
+
+
+class Change(models.Model):
+    """
+    Change class represent a entry of the change journal. Each time a object used by producers is
+    created, updated or removed, we add a change for each configuration which must be produced
+    again. On commit, producers only produce configuration from uncommitted changes.
+      - target: the type of configuration (domain, network, freeradius)
+      - name: the name of the domain or the network ('' for freeradius)
+      - entry: what changed inside the target (a record name for a domain, a IP address or a
+        host name for a network) or '' if we don't know
+      - date: when the change has been done
+      - committed: True when the change has been produced
+      - updated: True when the change has been sent to DNS servers as a dynamic update (see
+        slam_core.producer.dnsupdate)
+    """
+    target = models.CharField(max_length=10, choices=CHANGE_TARGET)
+    name = models.CharField(max_length=150, default='', blank=True)
+    entry = models.CharField(max_length=150, default='', blank=True)
+    date = models.DateTimeField(auto_now_add=True)
+    committed = models.BooleanField(default=False, db_index=True)
+    updated = models.BooleanField(default=False, db_index=True)
+
+    @staticmethod
+    def log(target, name='', entry=''):
+        """
+        This method add a change in the journal and renew the version of its target (see
+        ChangeVersion)
+
+        :param target: the type of configuration (domain, network, freeradius)
+        :param name: the name of the domain or the network
+        :param entry: what changed inside the target
+        :return:
+        """
+        Change.objects.create(target=target, name=name, entry=entry)
+        ChangeVersion.renew([(target, name)])
+
+    @staticmethod
+    def log_bulk(changes):
+        """
+        This method add a list of changes in the journal with a single query (per example on a
+        bulk import)
+
+        :param changes: a iterable of (target, name, entry)
+        :return:
+        """
+        changes = list(changes)
+        Change.objects.bulk_create([Change(target=target, name=name, entry=entry)
+                                    for target, name, entry in changes])
+        ChangeVersion.renew((target, name) for target, name, _ in changes)
+
+    @staticmethod
+    def pending():
+        """
+        This method return what must be produced from uncommitted changes. As changes can be
+        added while we produce, we keep the id of the last change we took into account.
+
+        :return:
+        """
+        result = {
+            'last': Change.objects.filter(committed=False).aggregate(last=Max('id'))['last'],
+            'domain': set(),
+            'network': set(),
+            'freeradius': False
+        }
+        if result['last'] is None:
+            return result
+        changes = Change.objects.filter(committed=False, id__lte=result['last']).\
+            values_list('target', 'name').distinct()
+        for target, name in changes:
+            if target == 'freeradius':
+                result['freeradius'] = True
+            else:
+                result[target].add(name)
+        return result
+
+    @staticmethod
+    def versions():
+        """
+        This method return the version of the configuration of each domain, network and
+        freeradius as a dict (target, name): version, used to cache rendered configuration (see
+        slam_core.producer.cache). Versions are read from ChangeVersion, so it doesn't depend on
+        the size of the journal.
+
+        :return:
+        """
+        return {(target, name): version for target, name, version in
+                ChangeVersion.objects.values_list('target', 'name', 'version')}
+
+    @staticmethod
+    def acknowledge(last):
+        """
+        This method mark all changes up to last as committed
+
+        :param last: the id of the last change which has been produced
+        :return:
+        """
+        if last is not None:
+            Change.objects.filter(committed=False, id__lte=last).update(committed=True)
+
+    @staticmethod
+    def pending_updates():
+        """
+        This method return changed entries of domains and networks which have not been sent as
+        dynamic updates. As pending, we keep the id of the last change we took into account.
+
+        :return:
+        """
+        changes = Change.objects.filter(updated=False, target__in=['domain', 'network'])
+        result = {
+            'last': changes.aggregate(last=Max('id'))['last'],
+            'domain': dict(),
+            'network': dict()
+        }
+        if result['last'] is None:
+            return result
+        changes = changes.filter(id__lte=result['last']).\
+            values_list('target', 'name', 'entry').distinct()
+        for target, name, entry in changes:
+            result[target].setdefault(name, set()).add(entry)
+        return result
+
+    @staticmethod
+    def acknowledge_updates(last, targets):
+        """
+        This method mark changes up to last of some domains and networks as updated
+
+        :param last: the id of the last change which has been sent
+        :param targets: a iterable of (target, name)
+        :return:
+        """
+        if last is None:
+            return
+        names = dict()
+        for target, name in targets:
+            names.setdefault(target, []).append(name)
+        for target in names:
+            Change.objects.filter(updated=False, id__lte=last, target=target,
+                                  name__in=names[target]).update(updated=True)
+
+
+class ChangeVersion(models.Model):
+    """
+    ChangeVersion class represent the version of the configuration of a target, there is only one
+    row by target whatever the number of changes in the journal.
+      - target: the type of configuration (domain, network, freeradius)
+      - name: the name of the domain or the network ('' for freeradius)
+      - version: a token renewed each time a change of the target is added in the journal
+    """
+    target = models.CharField(max_length=10, choices=CHANGE_TARGET)
+    name = models.CharField(max_length=150, default='', blank=True)
+    version = models.CharField(max_length=32)
+
+    class Meta:
+        """
+        A target has only one version
+        """
+        constraints = [
+            models.UniqueConstraint(fields=['target', 'name'], name='unique_change_version')
+        ]
+
+    @staticmethod
+    def renew(targets):
+        """
+        This method give a new version to some targets in a single query
+
+        :param targets: a iterable of (target, name)
+        :return:
+        """
+        ChangeVersion.objects.bulk_create(
+            [ChangeVersion(target=target, name=name, version=uuid.uuid4().hex)
+             for target, name in set(targets)],
+            update_conflicts=True, unique_fields=['target', 'name'], update_fields=['version'])
+
+
+class ZoneSerial(models.Model):
+    """
+    ZoneSerial class represent the SOA serial of a DNS zone (a domain or a reverse zone). The
+    serial is only increased when the content of the zone changed.
+      - zone: the name of the zone file w/o extension (per example example.com or 192.168.0.0)
+      - serial: the SOA serial
+      - digest: the content hash of the zone for this serial
+    """
+    zone = models.CharField(max_length=150, unique=True)
+    serial = models.BigIntegerField(default=0)
+    digest = models.CharField(max_length=64, default='', blank=True)
+
+    @staticmethod
+    def bump(zone, digest, current=None):
+        """
+        This method return the serial of a zone and True if it has been increased (ie the content
+        hash of the zone changed). As the serial of the zone may have been raised out of SLAM (by
+        hand on its SOA file or by named on dynamic update), a new serial is greater than both
+        the stored serial and the current one, and at least the serial of the day (YYYYMMDD00).
+
+        :param zone: the name of the zone
+        :param digest: the content hash of the zone
+        :param current: a function which return the current serial of the zone (per example from
+          its SOA file)
+        :return:
+        """
+        zone_serial = ZoneSerial.objects.filter(zone=zone).first()
+        if zone_serial is not None and zone_serial.digest == digest:
+            return zone_serial.serial, False
+        with transaction.atomic():
+            zone_serial = ZoneSerial.objects.select_for_update().filter(zone=zone).first()
+            if zone_serial is None:
+                zone_serial = ZoneSerial(zone=zone)
+            elif zone_serial.digest == digest:
+                return zone_serial.serial, False
+            serial = max(zone_serial.serial, current() if current else 0)
+            zone_serial.serial = max(serial + 1, int(date.today().strftime('%Y%m%d00')))
+            zone_serial.digest = digest
+            zone_serial.save()
+        return zone_serial.serial, True
+
+    @staticmethod
+    def follow(zone, serial):
+        """
+        This method raise the stored serial of a zone to its serial on the DNS server (named
+        increase it on each dynamic update). The content hash is cleared, so the next commit
+        write the SOA with a greater serial.
+
+        :param zone: the name of the zone
+        :param serial: the serial of the zone on the DNS server
+        :return:
+        """
+        with transaction.atomic():
+            zone_serial = ZoneSerial.objects.select_for_update().filter(zone=zone).first()
+            if zone_serial is None:
+                zone_serial = ZoneSerial(zone=zone)
+            if zone_serial.serial >= serial:
+                return
+            zone_serial.serial = serial
+            zone_serial.digest = ''
+            zone_serial.save()
+
+
+class JobCancelled(Exception):
+    """
+    Raised when a job has been cancelled by user
+    """
+    def __init__(self):
+        super().__init__('Job has been cancelled')
+
+
+class Job(models.Model):
+    """
+    Job class represent a commit, a publish or a dynamic update which is run in background by a
+    local thread. Its state is stored on database so any process can look at it.
+      - action: what the job do (commit, publish, dnsupdate)
+      - status: the job status (pending, running, done, failed, cancelled)
+      - cancel: set to True when a user ask to cancel the job
+      - progress: a JSON dict of the state of each step (per example each zone or each server)
+      - result: a JSON abstraction of the job output
+      - user: who started the job
+      - creation_date, start_date, end_date: when the job has been created, started and ended
+      - heartbeat: the last time the thread which run the job was alive (see JOB_HEARTBEAT)
+    """
+    action = models.CharField(max_length=10)
+    status = models.CharField(max_length=10, choices=JOB_STATUS, default='pending')
+    cancel = models.BooleanField(default=False)
+    progress = models.TextField(default='{}')
+    result = models.TextField(default='{}')
+    user = models.CharField(max_length=150, default='', blank=True)
+    creation_date = models.DateTimeField(auto_now_add=True)
+    start_date = models.DateTimeField(null=True, blank=True)
+    end_date = models.DateTimeField(null=True, blank=True)
+    heartbeat = models.DateTimeField(default=timezone.now)
+
+    def show(self, short=False):
+        """
+        This method return a dict construction of the object.
+
+        :param short: if set to True, we don't return the job result
+        :return:
+        """
+        result = {
+            'job': self.id,
+            'action': self.action,
+            'status': self.status,
+            'cancel': self.cancel,
+            'progress': json.loads(self.progress),
+            'user': self.user,
+            'creation_date': self.creation_date,
+            'start_date': self.start_date,
+            'end_date': self.end_date,
+            'heartbeat': self.heartbeat
+        }
+        if not short:
+            result['result'] = json.loads(self.result)
+        return result
+
+    def run(self, function, args):
+        """
+        This method run the job function and store its result. function is called with args
+        and 2 callbacks:
+          - progress(step, state): to store the state of a step
+          - cancelled(): which raise JobCancelled if user asked to cancel the job
+
+        :param function: the function to run (per example slam_core.producer.utils.commit)
+        :param args: a dict of arguments for the function
+        :return:
+        """
+        progress = dict()
+        progress_lock = threading.Lock()
+
+        def progress_callback(step, state):
+            with progress_lock:
+                progress[step] = state
+                Job.objects.filter(id=self.id).update(progress=json.dumps(progress))
+
+        def cancelled_callback():
+            if Job.objects.filter(id=self.id, cancel=True).exists():
+                raise JobCancelled()
+
+        stopped = threading.Event()
+
+        def heartbeat():
+            try:
+                while not stopped.wait(JOB_HEARTBEAT):
+                    Job.objects.filter(id=self.id).update(heartbeat=timezone.now())
+            finally:
+                # The thread has its own database connection, we must close it
+                connections.close_all()
+
+        heartbeat_thread = threading.Thread(target=heartbeat, daemon=True)
+        heartbeat_thread.start()
+        try:
+            Job.objects.filter(id=self.id).update(status='running', start_date=timezone.now())
+            cancelled_callback()
+            result = function(progress=progress_callback, cancelled=cancelled_callback, **args)
+            # A function can return a failed status (per example if a producer failed)
+            status = 'failed' if isinstance(result, dict) and \
+                result.get('status') == 'failed' else 'done'
+        except JobCancelled as err:
+            result = {'message': '{}'.format(err)}
+            status = 'cancelled'
+        except Exception as err:  # pylint: disable=W0703
+            result = {'message': '{}'.format(err)}
+            status = 'failed'
+        finally:
+            stopped.set()
+            heartbeat_thread.join()
+        Job.objects.filter(id=self.id).update(status=status, end_date=timezone.now(),
+                                              result=json.dumps(result, cls=DjangoJSONEncoder))
+
+    @staticmethod
+    def start(action, function, user='', args=None):
+        """
+        This is a custom method to create a job and run it on a background thread.
+
+        :param action: what the job do (commit, publish, dnsupdate)
+        :param function: the function to run
+        :param user: who started the job
+        :param args: a dict of arguments for the function
+        :return:
+        """
+        if args is None:
+            args = dict()
+        job = Job.objects.create(action=action, user=user)
+
+        def target():
+            try:
+                job.run(function, args)
+            finally:
+                # The thread has its own database connection, we must close it
+                connections.close_all()
+
+        threading.Thread(target=target, daemon=True).start()
+        return job.show(short=True)
+
+    @staticmethod
+    def expire():
+        """
+        This method mark as failed pending and running jobs which have no heartbeat since
+        JOB_HEARTBEAT_TIMEOUT seconds. Their thread has been stopped (per example if the process
+        which run them has been restarted), so they will never end.
+
+        :return:
+        """
+        now = timezone.now()
+        Job.objects.filter(status__in=['pending', 'running'],
+                           heartbeat__lt=now - timedelta(seconds=JOB_HEARTBEAT_TIMEOUT)).\
+            update(status='failed', end_date=now,
+                   result=json.dumps({'message': 'Job has been stopped w/o result'}))
+
+    @staticmethod
+    def get(job_id):
+        """
+        This is a custom method to get a job. Stopped jobs are marked as failed first (see
+        Job.expire).
+
+        :param job_id: the job id
+        :return:
+        """
+        Job.expire()
+        try:
+            job = Job.objects.get(id=job_id)
+        except ObjectDoesNotExist as err:
+            return error_message('job', job_id, err)
+        return job.show()
+
+    @staticmethod
+    def remove(job_id):
+        """
+        This is a custom method to cancel a job. The job is stopped before its next step.
+
+        :param job_id: the job id
+        :return:
+        """
+        updated = Job.objects.filter(id=job_id, status__in=['pending', 'running']).\
+            update(cancel=True)
+        if updated == 0:
+            return error_message('job', job_id, 'Job is not pending or running')
+        return {
+            'job': job_id,
+            'status': 'done'
+        }
+
+    @staticmethod
+    def search():
+        """
+        This is a custom method to get the job history (last JOB_HISTORY jobs). Stopped jobs are
+        marked as failed first (see Job.expire).
+
+        :return:
+        """
+        Job.expire()
+        result = []
+        for job in Job.objects.order_by('-id')[:JOB_HISTORY]:
+            result.append(job.show(short=True))
+        return result
+
+
+def search_tokens(value):
+    """
+    This function return all tokens of a value: the whole value, its words and, for a dotted
+    name, all its suffixes (per example host.lab.example.com give lab.example.com, example.com
+    and com). Tokens are lower case.
+
+    :param value: the value we want to index
+    :return:
+    """
+    value = '{}'.format(value).lower().strip()
+    if value == '':
+        return set()
+    tokens = {value}
+    for word in re.split(r'[\s\-_.,;/]+', value):
+        if word != '':
+            tokens.add(word)
+    parts = value.split('.')
+    for index in range(1, len(parts)):
+        tokens.add('.'.join(parts[index:]))
+    return set(token[:SEARCH_TOKEN_LENGTH] for token in tokens)
+
+
+class SearchToken(models.Model):
+    """
+    SearchToken class represent a entry of the search index. Each indexed object (host, domain,
+    entry, network, address, hardware and interface) has a token for each word of its indexed
+    fields. Searching is a range query on token (per example a prefix), so it's done through
+    the database index instead of scanning all tables.
+      - token: a lower case word (see search_tokens)
+      - kind: the type of object (per example host)
+      - object_id: the primary key of the object
+      - label: a human readable name of the object (per example the fqdn of a host)
+      - field: the field where token come from
+      - weight: how relevant the field is (a name is more relevant than a description)
+
+    A model is indexed if it has a SEARCH_KIND attribute and a search_fields method which
+    return a list of (field, value, weight). The first field is used as label, unless the model
+    provide a search_label method. Index is maintained on save and delete (see
+    slam_core.apps.SlamCoreConfig).
+    """
+    token = models.CharField(max_length=SEARCH_TOKEN_LENGTH, db_index=True)
+    kind = models.CharField(max_length=10)
+    object_id = models.IntegerField()
+    label = models.CharField(max_length=255)
+    field = models.CharField(max_length=20)
+    weight = models.SmallIntegerField(default=1)
+
+    class Meta:
+        """
+        We always remove tokens of a object when it's updated or deleted
+        """
+        indexes = [
+            models.Index(fields=['kind', 'object_id'])
+        ]
+
+    @staticmethod
+    def tokens(instance):
+        """
+        This method return (unsaved) tokens of a object
+
+        :param instance: the object we want to index
+        :return:
+        """
+        result = []
+        fields = instance.search_fields()
+        if hasattr(instance, 'search_label'):
+            label = instance.search_label()
+        else:
+            # The first field is the main identifier of the object (name, fqdn, ip, ...)
+            label = '{}'.format(fields[0][1])
+        for field, value, weight in fields:
+            if value is None:
+                continue
+            for token in search_tokens(value):
+                result.append(SearchToken(token=token, kind=instance.SEARCH_KIND,
+                                          object_id=instance.id, label=label[:255],
+                                          field=field, weight=weight))
+        return result
+
+    @staticmethod
+    def index(instance):
+        """
+        This method (re)index a object
+
+        :param instance: the object we want to index
+        :return:
+        """
+        SearchToken.objects.filter(kind=instance.SEARCH_KIND, object_id=instance.id).delete()
+        SearchToken.objects.bulk_create(SearchToken.tokens(instance))
+
+    @staticmethod
+    def unindex(kind, object_id):
+        """
+        This method remove a object from the index
+
+        :param kind: the type of object
+        :param object_id: the primary key of the object
+        :return:
+        """
+        deferred = getattr(SEARCH_DEFERRED, 'objects', None)
+        if deferred is not None:
+            deferred.setdefault(kind, set()).add(object_id)
+            return
+        SearchToken.objects.filter(kind=kind, object_id=object_id).delete()
+
+    @staticmethod
+    @contextmanager
+    def bulk_unindex():
+        """
+        This method is a context manager for bulk deletes: objects deleted inside it are removed
+        from the index on exit with a query per type of object (and per SEARCH_BATCH_SIZE
+        objects) instead of a query per object.
+
+        :return:
+        """
+        SEARCH_DEFERRED.objects = dict()
+        try:
+            yield
+            for kind, object_ids in SEARCH_DEFERRED.objects.items():
+                object_ids = sorted(object_ids)
+                for start in range(0, len(object_ids), SEARCH_BATCH_SIZE):
+                    SearchToken.objects.filter(
+                        kind=kind, object_id__in=object_ids[start:start + SEARCH_BATCH_SIZE]).\
+                        delete()
+        finally:
+            SEARCH_DEFERRED.objects = None
+
+    @staticmethod
+    def search(query, limit=SEARCH_LIMIT):
+        """
+        This method return objects which match all words of query. A word match a token if
+        it's a prefix of the token. Hits are ranked by score: the sum of the weight of all
+        tokens which match (doubled if the token is the word itself).
+
+        :param query: the words we look for (per example "web lab.example")
+        :param limit: the maximum number of hits
+        :return:
+        """
+        words = [word[:SEARCH_TOKEN_LENGTH] for word in query.lower().split()]
+        if not words:
+            return []
+        condition = Q()
+        matched = None
+        exact = []
+        for word in words:
+            word_condition = Q(token__gte=word, token__lt=word + SEARCH_TOKEN_END)
+            condition |= word_condition
+            word_matched = Max(Case(When(word_condition, then=Value(1)), default=Value(0),
+                                    output_field=IntegerField()))
+            matched = word_matched if matched is None else matched + word_matched
+            exact.append(When(token=word, then=F('weight') * 2))
+        hits = SearchToken.objects.filter(condition).\
+            values('kind', 'object_id', 'label').\
+            annotate(matched=matched,
+                     score=Sum(Case(*exact, default=F('weight'), output_field=IntegerField()))).\
+            filter(matched=len(words)).\
+            order_by('-score', 'kind', 'label')[:limit]
+        result = []
+        for hit in hits:
+            result.append({
+                'type': hit['kind'],
+                'id': hit['object_id'],
+                'name': hit['label'],
+                'score': hit['score']
+            })
+        return result
@@ -3,17 +3,92 @@ This module provide tools to produce DNS Bind9 configuration. It will put all re
 named example.com.db (for example.com) and update SOA serial in a file example.com.soa.db. For some
 reason, the serial number should be on its own line with the following format:
     2020010401 ; Serial
+
+Serials are stored in database (see slam_core.models.ZoneSerial) with the content hash of their
+zone, so a serial is only increased (and the SOA file written) if the content of the zone changed.
+As administrators can edit the SOA file, we keep it and only replace its serial. A new serial is
+always greater than the serial of the SOA file, which may have been raised by hand.
 """
 # As we use django model that provide objects method which is not visible by pylint, we must
 # disable no-member error from pylint
 # pylint: disable=E1101
 import ipaddress
 import os
-from datetime import datetime
 
-from django.core.files import locks
+from django.db.models import Prefetch
 
 from slam_domain.models import DomainEntry
+from slam_network.models import Address
+from slam_core.models import ZoneSerial
+from slam_core.producer.files import content_digest, write_file
+
+SOA_TEMPLATE = '$TTL    2H\n' \
+               '@ IN  SOA dns-master.example.com. contact.example.com. (\n' \
+               '          {} ; Serial\n' \
+               '          7200          ; Refresh - 2hours\n' \
+               '          1200          ; Retry - 20 minutess\n' \
+               '          3600000       ; Expire - 6 weeks\n' \
+               '          86400 )       ;  Minimum - 24 hours\n'
+
+
+def read_serial(filename):
+    """
+    This function return the serial of a SOA file (0 if the file doesn't exist)
+
+    :param filename: the SOA file
+    :return:
+    """
+    try:
+        with open(filename) as soa_file:
+            for line in soa_file:
+                if 'Serial' in line:
+                    return int(line.split()[0])
+    except (FileNotFoundError, ValueError, IndexError):
+        pass
+    return 0
+
+
+def soa_content(filename, serial):
+    """
+    This function return the content of a SOA file with a new serial. If the file doesn't exist,
+    we create a standard SOA.
+
+    :param filename: the SOA file
+    :param serial: the new serial
+    :return:
+    """
+    try:
+        with open(filename) as soa_file:
+            lines = soa_file.readlines()
+    except FileNotFoundError:
+        return SOA_TEMPLATE.format(serial)
+    result = ''
+    for line in lines:
+        if 'Serial' in line:
+            line = line.replace(line.split()[0], str(serial), 1)
+        result += line
+    return result
+
+
+def save_zone(directory, zone, content):
+    """
+    This function write a zone (example.com.db) and, if its content changed since the last
+    serial, increase the serial and write its SOA (example.com.soa.db). The zone is written first,
+    so if we fail before the new serial is stored, the zone will get it on next commit.
+
+    :param directory: directory where to put files
+    :param zone: the name of the zone file w/o extension (per example example.com)
+    :param content: the content of the zone
+    :return: True if the zone or its SOA has been written
+    """
+    filename = '{}/{}.db'.format(directory, zone)
+    soa_filename = '{}/{}.soa.db'.format(directory, zone)
+    changed = write_file(filename, content)
+    serial, bumped = ZoneSerial.bump(zone, content_digest(content),
+                                     lambda: read_serial(soa_filename))
+    if bumped or not os.path.exists(soa_filename):
+        write_file(soa_filename, soa_content(soa_filename, serial))
+    return changed or bumped
 
 
 class Bind:
@@ -21,26 +96,31 @@ class Bind:
     This class manage Bind9 file production. This only manage name resolution, not reverse IP
     resolution.
     """
-    def __init__(self, domain, directory):
+    def __init__(self, domain, directory, cache=None):
         """
         Just a constructor for bind, we need a domain name to produce and a directory where to put
         data generated.
 
         :param domain: domain name
         :param directory: directory where to put
+        :param cache: a cache of rendered configuration (see slam_core.producer.cache)
         """
         self.domain = domain
-        self.entries = DomainEntry.objects.filter(domain=self.domain).exclude(type='PTR')
+        self.cache = cache
+        # We load addresses and CNAME targets (w/ their domain) of all records in 3 queries
+        # whatever the number of records in the domain.
+        self.entries = DomainEntry.objects.filter(domain=self.domain).exclude(type='PTR').\
+            prefetch_related(Prefetch('address_set', queryset=Address.objects.order_by('id')),
+                             Prefetch('entries', queryset=DomainEntry.objects.
+                                      select_related('domain').order_by('id')))
         self.directory = directory
 
-    def show(self):
+    def lines(self):
         """
-        This method make the rendering and return it as a string. To make git diff easier to read,
-        we don't add some timestamp into the file.
+        This method make the rendering line by line.
 
         :return:
         """
-        result = ''
         for record in self.entries:
             if record.type == 'A':
                 for address in record.address_set.all():
@@ -48,90 +128,83 @@ class Bind:
                         ns_type = 'AAAA'
                     else:
                         ns_type = 'A'
-                    result += '{}    IN {}    {} ; {} - {}\n'.format(record.name, ns_type,
-                                                                     address.ip,
-                                                                     record.creation_date,
-                                                                     record.description)
+                    yield '{}    IN {}    {} ; {} - {}\n'.format(record.name, ns_type,
+                                                                 address.ip,
+                                                                 record.creation_date,
+                                                                 record.description)
             elif record.type == 'CNAME':
                 for entry in record.entries.all():
-                    result += '{}    IN {}    {}.{}. ; {} - {}\n'.format(record.name, record.type,
-                                                                         entry.name,
-                                                                         entry.domain.name,
-                                                                         entry.creation_date,
-                                                                         entry.description)
-        return result
+                    yield '{}    IN {}    {}.{}. ; {} - {}\n'.format(record.name, record.type,
+                                                                     entry.name,
+                                                                     entry.domain.name,
+                                                                     entry.creation_date,
+                                                                     entry.description)
 
-    def update_soa(self):
+    def show(self):
         """
-        This method update SOA to change Serial number, it s required by bind9 to make modification
-        available for other DNS server.
+        This method make the rendering and return it as a string. To make git diff easier to read,
+        we don't add some timestamp into the file.
 
         :return:
         """
-        now = datetime.now()
-        backup_filename = '{}/{}.soa.{}.old'.format(self.directory, self.domain.name,
-                                                    now)
-        new_filename = '{}/{}.soa.{}.new'.format(self.directory, self.domain.name,
-                                                 now)
-        filename = '{}/{}.soa.db'.format(self.directory, self.domain.name)
-        try:
-            os.rename(filename, backup_filename)
-        except FileNotFoundError:
-            # If the file not exist, we create a standard SOA file
-            result = '$TTL    2H\n'
-            result += '@ IN  SOA dns-master.example.com. contact.example.com. (\n'
-            result += '          {} ; Serial\n'.format(datetime.now().strftime("%Y%m%d00"))
-            result += '          7200          ; Refresh - 2hours\n'
-            result += '          1200          ; Retry - 20 minutess\n'
-            result += '          3600000       ; Expire - 6 weeks\n'
-            result += '          86400 )       ;  Minimum - 24 hours\n'
-            backup_file = open(backup_filename, 'w')
-            backup_file.write(result)
-            backup_file.close()
-        new_file = open(new_filename, 'w')
-        backup_file = open(backup_filename, 'r')
-        for line in backup_file.readlines():
-            if 'Serial' in line:
-                serial = line.split()[0]
-                new_serial = int(serial) + 1
-                new_file.write(line.replace(serial, str(new_serial)))
-            else:
-                new_file.write(line)
-        os.rename(new_filename, filename)
-        os.remove(backup_filename)
+        return ''.join(self.lines())
 
     def save(self):
         """
-        This method write on example.com.db file all the records.
+        This method write on example.com.db file all the records. The file and its SOA are only
+        written if records changed.
 
         :return:
         """
-        filename = '{}/{}.db'.format(self.directory, self.domain.name)
-        with open(filename, 'w') as lock_file:
-            locks.lock(lock_file, locks.LOCK_EX)
-            lock_file.write(self.show())
-            lock_file.close()
-        self.update_soa()
+        if self.cache is None:
+            content = self.show()
+        else:
+            content = self.cache.get('bind', 'domain', self.domain.name, self.show)
+        save_zone(self.directory, self.domain.name, content)
+
+
+def reverse_owners(networks):
+    """
+    This function return the network which produce each reverse zone file. As networks can be
+    nested, two networks may have a subnet with the same zone file (per example a /16 and a /24
+    inside it): the most specific network (longest prefix) produce it, so a zone file is only
+    written by one producer.
+
+    :param networks: all networks
+    :return: a dict zone file: network id
+    """
+    owners = dict()
+    # The most specific network is the last one (the oldest one for a same prefix)
+    for network in sorted(networks, key=lambda network: (network.prefix, -network.id)):
+        for subnet in BindReverse(network, '').subnets:
+            owners[str(subnet.network_address).replace(':', '.')] = network.id
+    return owners
 
 
 class BindReverse:
     """
     This class manage Bind9 file production. This only reverse IP resolution.
     """
-    def __init__(self, network, directory):
+    def __init__(self, network, directory, cache=None, owners=None):
         """
         Just a constructor for bind, we need a network name to produce and a directory where to put
         data generated.
 
         :param network: network name
         :param directory: directory where to put
+        :param cache: a cache of rendered configuration (see slam_core.producer.cache)
+        :param owners: the network which produce each zone file (see reverse_owners), subnets
+          produced by another network are skipped
         """
         self.network = network
+        self.cache = cache
+        self.owners = owners
         ip_network = ipaddress.ip_network('{}/{}'.format(self.network.ip, self.network.prefix))
         if ip_network.prefixlen < 24 and ip_network.version == 4:
-            self.subnets = []
-            for subnet in ip_network.subnets(new_prefix=24):
-                self.subnets.append(subnet)
+            self.subnets = list(ip_network.subnets(new_prefix=24))
+        elif ip_network.prefixlen % 4 != 0 and ip_network.version == 6:
+            # IPv6 reverse zones are delegated on nibble boundary (ie 4 bits)
+            self.subnets = list(ip_network.subnets(new_prefix=(ip_network.prefixlen // 4 + 1) * 4))
         else:
             self.subnets = [ip_network]
         self.directory = directory
@@ -154,88 +227,65 @@ class BindReverse:
                                                                       address.creation_date)
         return result
 
-    def update_soa(self):
+    def save(self):
         """
-        This method update SOA to change Serial number, it s required by bind9 to make modification
-        available for other DNS server.
+        This method write on example.com.db file all the records.
 
         :return:
         """
-        now = datetime.now()
-        for network in self.subnets:
-            backup_filename = '{}/{}.soa.{}.old'.format(self.directory,
-                                                        str(network.network_address).
-                                                        replace(':', '.'),
-                                                        now)
-            new_filename = '{}/{}.soa.{}.new'.format(self.directory,
-                                                     str(network.network_address).
-                                                     replace(':', '.'),
-                                                     now)
-            filename = '{}/{}.soa.db'.format(self.directory,
-                                             str(network.network_address).
-                                             replace(':', '.'))
-            try:
-                os.rename(filename, backup_filename)
-            except FileNotFoundError:
-                # If the file not exist, we create a standard SOA file
-                result = '$TTL    2H\n'
-                result += '@ IN  SOA dns-master.example.com. contact.example.com. (\n'
-                result += '          {} ; Serial\n'.format(datetime.now().strftime("%Y%m%d00"))
-                result += '          7200          ; Refresh - 2hours\n'
-                result += '          1200          ; Retry - 20 minutess\n'
-                result += '          3600000       ; Expire - 6 weeks\n'
-                result += '          86400 )       ;  Minimum - 24 hours\n'
-                backup_file = open(backup_filename, 'w')
-                backup_file.write(result)
-                backup_file.close()
-            new_file = open(new_filename, 'w')
-            backup_file = open(backup_filename, 'r')
-            for line in backup_file.readlines():
-                if 'Serial' in line:
-                    item = line.split()
-                    serial = item[0]
-                    new_serial = int(serial) + 1
-                    new_file.write(line.replace(serial, str(new_serial)))
-                else:
-                    new_file.write(line)
-            os.rename(new_filename, filename)
-            os.remove(backup_filename)
+        save_zone(self.directory, self.network.ip.replace(':', '.'), self.show())
 
-    def save(self):
+    def render(self):
         """
-        This method write on example.com.db file all the records.
+        This method make the rendering of all subnets and return a list with the content of
+        each subnet file (in the same order than self.subnets).
+
+        We get all addresses sorted by IP and all their PTR records in 2 queries, then we split
+        them by subnet in one pass.
 
         :return:
         """
-        filename = '{}/{}.db'.format(self.directory, self.network.ip.replace(':', '.'))
-        with open(filename, 'w') as lock_file:
-            locks.lock(lock_file, locks.LOCK_EX)
-            lock_file.write(self.show())
-            lock_file.close()
-        self.update_soa()
+        ip_network = ipaddress.ip_network('{}/{}'.format(self.network.ip, self.network.prefix))
+        shift = ip_network.max_prefixlen - self.subnets[0].prefixlen
+        outputs = dict()
+        for subnet in self.subnets:
+            outputs[int(subnet.network_address) >> shift] = []
+        addresses = self.network.addresses().order_by('key').prefetch_related(
+            Prefetch('ns_entries', to_attr='ptr_entries',
+                     queryset=DomainEntry.objects.filter(type='PTR').select_related('domain').
+                     order_by('id')))
+        for address in addresses:
+            ip_address = ipaddress.ip_address(address.ip)
+            output = outputs.get(int(ip_address) >> shift)
+            if output is None:  # Address is not in the network
+                continue
+            for entry in address.ptr_entries:
+                output.append('{}.    IN {}    {}.{}. ; {}\n'.format(ip_address.reverse_pointer,
+                                                                     entry.type, entry.name,
+                                                                     entry.domain.name,
+                                                                     address.creation_date))
+        return [''.join(outputs[int(subnet.network_address) >> shift])
+                for subnet in self.subnets]
 
     def produce(self):
         """
         This method will create a set of file for reverse DNS. As bind need to have reverse
-        DNS from /8, /16 or /24 network, if we want to manage a different prefix (/21 per example),
-        we need to create a file for each /24 that compose the subnet.
+        DNS from /8, /16 or /24 network (or on nibble boundary for IPv6), if we want to manage a
+        different prefix (/21 per example), we need to create a file for each /24 that compose the
+        subnet. A subnet file (and its SOA) is only written if its content changed.
 
-        :return:
+        :return: the list of subnets which have been written
         """
-        for network in self.subnets:
-            output = ''
-            for address in self.network.addresses():
-                if ipaddress.ip_address(address.ip) in network:
-                    for entry in address.ns_entries.filter(type='PTR'):
-                        reversed_ip = ipaddress.ip_address(address.ip).reverse_pointer
-                        output += '{}.    IN {}    {}.{}. ; {}\n'.format(reversed_ip, entry.type,
-                                                                         entry.name,
-                                                                         entry.domain.name,
-                                                                         address.creation_date)
-            filename = '{}/{}.db'.format(self.directory,
-                                         str(network.network_address).replace(':', '.'))
-            with open(filename, 'w') as lock_file:
-                locks.lock(lock_file, locks.LOCK_EX)
-                lock_file.write(output)
-                lock_file.close()
-        self.update_soa()
+        if self.cache is None:
+            outputs = self.render()
+        else:
+            outputs = self.cache.get('bind-reverse', 'network', self.network.name, self.render)
+        changed = []
+        for subnet, output in zip(self.subnets, outputs):
+            zone = str(subnet.network_address).replace(':', '.')
+            if self.owners is not None and self.owners.get(zone, self.network.id) != \
+                    self.network.id:
+                continue
+            if save_zone(self.directory, zone, output):
+                changed.append(subnet)
+        return changed
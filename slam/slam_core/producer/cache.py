@@ -0,0 +1,79 @@
+"""
+This module provide a cache of rendered configuration (zone of a domain, reverse zones and DHCP
+configuration of a network, freeradius users) through django cache framework (see CACHES in
+settings). A fragment is versioned by the version of its target, renewed on each change (see
+slam_core.models.Change.versions), so a fragment is only rendered again if something changed
+since it has been cached. Versions must be read before rendering: if a change is added while we
+render, the fragment is cached with the previous version and rendered again on next commit.
+"""
+import threading
+
+from django.core.cache import cache
+
+PRODUCER_CACHE_PREFIX = 'slam:producer'
+PRODUCER_CACHE_TIMEOUT = 86400
+
+
+class FragmentCache:
+    """
+    This class provide rendered fragments for a commit and count cache hits and misses.
+    """
+    def __init__(self, versions):
+        """
+        Just a constructor
+
+        :param versions: a dict (target, name): version (see Change.versions)
+        """
+        self.versions = versions
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, producer, target, name):
+        """
+        This method return the cache key of a fragment
+
+        :param producer: the producer name (bind, bind-reverse, isc-dhcp, freeradius)
+        :param target: the journal target of the fragment (domain, network, freeradius)
+        :param name: the name of the domain or the network ('' for freeradius)
+        :return:
+        """
+        return '{}:{}:{}:{}'.format(PRODUCER_CACHE_PREFIX, producer, name,
+                                    self.versions.get((target, name)))
+
+    def get(self, producer, target, name, render):
+        """
+        This method return a fragment from cache or, if we don't have it, from render() and cache
+        it.
+
+        :param producer: the producer name (bind, bind-reverse, isc-dhcp, freeradius)
+        :param target: the journal target of the fragment (domain, network, freeradius)
+        :param name: the name of the domain or the network ('' for freeradius)
+        :param render: a function which return the fragment
+        :return:
+        """
+        key = self.key(producer, target, name)
+        fragment = cache.get(key)
+        with self.lock:
+            if fragment is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if fragment is None:
+            fragment = render()
+            cache.set(key, fragment, PRODUCER_CACHE_TIMEOUT)
+        return fragment
+
+    def stats(self):
+        """
+        This method return cache hits, misses and hit ratio
+
+        :return:
+        """
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'ratio': round(self.hits / total, 3) if total else None
+            }
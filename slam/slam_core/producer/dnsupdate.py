@@ -0,0 +1,667 @@
+"""
+This module provide a producer which send changes of the journal (see slam_core.models.Change)
+to DNS master servers as DNS UPDATE messages (RFC 2136) signed with TSIG (RFC 8945). A new host
+reach the DNS in a few milliseconds w/o rendering zones or reloading bind.
+
+For each changed name, we replace all its records (A, AAAA and CNAME for a domain entry, PTR for
+a IP address) by those we have in database. An update doesn't depend on previous ones, so it
+can be sent again and changes can be sent in any order. Changes we can't send as a update (per
+example a new domain) are only produced by commit. A change is marked as updated once it has
+been sent, commit and publish still produce it and are the reconciliation path.
+
+Once a key is installed, a update job is started when hosts are created or removed (see
+schedule_update), so they reach DNS servers w/o waiting for someone to ask for a update.
+
+Zones must allow updates signed with our key (allow-update or update-policy). As bind keep
+updates on its journal, zone files produced by commit must be loaded with rndc freeze and thaw
+(see scripts/slam-bind). Bind also increase the serial of a zone on each update, so we read it
+once a zone has been updated and keep it (see slam_core.models.ZoneSerial.follow): the next commit
+will write a greater serial.
+
+The key is read from DNSUPDATE_KEY_FILE, a file made by tsig-keygen:
+
+    key "slam" {
+        algorithm hmac-sha256;
+        secret "8Zr6xN...";
+    };
+"""
+# As we use django model that provide objects method which is not visible by pylint, we must
+# disable no-member error from pylint
+# pylint: disable=E1101
+import base64
+import functools
+import hashlib
+import hmac
+import ipaddress
+import os
+import random
+import re
+import socket
+import struct
+import time
+
+from django.db import transaction
+from django.db.models import Prefetch
+
+from slam_core.models import Change, Job, ZoneSerial
+from slam_core.producer.bind import BindReverse
+from slam_core.producer.scheduler import schedule
+from slam_domain.models import Domain, DomainEntry
+from slam_network.models import Network, Address
+
+DNSUPDATE_KEY_FILE = './dnsupdate.key'
+DNSUPDATE_PORT = 53
+DNSUPDATE_TIMEOUT = 2
+DNSUPDATE_RETRY = 3
+# Records have the default TTL of zones (see SOA_TEMPLATE in slam_core.producer.bind)
+DNSUPDATE_TTL = 7200
+DNSUPDATE_FUDGE = 300
+# Larger messages are sent through TCP
+DNSUPDATE_UDP_SIZE = 512
+# Updates of a zone are split in messages of this size at most (a DNS message can't be larger
+# than 65535 bytes)
+DNSUPDATE_MESSAGE_SIZE = 16384
+
+TYPE_A = 1
+TYPE_CNAME = 5
+TYPE_SOA = 6
+TYPE_PTR = 12
+TYPE_AAAA = 28
+TYPE_TSIG = 250
+CLASS_IN = 1
+CLASS_ANY = 255
+OPCODE_QUERY = 0
+OPCODE_UPDATE = 5
+FLAG_TC = 0x0200
+
+RCODES = {
+    0: 'NOERROR',
+    1: 'FORMERR',
+    2: 'SERVFAIL',
+    3: 'NXDOMAIN',
+    4: 'NOTIMP',
+    5: 'REFUSED',
+    6: 'YXDOMAIN',
+    7: 'YXRRSET',
+    8: 'NXRRSET',
+    9: 'NOTAUTH',
+    10: 'NOTZONE',
+    16: 'BADSIG',
+    17: 'BADKEY',
+    18: 'BADTIME'
+}
+
+TSIG_ALGORITHMS = {
+    'hmac-md5': ('hmac-md5.sig-alg.reg.int', hashlib.md5),
+    'hmac-sha1': ('hmac-sha1', hashlib.sha1),
+    'hmac-sha224': ('hmac-sha224', hashlib.sha224),
+    'hmac-sha256': ('hmac-sha256', hashlib.sha256),
+    'hmac-sha384': ('hmac-sha384', hashlib.sha384),
+    'hmac-sha512': ('hmac-sha512', hashlib.sha512)
+}
+
+
+class DnsUpdateError(Exception):
+    """
+    Raised when a update can't be sent or is refused by the server
+    """
+
+
+def encode_name(name):
+    """
+    This function return a domain name in wire format (w/o compression)
+
+    :param name: the domain name (per example host.example.com)
+    :return:
+    """
+    result = b''
+    for label in name.rstrip('.').split('.'):
+        if label == '':
+            continue
+        label = label.encode('idna')
+        if len(label) > 63:
+            raise DnsUpdateError('Label {} is too long'.format(label))
+        result += bytes([len(label)]) + label
+    return result + b'\x00'
+
+
+def decode_name(data, offset):
+    """
+    This function read a domain name (which can be compressed) in a message and return it with
+    the offset of the data after it.
+
+    :param data: the message
+    :param offset: where the name start
+    :return:
+    """
+    labels = []
+    end = None
+    for _ in range(128):  # We don't want to loop forever on a malformed message
+        length = data[offset]
+        if length & 0xc0 == 0xc0:  # A pointer to a name elsewhere in the message
+            if end is None:
+                end = offset + 2
+            offset = struct.unpack('!H', data[offset:offset + 2])[0] & 0x3fff
+        elif length == 0:
+            return '.'.join(labels), offset + 1 if end is None else end
+        else:
+            labels.append(data[offset + 1:offset + 1 + length].decode('ascii'))
+            offset += length + 1
+    raise DnsUpdateError('Malformed domain name')
+
+
+def parse_message(data):
+    """
+    This function return a dict abstraction of a DNS message. Sections are zone (question), and
+    the 3 sections of records (prerequisite, update and additional for a update). A record is a
+    dict with its name, type, class, ttl, rdata, and where it start in the message.
+
+    :param data: the message
+    :return:
+    """
+    try:
+        message_id, flags, *counts = struct.unpack('!6H', data[:12])
+        offset = 12
+        zone = []
+        for _ in range(counts[0]):
+            name, offset = decode_name(data, offset)
+            rtype, rclass = struct.unpack('!HH', data[offset:offset + 4])
+            zone.append({'name': name, 'type': rtype, 'class': rclass})
+            offset += 4
+        sections = []
+        for count in counts[1:]:
+            records = []
+            for _ in range(count):
+                start = offset
+                name, offset = decode_name(data, offset)
+                rtype, rclass, ttl, length = struct.unpack('!HHIH', data[offset:offset + 10])
+                offset += 10
+                records.append({'name': name, 'type': rtype, 'class': rclass, 'ttl': ttl,
+                                'rdata': data[offset:offset + length], 'rdata_offset': offset,
+                                'start': start})
+                offset += length
+            sections.append(records)
+    except (struct.error, IndexError, UnicodeDecodeError) as err:
+        raise DnsUpdateError('Malformed message: {}'.format(err))
+    return {
+        'id': message_id,
+        'flags': flags,
+        'opcode': (flags >> 11) & 0xf,
+        'rcode': flags & 0xf,
+        'zone': zone,
+        'prerequisite': sections[0],
+        'update': sections[1],
+        'additional': sections[2]
+    }
+
+
+def encode_rdata(rtype, value):
+    """
+    This function return the rdata of a record in wire format
+
+    :param rtype: the record type (TYPE_A, TYPE_AAAA, TYPE_CNAME or TYPE_PTR)
+    :param value: a IP address or a domain name
+    :return:
+    """
+    if rtype in (TYPE_A, TYPE_AAAA):
+        return ipaddress.ip_address(value).packed
+    return encode_name(value)
+
+
+def reverse_zone(subnet):
+    """
+    This function return the reverse zone of a subnet produced by BindReverse (per example
+    0.168.192.in-addr.arpa for 192.168.0.0/24)
+
+    :param subnet: a ipaddress network
+    :return:
+    """
+    labels = subnet.network_address.reverse_pointer.split('.')
+    if subnet.version == 4:
+        keep = subnet.prefixlen // 8 + 2
+    else:
+        keep = subnet.prefixlen // 4 + 2
+    return '.'.join(labels[-keep:])
+
+
+class TsigKey:
+    """
+    This class represent a TSIG key
+    """
+    def __init__(self, name, algorithm, secret):
+        """
+        Just a constructor
+
+        :param name: the key name
+        :param algorithm: the algorithm (see TSIG_ALGORITHMS)
+        :param secret: the secret encoded in base64
+        """
+        if algorithm not in TSIG_ALGORITHMS:
+            raise DnsUpdateError('Unsupported TSIG algorithm {}'.format(algorithm))
+        self.name = name
+        self.algorithm = algorithm
+        self.secret = base64.b64decode(secret)
+
+    @staticmethod
+    def load(filename=DNSUPDATE_KEY_FILE):
+        """
+        This method read a key from a file made by tsig-keygen
+
+        :param filename: the key file
+        :return:
+        """
+        with open(filename) as key_file:
+            content = key_file.read()
+        name = re.search(r'key\s+"?([^"\s{]+)"?\s*{', content)
+        algorithm = re.search(r'algorithm\s+"?([^";\s]+)"?\s*;', content)
+        secret = re.search(r'secret\s+"([^"]+)"\s*;', content)
+        if name is None or algorithm is None or secret is None:
+            raise DnsUpdateError('Invalid key file {}'.format(filename))
+        return TsigKey(name.group(1), algorithm.group(1).lower(), secret.group(1))
+
+    def variables(self, time_signed, fudge, error=0, other=b''):
+        """
+        This method return TSIG variables added to the message to compute its MAC
+
+        :param time_signed: when the message has been signed
+        :param fudge: the time error permitted
+        :param error: the TSIG error
+        :param other: the other data
+        :return:
+        """
+        return encode_name(self.name.lower()) + struct.pack('!HI', CLASS_ANY, 0) + \
+            encode_name(TSIG_ALGORITHMS[self.algorithm][0]) + \
+            struct.pack('!QHHH', time_signed, fudge, error, len(other))[2:] + other
+
+    def mac(self, data):
+        """
+        This method return the MAC of data
+
+        :param data: what we sign
+        :return:
+        """
+        return hmac.new(self.secret, data, TSIG_ALGORITHMS[self.algorithm][1]).digest()
+
+    def sign(self, message, request_mac=b'', time_signed=None, fudge=DNSUPDATE_FUDGE):
+        """
+        This method return a message with its TSIG record and its MAC. A response is signed with
+        the MAC of the request.
+
+        :param message: a message w/o TSIG record
+        :param request_mac: the MAC of the request (to sign a response)
+        :param time_signed: when the message is signed (default now)
+        :param fudge: the time error permitted
+        :return:
+        """
+        if time_signed is None:
+            time_signed = int(time.time())
+        data = struct.pack('!H', len(request_mac)) + request_mac if request_mac else b''
+        mac = self.mac(data + message + self.variables(time_signed, fudge))
+        rdata = encode_name(TSIG_ALGORITHMS[self.algorithm][0]) + \
+            struct.pack('!QH', time_signed, fudge)[2:] + struct.pack('!H', len(mac)) + mac + \
+            message[:2] + struct.pack('!HH', 0, 0)
+        record = encode_name(self.name) + struct.pack('!HHIH', TYPE_TSIG, CLASS_ANY, 0,
+                                                      len(rdata)) + rdata
+        arcount = struct.unpack('!H', message[10:12])[0] + 1
+        return message[:10] + struct.pack('!H', arcount) + message[12:] + record, mac
+
+    def verify(self, data, request_mac=b''):
+        """
+        This method check the TSIG record of a message (its last record) and return the parsed
+        message and its MAC. A response is signed with the MAC of the request.
+
+        :param data: the message
+        :param request_mac: the MAC of the request (to verify a response)
+        :return:
+        """
+        message = parse_message(data)
+        if not message['additional'] or message['additional'][-1]['type'] != TYPE_TSIG:
+            raise DnsUpdateError('Message is not signed ({})'.format(
+                RCODES.get(message['rcode'], message['rcode'])))
+        record = message['additional'][-1]
+        if record['name'].lower() != self.name.lower().rstrip('.'):
+            raise DnsUpdateError('Message is signed with a unknown key {}'.format(record['name']))
+        algorithm, offset = decode_name(data, record['rdata_offset'])
+        time_signed, fudge, mac_size = struct.unpack('!QHH', b'\x00\x00' +
+                                                     data[offset:offset + 10])
+        offset += 10
+        mac = data[offset:offset + mac_size]
+        offset += mac_size
+        original_id, error, other_size = struct.unpack('!HHH', data[offset:offset + 6])
+        other = data[offset + 6:offset + 6 + other_size]
+        if error != 0:
+            raise DnsUpdateError('TSIG error {}'.format(RCODES.get(error, error)))
+        if algorithm.lower() != TSIG_ALGORITHMS[self.algorithm][0]:
+            raise DnsUpdateError('Message is signed with algorithm {}'.format(algorithm))
+        # The MAC is computed on the message w/o TSIG record and w/ its original id
+        unsigned = struct.pack('!H', original_id) + data[2:10] + \
+            struct.pack('!H', len(message['additional']) - 1) + data[12:record['start']]
+        prefix = struct.pack('!H', len(request_mac)) + request_mac if request_mac else b''
+        expected = self.mac(prefix + unsigned + self.variables(time_signed, fudge, error, other))
+        if not hmac.compare_digest(mac, expected):
+            raise DnsUpdateError('Bad TSIG signature')
+        if abs(time.time() - time_signed) > fudge:
+            raise DnsUpdateError('TSIG signature has expired')
+        return message, mac
+
+
+class UpdateMessage:
+    """
+    This class build a DNS UPDATE message for a zone. Records are removed before new ones are
+    added, the server apply the whole message or nothing. A message can't be larger than
+    DNSUPDATE_MESSAGE_SIZE (w/o TSIG), so the updates of a zone may need more than one message.
+    """
+    def __init__(self, zone):
+        """
+        Just a constructor
+
+        :param zone: the zone we update (per example example.com)
+        """
+        self.zone = zone
+        self.message_id = random.SystemRandom().randrange(0x10000)
+        self.records = []
+        self.names = set()
+        self.size = 12 + len(encode_name(zone)) + 4
+
+    def replace(self, name, rtypes, records):
+        """
+        This method replace all records of some types of a name. Nothing is added if the message
+        would be larger than DNSUPDATE_MESSAGE_SIZE (unless it's empty).
+
+        :param name: the fqdn
+        :param rtypes: types of records we replace
+        :param records: a list of (type, value), new records of the name
+        :return: True if records have been added to the message
+        """
+        result = []
+        for rtype in rtypes:
+            # Delete a RRset: class ANY, TTL 0 and no rdata
+            result.append(encode_name(name) + struct.pack('!HHIH', rtype, CLASS_ANY, 0, 0))
+        for rtype, value in records:
+            rdata = encode_rdata(rtype, value)
+            result.append(encode_name(name) +
+                          struct.pack('!HHIH', rtype, CLASS_IN, DNSUPDATE_TTL, len(rdata)) +
+                          rdata)
+        size = sum(len(record) for record in result)
+        if self.records and self.size + size > DNSUPDATE_MESSAGE_SIZE:
+            return False
+        self.names.add(name)
+        self.records += result
+        self.size += size
+        return True
+
+    def to_wire(self):
+        """
+        This method return the message in wire format (w/o TSIG)
+
+        :return:
+        """
+        header = struct.pack('!6H', self.message_id, OPCODE_UPDATE << 11, 1, 0,
+                             len(self.records), 0)
+        return header + encode_name(self.zone) + struct.pack('!HH', TYPE_SOA, CLASS_IN) + \
+            b''.join(self.records)
+
+
+def exchange(server, data, message_id, port=DNSUPDATE_PORT, timeout=DNSUPDATE_TIMEOUT):
+    """
+    This function send a message to a server and return its response. Message is sent through
+    UDP (and again if we don't get a response) or through TCP if it's too large for UDP or if the
+    response has been truncated.
+
+    :param server: IP address of the server
+    :param data: the message
+    :param message_id: the id of the message
+    :param port: the DNS port of the server
+    :param timeout: how long we wait for a response
+    :return:
+    """
+    family = socket.AF_INET6 if ipaddress.ip_address(server).version == 6 else socket.AF_INET
+    if len(data) <= DNSUPDATE_UDP_SIZE:
+        with socket.socket(family, socket.SOCK_DGRAM) as udp:
+            udp.settimeout(timeout)
+            udp.connect((server, port))
+            response = None
+            for _ in range(DNSUPDATE_RETRY):
+                udp.send(data)
+                try:
+                    while response is None:
+                        response = udp.recv(65535)
+                        if len(response) < 12 or \
+                                struct.unpack('!H', response[:2])[0] != message_id:
+                            response = None  # Not a response to our message
+                    break
+                except socket.timeout:
+                    continue
+            if response is None:
+                raise DnsUpdateError('No response from {}'.format(server))
+            if not struct.unpack('!H', response[2:4])[0] & FLAG_TC:
+                return response
+    with socket.create_connection((server, port), timeout=timeout) as tcp:
+        tcp.sendall(struct.pack('!H', len(data)) + data)
+        buffer = b''
+        while len(buffer) < 2 or len(buffer) < 2 + struct.unpack('!H', buffer[:2])[0]:
+            chunk = tcp.recv(65535)
+            if not chunk:
+                raise DnsUpdateError('Connection closed by {}'.format(server))
+            buffer += chunk
+        return buffer[2:2 + struct.unpack('!H', buffer[:2])[0]]
+
+
+def send_update(server, update, key, port=DNSUPDATE_PORT):
+    """
+    This function sign a update, send it to a server and check its response
+
+    :param server: IP address of the server
+    :param update: the UpdateMessage
+    :param key: the TsigKey
+    :param port: the DNS port of the server
+    :return:
+    """
+    data, mac = key.sign(update.to_wire())
+    response, _ = key.verify(exchange(server, data, update.message_id, port=port), mac)
+    if response['rcode'] != 0:
+        raise DnsUpdateError('Update of {} refused by {}: {}'.format(
+            update.zone, server, RCODES.get(response['rcode'], response['rcode'])))
+
+
+def zone_update(updates, server, zone, change, name, rtypes, records):
+    """
+    This function add to updates the records of a name (see UpdateMessage.replace). A new
+    message is started when the last message of the zone is full.
+
+    :param updates: a dict (server, zone file): (list of UpdateMessage, set of (target, name))
+    :param server: IP address of the server
+    :param zone: a tuple (zone, zone file), the zone file is the name used to store the serial of
+      the zone (see slam_core.producer.bind.save_zone)
+    :param change: the change (target, name) produced by this update
+    :param name: the fqdn
+    :param rtypes: types of records we replace
+    :param records: a list of (type, value), new records of the name
+    :return:
+    """
+    messages, changes = updates.setdefault((server, zone[1]), ([], set()))
+    changes.add(change)
+    if not messages or not messages[-1].replace(name, rtypes, records):
+        messages.append(UpdateMessage(zone[0]))
+        messages[-1].replace(name, rtypes, records)
+
+
+def query_serial(server, zone, key, port=DNSUPDATE_PORT):
+    """
+    This function return the SOA serial of a zone on a server
+
+    :param server: IP address of the server
+    :param zone: the zone (per example example.com)
+    :param key: the TsigKey
+    :param port: the DNS port of the server
+    :return:
+    """
+    message_id = random.SystemRandom().randrange(0x10000)
+    query = struct.pack('!6H', message_id, OPCODE_QUERY << 11, 1, 0, 0, 0) + encode_name(zone) + \
+        struct.pack('!HH', TYPE_SOA, CLASS_IN)
+    data, mac = key.sign(query)
+    data = exchange(server, data, message_id, port=port)
+    response, _ = key.verify(data, mac)
+    if response['rcode'] != 0:
+        raise DnsUpdateError('SOA query of {} refused by {}: {}'.format(
+            zone, server, RCODES.get(response['rcode'], response['rcode'])))
+    # For a query, the first section of records (prerequisite of a update) is the answer
+    for record in response['prerequisite']:
+        if record['type'] == TYPE_SOA:
+            _, offset = decode_name(data, record['rdata_offset'])  # Primary server
+            _, offset = decode_name(data, offset)  # Contact
+            return struct.unpack('!I', data[offset:offset + 4])[0]
+    raise DnsUpdateError('No SOA for {} on {}'.format(zone, server))
+
+
+def send_zone(server, zone, messages, key, serials, port=DNSUPDATE_PORT):
+    """
+    This function send updates of a zone to a server, then read the new serial of the zone
+
+    :param server: IP address of the server
+    :param zone: the zone file (see zone_update)
+    :param messages: the UpdateMessage of the zone
+    :param key: the TsigKey
+    :param serials: a dict where we put the serial of the zone (zone file: serial)
+    :param port: the DNS port of the server
+    :return:
+    """
+    for message in messages:
+        send_update(server, message, key, port=port)
+    serials[zone] = query_serial(server, messages[0].zone, key, port=port)
+
+
+def domain_updates(domains, updates):
+    """
+    This function add to updates the A, AAAA and CNAME records of changed domain entries. If we
+    don't know what changed in a domain (per example a new domain), only a commit can produce it.
+
+    :param domains: a dict domain name: set of changed entry names
+    :param updates: a dict (server, zone file): (list of UpdateMessage, set of (target, name))
+    :return:
+    """
+    for domain in Domain.objects.filter(name__in=domains):
+        names = domains[domain.name] - {''}
+        if not domain.dns_master or not names:
+            continue
+        records = dict((name, []) for name in names)
+        entries = DomainEntry.objects.filter(domain=domain, name__in=names).\
+            exclude(type='PTR').order_by('id').\
+            prefetch_related(Prefetch('address_set', queryset=Address.objects.order_by('id')),
+                             Prefetch('entries', queryset=DomainEntry.objects.
+                                      select_related('domain').order_by('id')))
+        for entry in entries:
+            if entry.type == 'A':
+                for address in entry.address_set.all():
+                    records[entry.name].append((TYPE_AAAA if address.version() == 6 else TYPE_A,
+                                                address.ip))
+            elif entry.type == 'CNAME':
+                for sub_entry in entry.entries.all():
+                    records[entry.name].append((TYPE_CNAME, '{}.{}'.format(
+                        sub_entry.name, sub_entry.domain.name)))
+        for name in sorted(records):
+            zone_update(updates, domain.dns_master, (domain.name, domain.name),
+                        ('domain', domain.name),
+                        '{}.{}'.format(name, domain.name), (TYPE_A, TYPE_AAAA, TYPE_CNAME),
+                        records[name])
+
+
+def network_updates(networks, updates):
+    """
+    This function add to updates the PTR records of changed IP addresses. Other changes of a
+    network (DHCP configuration) are only produced by commit.
+
+    :param networks: a dict network name: set of changed entries (IP addresses or host names)
+    :param updates: a dict (server, zone file): (list of UpdateMessage, set of (target, name))
+    :return:
+    """
+    for network in Network.objects.filter(name__in=networks):
+        ips = set()
+        for entry in networks[network.name]:
+            try:
+                ips.add(ipaddress.ip_address(entry))
+            except ValueError:
+                continue
+        if not network.dns_master or not ips:
+            continue
+        records = dict((ip, []) for ip in ips)
+        addresses = Address.objects.filter(ip__in=[str(ip) for ip in ips]).prefetch_related(
+            Prefetch('ns_entries', to_attr='ptr_entries',
+                     queryset=DomainEntry.objects.filter(type='PTR').select_related('domain').
+                     order_by('id')))
+        for address in addresses:
+            for entry in address.ptr_entries:
+                records[ipaddress.ip_address(address.ip)].append(
+                    (TYPE_PTR, '{}.{}'.format(entry.name, entry.domain.name)))
+        subnets = BindReverse(network, '').subnets
+        for ip_address in sorted(records, key=lambda ip: (ip.version, ip)):
+            subnet = next((subnet for subnet in subnets if ip_address in subnet), None)
+            if subnet is None:  # Address is not in the network
+                continue
+            zone_update(updates, network.dns_master,
+                        (reverse_zone(subnet), str(subnet.network_address).replace(':', '.')),
+                        ('network', network.name), ip_address.reverse_pointer, (TYPE_PTR,),
+                        records[ip_address])
+
+
+def update(progress=None, cancelled=None, key=None, port=DNSUPDATE_PORT):
+    """
+    This function send changes which have not been updated yet to DNS master servers (see
+    slam_core.models.Change.pending_updates). Updates of each zone (one or more messages) are sent
+    on a pool of threads (see slam_core.producer.scheduler). Changes of a domain or a network are
+    marked as updated unless one of its updates failed, so they are sent again on next update.
+    Serials of updated zones are kept for the next commit (see ZoneSerial.follow).
+
+    :param progress: a callback to follow updates (see slam_core.models.Job)
+    :param cancelled: a callback which raise a exception if update has been cancelled
+    :param key: the TsigKey (default read from DNSUPDATE_KEY_FILE)
+    :param port: the DNS port of servers
+    :return:
+    """
+    try:
+        if key is None:
+            key = TsigKey.load()
+    except (OSError, DnsUpdateError) as err:
+        return {
+            'status': 'failed',
+            'message': '{}'.format(err)
+        }
+    pending = Change.pending_updates()
+    updates = dict()
+    domain_updates(pending['domain'], updates)
+    network_updates(pending['network'], updates)
+    updates = sorted(updates.items())
+    serials = dict()
+    tasks = []
+    for (server, zone), (messages, _) in updates:
+        tasks.append(('dnsupdate', messages[0].zone,
+                      functools.partial(send_zone, server, zone, messages, key, serials,
+                                        port=port)))
+    producers = schedule(tasks, progress=progress, cancelled=cancelled)
+    # Serials are stored by this thread as a database write from workers could be blocked
+    for zone, serial in serials.items():
+        ZoneSerial.follow(zone, serial)
+    failed = set()
+    for producer, (_, (_, changes)) in zip(producers, updates):
+        if producer['status'] != 'done':
+            failed.update(changes)
+    updated = set(('domain', name) for name in pending['domain']) | \
+        set(('network', name) for name in pending['network'])
+    Change.acknowledge_updates(pending['last'], updated - failed)
+    return {
+        'status': 'failed' if failed else 'done',
+        'producers': producers
+    }
+
+
+def schedule_update(user=''):
+    """
+    This function start a update job (see update and slam_core.models.Job) once the current
+    transaction is committed, so changes are sent to DNS servers in background. Nothing is done if
+    we don't have a key (DNSUPDATE_KEY_FILE): dynamic updates are not used.
+
+    :param user: who did the changes
+    :return:
+    """
+    if os.path.exists(DNSUPDATE_KEY_FILE):
+        transaction.on_commit(lambda: Job.start('dnsupdate', update, user=user))
@@ -0,0 +1,212 @@
+"""
+This module provide tools to write files produced by producers.
+  - write_file: write a file atomically (other processes see the old or the new file, never a
+    partial one) and only if its content changed
+  - Manifest: the content hash of files we wrote, used to know if a file changed w/o reading it
+  - FileLock: a context manager which hold a exclusive lock on a file
+"""
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+from django.core.files import locks
+
+FILE_ENCODING = 'utf-8'
+FILE_CHUNK_SIZE = 65536
+FILE_MODE = 0o644
+
+
+def content_digest(content):
+    """
+    This function return the content hash (sha256) of a string, the same than file_digest of a
+    file with this content.
+
+    :param content: the string
+    :return:
+    """
+    return hashlib.sha256(content.encode(FILE_ENCODING)).hexdigest()
+
+
+def file_digest(filename):
+    """
+    This function return the content hash (sha256) of a file
+
+    :param filename: the file
+    :return:
+    """
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as hashed_file:
+        for chunk in iter(lambda: hashed_file.read(FILE_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def sync_directory(directory):
+    """
+    This function flush a directory on disk, so a file renamed in it is still there after a
+    crash. It does nothing on systems which can't open a directory (Windows).
+
+    :param directory: the directory
+    :return:
+    """
+    if not hasattr(os, 'O_DIRECTORY'):
+        return
+    descriptor = os.open(directory or '.', os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(descriptor)
+    finally:
+        os.close(descriptor)
+
+
+class Manifest:
+    """
+    This class keep the content hash of files we wrote with their size and modification time.
+    If a file has been modified by someone else (size or modification time changed) or if we
+    don't know it, its content hash is computed from the file.
+    """
+    def __init__(self):
+        """
+        Just a constructor
+        """
+        self.files = dict()
+        self.lock = threading.Lock()
+
+    def digest(self, filename):
+        """
+        This method return the content hash of a file or None if it doesn't exist
+
+        :param filename: the file
+        :return:
+        """
+        try:
+            stat = os.stat(filename)
+        except FileNotFoundError:
+            return None
+        key = os.path.abspath(filename)
+        with self.lock:
+            entry = self.files.get(key)
+        if entry is not None and entry[1:] == [stat.st_size, stat.st_mtime_ns]:
+            return entry[0]
+        digest = file_digest(filename)
+        with self.lock:
+            self.files[key] = [digest, stat.st_size, stat.st_mtime_ns]
+        return digest
+
+    def update(self, filename, digest):
+        """
+        This method store the content hash of a file we wrote
+
+        :param filename: the file
+        :param digest: its content hash
+        :return:
+        """
+        stat = os.stat(filename)
+        with self.lock:
+            self.files[os.path.abspath(filename)] = [digest, stat.st_size, stat.st_mtime_ns]
+
+    def load(self, filename):
+        """
+        This method load a manifest saved by another process (or before a restart). A invalid
+        or missing manifest is ignored as content hash is computed again from files.
+
+        :param filename: the manifest file
+        :return:
+        """
+        try:
+            with open(filename, encoding=FILE_ENCODING) as manifest_file:
+                files = json.load(manifest_file)
+        except (OSError, ValueError):
+            return
+        if isinstance(files, dict):
+            with self.lock:
+                self.files.update(files)
+
+    def save(self, filename):
+        """
+        This method save the manifest
+
+        :param filename: the manifest file
+        :return:
+        """
+        with self.lock:
+            content = json.dumps(self.files, indent=0, sort_keys=True)
+        write_file(filename, content, Manifest())
+
+
+# Per process manifest used by producers
+MANIFEST = Manifest()
+
+
+def write_file(filename, content, manifest=None):
+    """
+    This function write content into filename if it changed and return True if the file has been
+    written. Content is written into a temporary file (and flushed on disk) which replace
+    filename once it has been fully written, so a reader never see a truncated file. If its
+    content hash is the same than the current file (see Manifest), the temporary file is dropped.
+    Each writer has its own temporary file, so two writers of the same file can't remove or
+    replace the temporary file of the other.
+
+    :param filename: the file we want to write
+    :param content: a string or a iterable of strings (per example a generator of lines)
+    :param manifest: the manifest of written files (default MANIFEST)
+    :return:
+    """
+    if manifest is None:
+        manifest = MANIFEST
+    if isinstance(content, str):
+        content = [content]
+    descriptor, temporary_filename = tempfile.mkstemp(
+        dir=os.path.dirname(filename) or '.', prefix='{}.'.format(os.path.basename(filename)),
+        suffix='.tmp')
+    digest = hashlib.sha256()
+    try:
+        with open(descriptor, 'w', encoding=FILE_ENCODING) as temporary_file:
+            # mkstemp create a file only readable by us
+            os.fchmod(temporary_file.fileno(), FILE_MODE)
+            locks.lock(temporary_file, locks.LOCK_EX)
+            for chunk in content:
+                temporary_file.write(chunk)
+                digest.update(chunk.encode(FILE_ENCODING))
+            changed = manifest.digest(filename) != digest.hexdigest()
+            if changed:
+                temporary_file.flush()
+                os.fsync(temporary_file.fileno())
+        if not changed:
+            os.remove(temporary_filename)
+            return False
+        os.replace(temporary_filename, filename)
+        sync_directory(os.path.dirname(filename))
+        manifest.update(filename, digest.hexdigest())
+    except BaseException:
+        # We don't want to let a partial file in build directory
+        if os.path.exists(temporary_filename):
+            os.remove(temporary_filename)
+        raise
+    return True
+
+
+class FileLock:
+    """
+    This class is a context manager which hold a exclusive lock on a file. It's used to avoid
+    two commits (or publish) to run at the same time.
+    """
+    def __init__(self, filename):
+        """
+        Just a constructor, we need the name of the lock file
+
+        :param filename: the lock file (created if it doesn't exist)
+        """
+        self.filename = filename
+        self.lock_file = None
+
+    def __enter__(self):
+        self.lock_file = open(self.filename, 'a')
+        locks.lock(self.lock_file, locks.LOCK_EX)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        locks.unlock(self.lock_file)
+        self.lock_file.close()
+        self.lock_file = None
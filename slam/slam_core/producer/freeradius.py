@@ -7,25 +7,79 @@ This module provide tools to produce freeradius configuration. A freeradius file
         Tunnel-Private-Group-Id = vlan-id
     DEFAULT Auth-Type := Reject
         Reply-Message = "Pas d'autorisation"
+
+Entries are sorted by MAC address and streamed from one query into the file. Hosts without
+interface or network are not authorized. If FREERADIUS_SPLIT_VLAN is set, entries are put on a
+file by VLAN (users-vlan-<vlan-id>) included by the users file, so only files of VLAN which
+changed are written.
 """
 # As we use django model that provide objects method which is not visible by pylint, we must
 # disable no-member error from pylint
 # pylint: disable=E1101
-from django.core.files import locks
+import glob
+import itertools
+import os
+
+from slam_core.producer.files import write_file
+
+FREERADIUS_SPLIT_VLAN = False
+FREERADIUS_CHUNK_SIZE = 2000
 
 
 class FreeRadius:
     """
     This class manage freeradius configuration
     """
-    def __init__(self, hosts, directory):
+    def __init__(self, hosts, directory, cache=None, split=None):
         """
         This is just a constructor. We just need a directory to put data
 
+        :param hosts: hosts we want to authorize
         :param directory: directory where to put data
+        :param cache: a cache of rendered configuration (see slam_core.producer.cache)
+        :param split: put entries on a file by VLAN (default FREERADIUS_SPLIT_VLAN)
         """
         self.hosts = hosts
         self.directory = directory
+        self.cache = cache
+        self.split = FREERADIUS_SPLIT_VLAN if split is None else split
+
+    def entries(self, *order):
+        """
+        This method return (MAC address, VLAN) of hosts from one query (joined with interfaces and
+        networks), read by chunk.
+
+        :param order: fields used to sort entries
+        :return:
+        """
+        return self.hosts.filter(interface__isnull=False, network__isnull=False).\
+            order_by(*order).values_list('interface__mac_address', 'network__vlan').\
+            iterator(chunk_size=FREERADIUS_CHUNK_SIZE)
+
+    @staticmethod
+    def entry(mac_address, vlan):
+        """
+        This method return the configuration of a host
+
+        :param mac_address: MAC address of the host
+        :param vlan: VLAN of its network
+        :return:
+        """
+        return '{} Cleartext-Password := {}\n' \
+               '    Tunnel-Type = VLAN,\n' \
+               '    Tunnel-Medium-Type = IEEE-802,\n' \
+               '    Tunnel-Private-Group-Id = {}\n'.format(mac_address, mac_address, vlan)
+
+    def lines(self):
+        """
+        This method make the rendering entry by entry.
+
+        :return:
+        """
+        for mac_address, vlan in self.entries('interface__mac_address', 'id'):
+            yield self.entry(mac_address, vlan)
+        yield 'DEFAULT Auth-Type := Reject\n'
+        yield '    Reply-Message = "No authorisation"\n'
 
     def show(self):
         """
@@ -34,26 +88,56 @@ class FreeRadius:
 
         :return:
         """
+        return ''.join(self.lines())
+
+    def show_vlans(self):
+        """
+        This method make the rendering by VLAN and return a dict VLAN: configuration
+
+        :return:
+        """
+        result = dict()
+        entries = self.entries('network__vlan', 'interface__mac_address', 'id')
+        for vlan, group in itertools.groupby(entries, key=lambda entry: entry[1]):
+            result[vlan] = ''.join(self.entry(mac_address, vlan) for mac_address, _ in group)
+        return result
+
+    def save_vlans(self):
+        """
+        This method write a file by VLAN and the users file which include them. Files of VLAN
+        we don't have anymore are removed.
+
+        :return:
+        """
+        if self.cache is None:
+            vlans = self.show_vlans()
+        else:
+            vlans = self.cache.get('freeradius-vlan', 'freeradius', '', self.show_vlans)
+        filenames = set()
         result = ''
-        for host in self.hosts:
-            if host.interface is not None:
-                result += '{} Cleartext-Password := {}\n'.format(host.interface.mac_address,
-                                                                 host.interface.mac_address)
-                result += '    Tunnel-Type = VLAN,\n'
-                result += '    Tunnel-Medium-Type = IEEE-802,\n'
-                result += '    Tunnel-Private-Group-Id = {}\n'.format(host.network.vlan)
+        for vlan in sorted(vlans):
+            filename = 'users-vlan-{}'.format(vlan)
+            filenames.add(os.path.join(self.directory, filename))
+            write_file(os.path.join(self.directory, filename), vlans[vlan])
+            result += '$INCLUDE {}\n'.format(filename)
         result += 'DEFAULT Auth-Type := Reject\n'
         result += '    Reply-Message = "No authorisation"\n'
-        return result
+        write_file('{}/users'.format(self.directory), result)
+        for filename in glob.glob(os.path.join(self.directory, 'users-vlan-*')):
+            if filename not in filenames:
+                os.remove(filename)
 
     def save(self):
         """
-        This method write on example.com.db file all the records.
+        This method write on users file all the records.
 
         :return:
         """
+        if self.split:
+            self.save_vlans()
+            return
         filename = '{}/users'.format(self.directory)
-        with open(filename, 'w') as lock_file:
-            locks.lock(lock_file, locks.LOCK_EX)
-            lock_file.write(self.show())
-            lock_file.close()
+        if self.cache is None:
+            write_file(filename, self.lines())
+        else:
+            write_file(filename, self.cache.get('freeradius', 'freeradius', '', self.show))
@@ -1,11 +1,78 @@
 """
 This module provide tools to produce ISC-DHCP configuration. It will put all DHCP entries on a file
 named network.conf (for local.conf).
+
+Hosts of all produced networks are read in one query (see DhcpHosts) and split by network, so the
+number of queries doesn't depend on the number of hosts or networks. IPv6 networks are produced
+for DHCPv6 (dhcpd -6), with a fixed-address6 for each host.
 """
 # As we use django model that provide objects method which is not visible by pylint, we must
 # disable no-member error from pylint
 # pylint: disable=E1101
-from django.core.files import locks
+import threading
+
+from django.db.models import Q
+
+from slam_host.models import Host
+from slam_core.producer.files import write_file
+
+
+class DhcpHosts:
+    """
+    This class provide DHCP hosts of a set of networks. Hosts are read from database the first
+    time we need them (a network may be rendered from cache), then shared by all producers of a
+    commit (which can run on different threads).
+    """
+    def __init__(self, networks):
+        """
+        Just a constructor
+
+        :param networks: networks we want to produce
+        """
+        self.networks = [network.id for network in networks]
+        self.lock = threading.Lock()
+        self.hosts = None
+
+    def load(self):
+        """
+        This method read hosts which have a address in one of our networks or which are in one of
+        our networks (for dynamic DHCP) with their MAC address and addresses in one query, and
+        split them by network.
+
+        :return: a dict network id: (fixed hosts, dynamic hosts), fixed hosts is a list of
+          (name, mac address, ip), dynamic hosts a list of mac address
+        """
+        rows = Host.objects.filter(dhcp=True, interface__isnull=False).\
+            filter(Q(network__in=self.networks) | Q(addresses__network__in=self.networks)).\
+            order_by('id', 'addresses__id').\
+            values_list('id', 'name', 'interface__mac_address', 'network_id',
+                        'addresses__network_id', 'addresses__ip')
+        hosts = dict((network, ([], [])) for network in self.networks)
+        fixed = set()
+        dynamic = dict()
+        for host, name, mac_address, network, address_network, address in rows:
+            if address_network in hosts and (host, address_network) not in fixed:
+                # Like before, a host only have one entry by network
+                fixed.add((host, address_network))
+                hosts[address_network][0].append((name, mac_address, address))
+            if network in hosts:
+                dynamic[(host, network)] = mac_address
+        for (host, network), mac_address in dynamic.items():
+            if (host, network) not in fixed:
+                hosts[network][1].append(mac_address)
+        return hosts
+
+    def get(self, network):
+        """
+        This method return fixed and dynamic hosts of a network (see load)
+
+        :param network: the network
+        :return:
+        """
+        with self.lock:
+            if self.hosts is None:
+                self.hosts = self.load()
+        return self.hosts.get(network.id, ([], []))
 
 
 class IscDhcp:
@@ -13,43 +80,52 @@ class IscDhcp:
     This class manage ISC-DHCP configuration. It will only provide host configuration, you have to
     include those file on DHCP configuration
     """
-    def __init__(self, network, hosts, directory):
+    def __init__(self, network, hosts, directory, cache=None):
         """
         This is just a constructor. We need a network and a directory where to put configuration
         file
 
         :param network: network name
+        :param hosts: DHCP hosts shared by producers (see DhcpHosts), None to read hosts of this
+          network only
         :param directory: directory where to put data
+        :param cache: a cache of rendered configuration (see slam_core.producer.cache)
         """
         self.network = network
+        if hosts is None:
+            hosts = DhcpHosts([network])
         self.hosts = hosts
         self.directory = directory
+        self.cache = cache
 
     def show(self):
         """
         This method make the rendering and return it as a string. To make git diff easier to read,
         we don't add some timestamp into the file.
 
+        DHCPv6 can't match a class on hardware address, so dynamic configuration of a IPv6
+        network is empty.
+
         :return:
         """
-        if self.network.version() == 6:
-            return '', ''
+        fixed, dynamic = self.hosts.get(self.network)
         result_fixed = ''
+        if self.network.version() == 6:
+            for name, mac_address, address in fixed:
+                result_fixed += 'host {} {{\n'.format(name)
+                result_fixed += '    hardware ethernet {};\n'.format(mac_address)
+                result_fixed += '    fixed-address6 {};\n'.format(address)
+                result_fixed += '}\n'
+            return result_fixed, ''
         result_dynamic = 'class "dynamic-{}" {{ match hardware; }}\n'.format(self.network.name)
-        for host in self.hosts:
-            if host.interface is not None and host.dhcp:
-                addresses = host.addresses.filter(network=self.network).count()
-                if addresses != 0:
-                    result_host = 'host {} {{\n'.format(host.name)
-                    result_host += '    hardware ethernet {};\n'.format(
-                        host.interface.mac_address)
-                    result_host += '    fixed-address {};\n'.format(host.name)
-                    result_host += '}\n'
-                    result_fixed += result_host
-                elif host.network == self.network:
-                    result_dynamic += 'subclass "dynamic-{}" {};\n'.format(self.network.name,
-                                                                           host.interface.
-                                                                           mac_address)
+        for name, mac_address, _ in fixed:
+            result_fixed += 'host {} {{\n'.format(name)
+            result_fixed += '    hardware ethernet {};\n'.format(mac_address)
+            result_fixed += '    fixed-address {};\n'.format(name)
+            result_fixed += '}\n'
+        for mac_address in dynamic:
+            result_dynamic += 'subclass "dynamic-{}" {};\n'.format(self.network.name,
+                                                                   mac_address)
         return result_fixed, result_dynamic
 
     def save(self):
@@ -59,12 +135,9 @@ class IscDhcp:
         :return:
         """
         filename = '{}/{}.conf'.format(self.directory, self.network.name)
-        fixed, dynamic = self.show()
-        with open(filename, 'w') as lock_file:
-            locks.lock(lock_file, locks.LOCK_EX)
-            lock_file.write(fixed)
-            lock_file.close()
-        with open('{}-dynamic'.format(filename), 'w') as lock_file:
-            locks.lock(lock_file, locks.LOCK_EX)
-            lock_file.write(dynamic)
-            lock_file.close()
+        if self.cache is None:
+            fixed, dynamic = self.show()
+        else:
+            fixed, dynamic = self.cache.get('isc-dhcp', 'network', self.network.name, self.show)
+        write_file(filename, fixed)
+        write_file('{}-dynamic'.format(filename), dynamic)
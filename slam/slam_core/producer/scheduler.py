@@ -0,0 +1,89 @@
+"""
+This module provide a scheduler to run producers on a pool of threads. A producer task is a
+tuple (producer, name, function) like ('bind', 'example.com', Bind(domain, directory).save).
+Each task must write its own files so the result doesn't depend on the order tasks are run.
+"""
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from django.db import connections
+
+from slam_core.models import JobCancelled
+
+PRODUCER_WORKERS = 4
+
+
+def run_task(producer, name, function, progress=None, cancelled=None):
+    """
+    This function run a producer task and return a dict abstraction of its execution. progress
+    and cancelled are the callbacks of schedule, they are called from the worker thread so they
+    are run before its database connection is closed.
+
+    :param producer: the producer name (bind, bind-reverse, isc-dhcp, freeradius)
+    :param name: the name of the object produced (domain, network, ...)
+    :param function: the function which produce the files
+    :param progress: a callback to follow tasks execution
+    :param cancelled: a callback to know if we must stop
+    :return:
+    """
+    step = '{}:{}'.format(producer, name)
+    result = {
+        'producer': producer,
+        'name': name,
+        'start': datetime.now().isoformat(),
+        'status': 'done'
+    }
+    begin = time.monotonic()
+    try:
+        try:
+            if cancelled is not None:
+                cancelled()
+        except JobCancelled as err:
+            result['status'] = 'cancelled'
+            result['message'] = '{}'.format(err)
+            return result
+        except Exception as err:  # pylint: disable=W0703
+            result['status'] = 'failed'
+            result['message'] = '{}'.format(err)
+            return result
+        if progress is not None:
+            progress(step, 'running')
+        try:
+            function()
+        except Exception as err:  # pylint: disable=W0703
+            # We don't want a producer to stop others
+            result['status'] = 'failed'
+            result['message'] = '{}'.format(err)
+        result['duration'] = round(time.monotonic() - begin, 3)
+        if progress is not None:
+            progress(step, result['status'])
+    finally:
+        # Each thread has its own database connection, we must close it
+        connections.close_all()
+    return result
+
+
+def schedule(tasks, workers=PRODUCER_WORKERS, progress=None, cancelled=None):
+    """
+    This function run all producer tasks on a pool of threads and return their execution
+    abstraction in the same order than tasks.
+
+    progress and cancelled are optional callbacks used by background jobs (see
+    slam_core.models.Job). progress(step, state) is called when a task start and end,
+    cancelled() raise a exception if job has been cancelled. Tasks which are not started when a
+    job is cancelled are not run and JobCancelled is raised once running tasks are finished.
+
+    :param tasks: a list of (producer, name, function)
+    :param workers: number of threads
+    :param progress: a callback to follow tasks execution
+    :param cancelled: a callback to know if we must stop
+    :return:
+    """
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(run_task, *task, progress=progress, cancelled=cancelled)
+                   for task in tasks]
+        result = [future.result() for future in futures]
+    if any(task['status'] == 'cancelled' for task in result):
+        raise JobCancelled()
+    return result
@@ -0,0 +1,258 @@
+"""
+This module provide the engine used by publish to reload services (DNS, DHCP, freeradius) on
+servers. slam-agent is started on all servers in parallel through SSH.
+  - ParamikoTransport: a SSH connection to a server
+  - ConnectionPool: keep connections alive from one publish to the next one
+  - reload_servers: run a command on a list of servers and return a result for each server
+
+The engine only use transport.active(), transport.run(command, timeout) and transport.close().
+So any object with those methods can be used as transport (per example to test the engine
+w/o SSH server).
+"""
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import connections
+from paramiko import SSHClient, AutoAddPolicy, RSAKey
+
+from slam_core.models import JobCancelled
+
+SSH_KEY = './ssh/id_rsa'
+SSH_USER = 'root'
+SSH_KEEPALIVE = 30
+PUBLISH_COMMAND = '/usr/local/bin/slam-agent'
+PUBLISH_WORKERS = 8
+PUBLISH_TIMEOUT = 60
+
+KEYS = dict()
+KEYS_LOCK = threading.Lock()
+
+
+def load_key(filename=SSH_KEY):
+    """
+    This function return the private key stored in filename. The key is only read again if the
+    file has been modified.
+
+    :param filename: the private key file
+    :return:
+    """
+    with KEYS_LOCK:
+        # Instanciate the appropriate key class rather than relying on key_file which is
+        # attempting all possible class with the file resulting in inappropriate error messages
+        # making debugging harder.
+        # TBD: retrieve the key file name from a configuration file with its associated type
+        mtime = os.path.getmtime(filename)
+        if filename not in KEYS or KEYS[filename][0] != mtime:
+            with open(filename) as key_file:
+                KEYS[filename] = (mtime, RSAKey.from_private_key(key_file))
+        return KEYS[filename][1]
+
+
+class ParamikoTransport:
+    """
+    This class is a SSH connection to a server based on paramiko.
+    """
+    def __init__(self, server, timeout=PUBLISH_TIMEOUT, key=None):
+        """
+        Just a constructor, we open the connection to the server
+
+        :param server: the server name or IP address
+        :param timeout: how long we wait for the server to answer
+        :param key: the private key (default is the one stored in SSH_KEY)
+        """
+        if key is None:
+            key = load_key()
+        self.client = SSHClient()
+        self.client.load_system_host_keys()
+        self.client.set_missing_host_key_policy(AutoAddPolicy())
+        # The next 2 lines are required for paramiko 2.8+ to work with EL6 systems
+        # that don't support RSA2 algorithms
+        self.client.disabled_algorithms = {'keys': ['rsa-sha2-256', 'rsa-sha2-512']}
+        self.client.disabled_keys = {'pubkeys': ['rsa-sha2-256', 'rsa-sha2-512']}
+        self.client.connect(hostname=server, username=SSH_USER, pkey=key, timeout=timeout,
+                            banner_timeout=timeout, auth_timeout=timeout)
+        self.client.get_transport().set_keepalive(SSH_KEEPALIVE)
+
+    def active(self):
+        """
+        This method return True if the connection can still be used
+
+        :return:
+        """
+        transport = self.client.get_transport()
+        return transport is not None and transport.is_active()
+
+    def run(self, command, timeout=PUBLISH_TIMEOUT):
+        """
+        This method run a command on the server and return its exit code and outputs
+
+        :param command: the command to run
+        :param timeout: how long we wait for the command to finish
+        :return:
+        """
+        _, stdout, stderr = self.client.exec_command(command, timeout=timeout)
+        output = stdout.read().decode(errors='replace')
+        error = stderr.read().decode(errors='replace')
+        if not stdout.channel.status_event.wait(timeout):
+            raise TimeoutError('{} did not finish in {}s'.format(command, timeout))
+        return stdout.channel.recv_exit_status(), output, error
+
+    def close(self):
+        """
+        This method close the connection
+
+        :return:
+        """
+        self.client.close()
+
+
+class ConnectionPool:
+    """
+    This class keep one connection per server. A connection is removed from the pool while it's
+    used, so a connection is never used by two threads at the same time.
+    """
+    def __init__(self, factory=ParamikoTransport):
+        """
+        Just a constructor
+
+        :param factory: a function which return a new connection from (server, timeout)
+        """
+        self.factory = factory
+        self.connections = dict()
+        self.lock = threading.Lock()
+
+    def acquire(self, server, timeout=PUBLISH_TIMEOUT):
+        """
+        This method return a connection to the server, a new one is opened if we don't have a
+        active connection.
+
+        :param server: the server name or IP address
+        :param timeout: how long we wait for the server to answer
+        :return:
+        """
+        with self.lock:
+            transport = self.connections.pop(server, None)
+        if transport is not None and not transport.active():
+            transport.close()
+            transport = None
+        if transport is None:
+            transport = self.factory(server, timeout)
+        return transport
+
+    def release(self, server, transport):
+        """
+        This method give back a connection to the pool once we used it
+
+        :param server: the server name or IP address
+        :param transport: the connection
+        :return:
+        """
+        with self.lock:
+            if server not in self.connections:
+                self.connections[server] = transport
+                return
+        transport.close()
+
+    def close(self):
+        """
+        This method close all connections of the pool
+
+        :return:
+        """
+        with self.lock:
+            connections = list(self.connections.values())
+            self.connections.clear()
+        for transport in connections:
+            transport.close()
+
+
+POOL = ConnectionPool()
+
+
+def reload_server(pool, server, command, timeout):
+    """
+    This function run command on a server and return a dict abstraction of its execution.
+
+    :param pool: the connection pool
+    :param server: the server name or IP address
+    :param command: the command to run
+    :param timeout: how long we wait for the server
+    :return:
+    """
+    result = {
+        'server': server,
+        'status': 'done',
+        'exit_code': None,
+        'stdout': '',
+        'stderr': ''
+    }
+    begin = time.monotonic()
+    transport = None
+    try:
+        transport = pool.acquire(server, timeout)
+        result['exit_code'], result['stdout'], result['stderr'] = transport.run(command,
+                                                                                 timeout)
+        pool.release(server, transport)
+        if result['exit_code'] != 0:
+            result['status'] = 'failed'
+    except Exception as err:  # pylint: disable=W0703
+        # We don't want a server to stop others
+        if transport is not None:
+            transport.close()
+        result['status'] = 'failed'
+        result['message'] = '{}'.format(err)
+    result['duration'] = round(time.monotonic() - begin, 3)
+    return result
+
+
+def reload_servers(servers, command=PUBLISH_COMMAND, pool=None, workers=PUBLISH_WORKERS,
+                   timeout=PUBLISH_TIMEOUT, progress=None, cancelled=None):
+    """
+    This function run command on all servers in parallel and return their execution
+    abstraction in the same order than servers. progress and cancelled are the same callbacks
+    than slam_core.producer.scheduler.schedule, JobCancelled is raised if the job has been
+    cancelled.
+
+    :param servers: a list of server name or IP address
+    :param command: the command to run
+    :param pool: the connection pool (default is POOL)
+    :param workers: number of servers reloaded at the same time
+    :param timeout: how long we wait for each server
+    :param progress: a callback to follow servers reload
+    :param cancelled: a callback to know if we must stop
+    :return:
+    """
+    if pool is None:
+        pool = POOL
+
+    def execute(server):
+        try:
+            if cancelled is not None:
+                try:
+                    cancelled()
+                except JobCancelled as err:
+                    return {
+                        'server': server,
+                        'status': 'cancelled',
+                        'message': '{}'.format(err)
+                    }
+            if progress is not None:
+                progress(server, 'running')
+            result = reload_server(pool, server, command, timeout)
+            if progress is not None:
+                progress(server, result['status'])
+            return result
+        finally:
+            # Callbacks use the database connection of the worker thread, we must close it
+            connections.close_all()
+
+    if not servers:
+        return []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(execute, server) for server in servers]
+        result = [future.result() for future in futures]
+    if any(server['status'] == 'cancelled' for server in result):
+        raise JobCancelled()
+    return result
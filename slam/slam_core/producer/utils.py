@@ -4,56 +4,88 @@ This module provide some useful tools for GitPython
 # As we use django model that provide objects method which is not visible by pylint, we must
 # disable no-member error from pylint
 # pylint: disable=E1101
-from datetime import datetime
 import git
-from paramiko import SSHClient, AutoAddPolicy, RSAKey, __version__ as paramiko_version
 
+from slam_core.models import Change
 from slam_network.models import Network
 from slam_domain.models import Domain
 from slam_host.models import Host
-from slam_core.producer.bind import BindReverse, Bind
-from slam_core.producer.isc_dhcp import IscDhcp
+from slam_core.producer.bind import BindReverse, Bind, reverse_owners
+from slam_core.producer.isc_dhcp import IscDhcp, DhcpHosts
 from slam_core.producer.freeradius import FreeRadius
+from slam_core.producer.cache import FragmentCache
+from slam_core.producer.files import FileLock, MANIFEST
+from slam_core.producer.scheduler import schedule
+from slam_core.producer.ssh import reload_servers
 
 PRODUCER_DIRECTORY = './build'
+PRODUCER_LOCK = './build.lock'
+PRODUCER_MANIFEST = './build.manifest'
 PRODUCER_SSH_DIR = './ssh'
 
 
-def commit():
+def commit(full=False, progress=None, cancelled=None):
     """
-    This method trig a git commit for DNS/DHCP and freeradius
+    This method trig a git commit for DNS/DHCP and freeradius. By default, we only produce
+    domains, networks and freeradius configuration which changed since the last commit (see
+    slam_core.models.Change).
 
+    Producers are run on a pool of threads (see slam_core.producer.scheduler). A lock on
+    PRODUCER_LOCK avoid two commits to run at the same time. Rendered configuration is cached
+    (see slam_core.producer.cache), so a full commit only render again domains and networks which
+    changed. Cache hits and misses are returned with the result.
+
+    :param full: if set to True, we produce all configuration
+    :param progress: a callback to follow producers execution (see slam_core.models.Job)
+    :param cancelled: a callback which raise a exception if commit has been cancelled
     :return:
     """
-    domains = Domain.objects.all()
-    hosts = Host.objects.all()
-    networks = Network.objects.all()
-    print('#### DOMAINS ####')
-    for domain in domains:
-        print('{}    BEGIN    {}'.format(domain.name, datetime.now()))
-        domain_bind = Bind(domain, PRODUCER_DIRECTORY + '/bind')
-        domain_bind.save()
-        print('{}    END      {}'.format(domain.name, datetime.now()))
-    for network in networks:
-        print('#### NETWORK BIND ####')
-        print('{}   BEGIN   {}'.format(network.name, datetime.now()))
-        network_bind = BindReverse(network, PRODUCER_DIRECTORY + '/bind')
-        network_bind.produce()
-        print('{}   END     {}'.format(network.name, datetime.now()))
-        print('#### NETWORK DHCP ####')
-        print('{}   BEGIN   {}'.format(network.name, datetime.now()))
-        network_isc_dhcp = IscDhcp(network, hosts, PRODUCER_DIRECTORY + '/isc-dhcp')
-        network_isc_dhcp.save()
-        print('{}   END     {}'.format(network.name, datetime.now()))
-    print('#### FREERADIUS ####')
-    print('   BEGIN   {}'.format(datetime.now()))
-    freeradius = FreeRadius(hosts, PRODUCER_DIRECTORY + '/freeradius')
-    freeradius.save()
-    print('   BEGIN   {}'.format(datetime.now()))
-    build_repo = git.Repo(PRODUCER_DIRECTORY)
-    result = {
-        'data': build_repo.git.diff()
-    }
+    with FileLock(PRODUCER_LOCK):
+        pending = Change.pending()
+        # Versions are read before rendering (see slam_core.producer.cache)
+        cache = FragmentCache(Change.versions())
+        # Files are only written if their content hash changed (see slam_core.producer.files)
+        MANIFEST.load(PRODUCER_MANIFEST)
+        if full:
+            domains = Domain.objects.all()
+            networks = Network.objects.all()
+        else:
+            domains = Domain.objects.filter(name__in=pending['domain'])
+            networks = Network.objects.filter(name__in=pending['network'])
+        # DHCP hosts of all networks are read once (see slam_core.producer.isc_dhcp)
+        dhcp_hosts = DhcpHosts(networks)
+        # A reverse zone file shared by nested networks is only produced by one of them
+        owners = reverse_owners(Network.objects.all())
+        tasks = []
+        for domain in domains:
+            tasks.append(('bind', domain.name,
+                          Bind(domain, PRODUCER_DIRECTORY + '/bind', cache).save))
+        for network in networks:
+            tasks.append(('bind-reverse', network.name,
+                          BindReverse(network, PRODUCER_DIRECTORY + '/bind', cache,
+                                      owners).produce))
+            tasks.append(('isc-dhcp', network.name,
+                          IscDhcp(network, dhcp_hosts, PRODUCER_DIRECTORY + '/isc-dhcp',
+                                  cache).save))
+        if full or pending['freeradius']:
+            tasks.append(('freeradius', '',
+                          FreeRadius(Host.objects.all(), PRODUCER_DIRECTORY + '/freeradius',
+                                     cache).save))
+        try:
+            producers = schedule(tasks, progress=progress, cancelled=cancelled)
+        finally:
+            MANIFEST.save(PRODUCER_MANIFEST)
+        failed = any(producer['status'] != 'done' for producer in producers)
+        if not failed:
+            # If a producer failed, we keep changes to produce them again on next commit
+            Change.acknowledge(pending['last'])
+        build_repo = git.Repo(PRODUCER_DIRECTORY)
+        result = {
+            'status': 'failed' if failed else 'done',
+            'data': build_repo.git.diff(),
+            'producers': producers,
+            'cache': cache.stats()
+        }
     return result
 
 
@@ -70,14 +102,52 @@ def diff():
     return result
 
 
-def publish(message='This is the default comment'):
+def changed_servers(files):
     """
-    This function trig a git push command to make data available for production
+    This function return servers which use at least one of the files. A file is a path inside
+    PRODUCER_DIRECTORY (per example bind/example.com.db)
+      - bind/<domain>.db and bind/<domain>.soa.db: DNS master of the domain
+      - bind/<subnet>.db and bind/<subnet>.soa.db: DNS master of the network
+      - isc-dhcp/<network>.conf and isc-dhcp/<network>.conf-dynamic: DHCP server of the network
+      - freeradius/users and freeradius/users-vlan-<vlan>: freeradius servers of all networks
+
+    :param files: a list of files
+    :return:
+    """
+    files = set(files)
+    servers = []
+    freeradius = any(filename.startswith('freeradius/users') for filename in files)
+
+    def add(server):
+        if server and server not in servers:
+            servers.append(server)
+
+    for domain in Domain.objects.all():
+        if {'bind/{}.db'.format(domain.name), 'bind/{}.soa.db'.format(domain.name)} & files:
+            add(domain.dns_master)
+    for network in Network.objects.all():
+        reverse = set()
+        for subnet in BindReverse(network, 'bind').subnets:
+            subnet_filename = 'bind/{}'.format(str(subnet.network_address).replace(':', '.'))
+            reverse.update({'{}.db'.format(subnet_filename),
+                            '{}.soa.db'.format(subnet_filename)})
+        if reverse & files:
+            add(network.dns_master)
+        dhcp_filename = 'isc-dhcp/{}.conf'.format(network.name)
+        if {dhcp_filename, '{}-dynamic'.format(dhcp_filename)} & files:
+            add(network.dhcp)
+        if freeradius:
+            add(network.radius)
+    return servers
+
+
+def all_servers():
+    """
+    This function return all DNS, DHCP and freeradius servers
 
     :return:
     """
     servers = []
-    result = ''
     domains = Domain.objects.all()
     networks = Network.objects.all()
     for domain in domains:  # We get DNS servers
@@ -94,40 +164,52 @@ def publish(message='This is the default comment'):
         if network.radius is not None and\
                 network.radius not in servers:
             servers.append(network.radius)
+    return servers
+
+
+def publish(message='This is the default comment', full=False, progress=None, cancelled=None):
+    """
+    This function trig a git push command to make data available for production. By default,
+    we only reload servers which use a file that changed since the last publish (see
+    changed_servers). Like commit, we hold the lock on PRODUCER_LOCK while we commit and push
+    files, so we never push files a commit is writing.
+
+    :param message: the git commit message
+    :param full: if set to True, we reload all servers
+    :param progress: a callback to follow servers reload (see slam_core.models.Job)
+    :param cancelled: a callback which raise a exception if publish has been cancelled
+    :return:
+    """
     # We commit & push data
-    build_repo = git.Repo(PRODUCER_DIRECTORY)
-    build_repo.git.add('.')
-    try:  # If there are no modification, PythonGit raise a exception.
-        build_repo.git.commit(m=message)
-    except git.GitCommandError:
-        pass
-    build_repo.git.push()
-
-    # We create a ssh client objects
-    client = SSHClient()
-    client.load_system_host_keys()
-    client.set_missing_host_key_policy(AutoAddPolicy())
-    # The next 2 lines are required for paramiko 2.8+ to work with EL6 systems
-    # that don't support RSA2 algorithms
-    client.disabled_algorithms = {'keys': ['rsa-sha2-256', 'rsa-sha2-512']}
-    client.disabled_keys = {'pubkeys': ['rsa-sha2-256', 'rsa-sha2-512']}
-    # Instanciate the appropriate key class rather than relying on key_file which is
-    # attempting all possible class with the file resulting in inappropriate error messages
-    # making debugging harder.
-    # TBD: retrieve the key file name from a configuration file with its associated type
-    with open('ssh/id_rsa') as f:
-        private_key = RSAKey.from_private_key(f)
-    for server in servers:  # And we start SLAM sync. scripts for each domains
-        client.connect(hostname=server, username='root', pkey=private_key)
-        _, stdout, stderr = client.exec_command('/usr/local/bin/slam-agent')
-        result += 'Reload config. on {}'.format(server)
-        for line in stdout.readlines():
-            result += '{}\n'.format(line)
-        result += 'stderr on {}'.format(server)
-        for line in stderr.readlines():
-            result += '{}\n'.format(line)
-        client.close()
+    with FileLock(PRODUCER_LOCK):
+        build_repo = git.Repo(PRODUCER_DIRECTORY)
+        build_repo.git.add('.')
+        files = build_repo.git.diff('--cached', '--name-only').splitlines()
+        try:  # If there are no modification, PythonGit raise a exception.
+            build_repo.git.commit(m=message)
+        except git.GitCommandError:
+            pass
+        build_repo.git.push()
+    if full:
+        servers = all_servers()
+    else:
+        servers = changed_servers(files)
+
+    # We start SLAM sync. scripts on all servers
+    servers_result = reload_servers(servers, progress=progress, cancelled=cancelled)
+    result = ''
+    for server in servers_result:
+        result += 'Reload config. on {} ({})\n'.format(server['server'], server['status'])
+        if 'message' in server:
+            result += '{}\n'.format(server['message'])
+        result += server.get('stdout', '')
+        result += 'stderr on {}\n'.format(server['server'])
+        result += server.get('stderr', '')
+    failed = any(server['status'] != 'done' for server in servers_result)
     result_json = {
-        'data': result
+        'status': 'failed' if failed else 'done',
+        'data': result,
+        'files': files,
+        'servers': servers_result
     }
     return result_json
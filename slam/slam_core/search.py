@@ -0,0 +1,145 @@
+"""
+This module provide typed search operators for /search. A operator query is
+"<field> <operator> <value>":
+  - ip in <CIDR>: addresses and networks included in a CIDR (per example ip in 10.3.0.0/16)
+  - mac prefix <prefix>: interfaces which MAC address start with prefix (per example
+    mac prefix 00:11:22)
+  - fqdn suffix <suffix>: hosts and entries which name end with suffix (per example
+    fqdn suffix .lab.example.com)
+
+Each operator is a range query on a indexed column (IP keys, integer MAC address or reversed
+name), so we never scan a whole table. Output is the same list of hits than full text search
+(see slam_core.models.SearchToken.search).
+"""
+# As we use django models.Model, pylint fail to find objects method. We must disable pylint
+# test E1101 (no-member)
+# pylint: disable=E1101
+import re
+
+from slam_core.models import SEARCH_LIMIT, SEARCH_TOKEN_END
+from slam_core.utils import reversed_name, mac_key
+from slam_domain.models import DomainEntry
+from slam_hardware.models import Interface
+from slam_host.models import Host
+from slam_network.models import Network, Address
+from slam_network.utils import cidr_keys
+
+OPERATOR_REGEX = re.compile(r'^\s*(ip\s+in|mac\s+prefix|fqdn\s+suffix)\s+(\S+)\s*$',
+                            re.IGNORECASE)
+MAC_DIGITS = 12
+
+
+def hit(kind, object_id, name):
+    """
+    This function return a search hit
+
+    :param kind: the type of object
+    :param object_id: the primary key of the object
+    :param name: a human readable name of the object
+    :return:
+    """
+    return {
+        'type': kind,
+        'id': object_id,
+        'name': name,
+        'score': 0
+    }
+
+
+def parse(query):
+    """
+    This function return (operator, value) if query is a operator query (operator is one of
+    "ip in", "mac prefix" or "fqdn suffix") or None.
+
+    :param query: the search query
+    :return:
+    """
+    match = OPERATOR_REGEX.match(query)
+    if match is None:
+        return None
+    return ' '.join(match.group(1).lower().split()), match.group(2)
+
+
+def ip_in(cidr, limit=SEARCH_LIMIT):
+    """
+    This function return networks and addresses included in cidr
+
+    :param cidr: a network (per example 10.3.0.0/16)
+    :param limit: the maximum number of hits of each type
+    :return:
+    """
+    first, last = cidr_keys(cidr)
+    result = []
+    networks = Network.objects.filter(first_key__gte=first, last_key__lte=last).\
+        order_by('first_key').values_list('id', 'name')[:limit]
+    for network_id, name in networks:
+        result.append(hit('network', network_id, name))
+    addresses = Address.objects.filter(key__gte=first, key__lte=last).\
+        order_by('key').values_list('id', 'ip')[:limit]
+    for address_id, ip in addresses:
+        result.append(hit('address', address_id, ip))
+    return result
+
+
+def mac_prefix(prefix, limit=SEARCH_LIMIT):
+    """
+    This function return interfaces which MAC address start with prefix
+
+    :param prefix: the beginning of a MAC address (per example 00:11:22)
+    :param limit: the maximum number of hits
+    :return:
+    """
+    digits = len(re.sub(r'[:\-.]', '', prefix))
+    if digits == 0 or digits > MAC_DIGITS:
+        raise ValueError('Invalid MAC address prefix {}'.format(prefix))
+    shift = 4 * (MAC_DIGITS - digits)
+    first = mac_key(prefix) << shift
+    last = first + (1 << shift) - 1
+    interfaces = Interface.objects.filter(mac_key__gte=first, mac_key__lte=last).\
+        order_by('mac_key').values_list('id', 'mac_address')[:limit]
+    return [hit('interface', interface_id, mac_address)
+            for interface_id, mac_address in interfaces]
+
+
+def fqdn_suffix(suffix, limit=SEARCH_LIMIT):
+    """
+    This function return hosts and entries which name end with suffix
+
+    :param suffix: the end of a name (per example .lab.example.com)
+    :param limit: the maximum number of hits of each type
+    :return:
+    """
+    first = reversed_name(suffix)
+    last = first + SEARCH_TOKEN_END
+    result = []
+    hosts = Host.objects.filter(reversed_name__gte=first, reversed_name__lt=last).\
+        order_by('reversed_name').values_list('id', 'name')[:limit]
+    for host_id, name in hosts:
+        result.append(hit('host', host_id, name))
+    entries = DomainEntry.objects.filter(reversed_fqdn__gte=first, reversed_fqdn__lt=last).\
+        order_by('reversed_fqdn').select_related('domain')[:limit]
+    for entry in entries:
+        result.append(hit('entry', entry.id, entry.search_label()))
+    return result
+
+
+OPERATORS = {
+    'ip in': ip_in,
+    'mac prefix': mac_prefix,
+    'fqdn suffix': fqdn_suffix
+}
+
+
+def search(query, limit=SEARCH_LIMIT):
+    """
+    This function return hits of a operator query or None if query is not a operator query.
+    ValueError is raised if the value is invalid (per example a invalid CIDR).
+
+    :param query: the search query
+    :param limit: the maximum number of hits of each type
+    :return:
+    """
+    operator = parse(query)
+    if operator is None:
+        return None
+    return OPERATORS[operator[0]](operator[1], limit=limit)
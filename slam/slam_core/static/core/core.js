@@ -6,9 +6,36 @@ function sleep(ms) {
 }
 
 
+/*
+ * commit and publish are run by background jobs. wait_job poll the job until it's finished,
+ * call progress with the job state on each poll and callback with the final job.
+ */
+async function wait_job(job_id, progress, callback) {
+    while (true) {
+        var job = await $.ajax({
+            url: '/producer/jobs/' + job_id,
+            type: 'GET',
+            headers: { 'Accept': 'application/json' }
+        });
+        if (job.status != 'pending' && job.status != 'running') {
+            callback(job);
+            return;
+        }
+        progress(job);
+        await sleep(1000);
+    }
+}
+
+
+function job_progress(job) {
+    var steps = Object.keys(job.progress);
+    var finished = steps.filter(step => job.progress[step] != 'running');
+    return 'Please Wait... (' + finished.length + '/' + steps.length + ' steps done)';
+}
+
+
 class CommitPublishCtrl{
     commit() {
-        console.log('commit')
         var csrftoken = $.cookie('csrftoken');
         $('#commit-publish-commit').attr("disabled", true);
         $('#commit-publish-diff').text('Please Wait...');
@@ -19,9 +46,12 @@ class CommitPublishCtrl{
             url: '/producer/commit/',
             type: 'POST',
             success: function(data){
-                        console.log(data)
-                        $('#commit-publish-diff').text(data.data);
-                        $('#commit-publish-publish').attr("disabled", false);
+                        wait_job(data.job, function(job){
+                            $('#commit-publish-diff').text(job_progress(job));
+                        }, function(job){
+                            $('#commit-publish-diff').text(job.result.data || job.result.message);
+                            $('#commit-publish-publish').attr("disabled", job.status != 'done');
+                        });
                     }
         });
     }
@@ -37,8 +67,12 @@ class CommitPublishCtrl{
             url: '/producer/publish/',
             type: 'POST',
             success: function(data){
-                        $('#commit-publish-diff').text('');
-                        $('#commit-publish').modal('hide');
+                        wait_job(data.job, function(job){
+                            $('#commit-publish-diff').text(job_progress(job));
+                        }, function(job){
+                            $('#commit-publish-diff').text('');
+                            $('#commit-publish').modal('hide');
+                        });
                     }
         });
     }
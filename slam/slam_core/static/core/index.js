@@ -144,10 +144,14 @@ class HostViewListener {
             url: '/producer/commit/',
             type: 'POST',
             success: function(data){
-                        $('#diff').text(data.data);
-                        $('#push').attr("disabled", false);
-                        $('#network').hide();
-                        $('#hardware').hide();
+                        wait_job(data.job, function(job){
+                            $('#diff').text(job_progress(job));
+                        }, function(job){
+                            $('#diff').text(job.result.data || job.result.message);
+                            $('#push').attr("disabled", job.status != 'done');
+                            $('#network').hide();
+                            $('#hardware').hide();
+                        });
                     }
         });
     }
@@ -165,12 +169,17 @@ class HostViewListener {
             url: '/producer/publish/',
             type: 'POST',
             success: function(data){
-                        $('#diff').text('');
-                        $('#push').attr("disabled", true);
-                        $('#success-box').collapse('hide');
-                        $('#network').show();
-                        $('#hardware').show();
-                        $(location).attr('pathname', '/hosts/' + self.hostname + '.' + self.domain);
+                        wait_job(data.job, function(job){
+                            $('#diff').text(job_progress(job));
+                        }, function(job){
+                            $('#diff').text('');
+                            $('#push').attr("disabled", true);
+                            $('#success-box').collapse('hide');
+                            $('#network').show();
+                            $('#hardware').show();
+                            $(location).attr('pathname',
+                                             '/hosts/' + self.hostname + '.' + self.domain);
+                        });
                     }
         });
     }
@@ -2,4 +2,758 @@
 As this is a django internal template, we disable pylint
 """
 # pylint: disable=W0611
+import base64
+import os
+import socket
+import struct
+import tempfile
+import threading
+from datetime import date, timedelta
+from unittest import mock
+
+from django.core.cache import cache
+from django.utils import timezone
 from django.test import TestCase
+from slam_core.cache import ObjectCache
+from slam_core.models import Change, Job, JobCancelled, SearchToken, ZoneSerial, \
+    JOB_HEARTBEAT_TIMEOUT
+from slam_core.producer.bind import Bind, BindReverse, reverse_owners
+from slam_core.producer.cache import FragmentCache
+from slam_core.producer.dnsupdate import TsigKey, UpdateMessage, update as dns_update, \
+    encode_name, parse_message
+from slam_core.producer.files import write_file, Manifest
+from slam_core.producer.freeradius import FreeRadius
+from slam_core.producer.isc_dhcp import IscDhcp, DhcpHosts
+from slam_core.producer.scheduler import schedule
+from slam_core.producer.ssh import ConnectionPool, reload_servers
+from slam_core.producer.utils import changed_servers
+from slam_core.search import search as operator_search
+from slam_domain.models import Domain, DomainEntry, DOMAIN_CACHE
+from slam_network.models import Network
+from slam_host.models import Host
+
+
+class ChangeTestCase(TestCase):
+    def setUp(self) -> None:
+        Domain.create(name='example.com', args={'dns_master': '127.0.0.1'})
+        Network.create(name='net.example', address='192.168.0.0', prefix='24')
+        Network.create(name='other.example', address='192.168.1.0', prefix='24')
+        Change.acknowledge(Change.pending()['last'])
+
+    def test_change_host(self):
+        self.assertIsNone(Change.pending()['last'])
+        Host.create(name='dynamic.example.com', network='net.example',
+                    interface='00:11:22:33:44:55',
+                    dns_entry={'name': 'dynamic', 'domain': 'example.com'})
+        pending = Change.pending()
+        self.assertSetEqual(pending['domain'], {'example.com'})
+        self.assertSetEqual(pending['network'], {'net.example'})
+        self.assertTrue(pending['freeradius'])
+        Change.acknowledge(pending['last'])
+        Host.remove(name='dynamic.example.com')
+        pending = Change.pending()
+        self.assertSetEqual(pending['domain'], {'example.com'})
+        self.assertSetEqual(pending['network'], {'net.example'})
+
+
+    def test_versions(self):
+        versions = Change.versions()
+        Host.create(name='dynamic.example.com', network='net.example')
+        Change.log_bulk([('network', 'net.example', '192.168.0.2'),
+                         ('network', 'net.example', '192.168.0.3')])
+        Change.acknowledge(Change.pending()['last'])
+        # Versions are read in one query, whatever the size of the journal
+        with self.assertNumQueries(1):
+            result = Change.versions()
+        self.assertEqual(len(result), len(versions))
+        self.assertNotEqual(result[('network', 'net.example')],
+                            versions[('network', 'net.example')])
+        self.assertEqual(result[('network', 'other.example')],
+                         versions[('network', 'other.example')])
+
+
+class BindTestCase(TestCase):
+    def setUp(self) -> None:
+        Domain.create(name='example.com', args={'dns_master': '127.0.0.1'})
+        Network.create(name='net.example', address='192.168.0.0', prefix='24')
+
+    def test_bind_show(self):
+        Host.create(name='host-1.example.com', network='net.example',
+                    dns_entry={'name': 'host-1', 'domain': 'example.com'})
+        DomainEntry.create(name='www-1', domain='example.com', ns_type='CNAME',
+                           sub_entry={'name': 'host-1', 'domain': 'example.com', 'type': 'A'})
+        domain = Domain.objects.get(name='example.com')
+        with self.assertNumQueries(3):
+            result = Bind(domain, '/tmp').show()
+        self.assertIn('host-1    IN A    192.168.0.1 ;', result)
+        self.assertIn('www-1    IN CNAME    host-1.example.com. ;', result)
+        for index in range(2, 6):
+            Host.create(name='host-{}.example.com'.format(index), network='net.example',
+                        dns_entry={'name': 'host-{}'.format(index), 'domain': 'example.com'})
+            DomainEntry.create(name='www-{}'.format(index), domain='example.com',
+                               ns_type='CNAME', sub_entry={'name': 'host-{}'.format(index),
+                                                           'domain': 'example.com',
+                                                           'type': 'A'})
+        # Number of queries doesn't depend on number of records
+        with self.assertNumQueries(3):
+            result = Bind(domain, '/tmp').show()
+        self.assertEqual(len(result.splitlines()), 10)
+
+    def test_bind_reverse_produce(self):
+        Network.create(name='large.example', address='10.0.0.0', prefix='23')
+        Network.create(name='net6.example', address='fd00::', prefix='62')
+        Host.create(name='host-1.example.com', address='10.0.1.1',
+                    dns_entry={'name': 'host-1', 'domain': 'example.com'})
+        Host.create(name='host-2.example.com', address='fd00:0:0:2::1',
+                    dns_entry={'name': 'host-2', 'domain': 'example.com'})
+        with tempfile.TemporaryDirectory() as directory:
+            network = Network.objects.get(name='large.example')
+            with self.assertNumQueries(2):
+                BindReverse(network, directory).render()
+            changed = BindReverse(network, directory).produce()
+            self.assertEqual([str(subnet) for subnet in changed], ['10.0.0.0/24', '10.0.1.0/24'])
+            with open(os.path.join(directory, '10.0.1.0.db')) as zone_file:
+                self.assertTrue(zone_file.read().startswith(
+                    '1.1.0.10.in-addr.arpa.    IN PTR    host-1.example.com. ;'))
+            # Nothing changed, nothing is written
+            self.assertEqual(BindReverse(network, directory).produce(), [])
+            network = Network.objects.get(name='net6.example')
+            changed = BindReverse(network, directory).produce()
+            self.assertEqual(len(changed), 4)
+            with open(os.path.join(directory, 'fd00.0.0.2...db')) as zone_file:
+                self.assertIn('ip6.arpa.    IN PTR    host-2.example.com.', zone_file.read())
+        # A zone file of nested networks is only produced by the most specific one
+        Network.create(name='nested.example', address='10.0.1.0', prefix='24')
+        owners = reverse_owners(Network.objects.all())
+        self.assertEqual(owners['10.0.0.0'], Network.objects.get(name='large.example').id)
+        self.assertEqual(owners['10.0.1.0'], Network.objects.get(name='nested.example').id)
+        with tempfile.TemporaryDirectory() as directory:
+            for name, subnets in [('large.example', ['10.0.0.0/24']),
+                                  ('nested.example', ['10.0.1.0/24'])]:
+                network = Network.objects.get(name=name)
+                self.assertEqual([str(subnet) for subnet in
+                                  BindReverse(network, directory, owners=owners).produce()],
+                                 subnets)
+
+    def test_fragment_cache(self):
+        cache.clear()
+        Host.create(name='host-1.example.com', network='net.example',
+                    dns_entry={'name': 'host-1', 'domain': 'example.com'})
+        domain = Domain.objects.get(name='example.com')
+        network = Network.objects.get(name='net.example')
+        with tempfile.TemporaryDirectory() as directory:
+            fragments = FragmentCache(Change.versions())
+            Bind(domain, directory, fragments).save()
+            BindReverse(network, directory, fragments).produce()
+            self.assertEqual(fragments.stats(), {'hits': 0, 'misses': 2, 'ratio': 0.0})
+            # Nothing changed, fragments are not rendered again (we only read zone serials)
+            fragments = FragmentCache(Change.versions())
+            with self.assertNumQueries(2):
+                Bind(domain, directory, fragments).save()
+                BindReverse(network, directory, fragments).produce()
+            self.assertEqual(fragments.stats(), {'hits': 2, 'misses': 0, 'ratio': 1.0})
+            # A change in the domain give a new version of its fragment
+            Host.create(name='host-2.example.com', address='192.168.0.2',
+                        dns_entry={'name': 'host-2', 'domain': 'example.com'})
+            DomainEntry.create(name='www', domain='example.com')
+            fragments = FragmentCache(Change.versions())
+            Bind(domain, directory, fragments).save()
+            BindReverse(network, directory, fragments).produce()
+            self.assertEqual(fragments.stats()['misses'], 2)
+            with open(os.path.join(directory, 'example.com.db')) as zone_file:
+                self.assertIn('host-2    IN A    192.168.0.2 ;', zone_file.read())
+
+    def test_zone_serial(self):
+        domain = Domain.objects.get(name='example.com')
+        with tempfile.TemporaryDirectory() as directory:
+            soa_filename = os.path.join(directory, 'example.com.soa.db')
+            with open(soa_filename, 'w') as soa_file:
+                soa_file.write('@ IN  SOA ns.example.com. admin.example.com. (\n'
+                               '          2000010100 ; Serial\n')
+            Bind(domain, directory).save()
+            serial = ZoneSerial.objects.get(zone='example.com').serial
+            self.assertEqual(serial, int(date.today().strftime('%Y%m%d00')))
+            with open(soa_filename) as soa_file:
+                self.assertEqual(soa_file.read(), '@ IN  SOA ns.example.com. admin.example.com. '
+                                                  '(\n          {} ; Serial\n'.format(serial))
+            # Same content, same serial
+            Bind(domain, directory).save()
+            self.assertEqual(ZoneSerial.objects.get(zone='example.com').serial, serial)
+            Host.create(name='host-1.example.com', network='net.example',
+                        dns_entry={'name': 'host-1', 'domain': 'example.com'})
+            Bind(domain, directory).save()
+            self.assertEqual(ZoneSerial.objects.get(zone='example.com').serial, serial + 1)
+            with open(soa_filename) as soa_file:
+                self.assertIn('{} ; Serial'.format(serial + 1), soa_file.read())
+            # A serial raised by hand on the SOA file is not overwritten by the stored one
+            with open(soa_filename, 'w') as soa_file:
+                soa_file.write('          {} ; Serial\n'.format(serial + 50))
+            Host.create(name='host-2.example.com', network='net.example',
+                        dns_entry={'name': 'host-2', 'domain': 'example.com'})
+            Bind(domain, directory).save()
+            self.assertEqual(ZoneSerial.objects.get(zone='example.com').serial, serial + 51)
+            with open(soa_filename) as soa_file:
+                self.assertIn('{} ; Serial'.format(serial + 51), soa_file.read())
+            self.assertEqual(sorted(os.listdir(directory)),
+                             ['example.com.db', 'example.com.soa.db'])
+
+
+class IscDhcpTestCase(TestCase):
+    def setUp(self) -> None:
+        Network.create(name='net.example', address='192.168.0.0', prefix='24')
+        Network.create(name='net6.example', address='fd00::', prefix='64')
+
+    def test_isc_dhcp_show(self):
+        Host.create(name='fixed.example.com', network='net.example',
+                    interface='00:11:22:33:44:01')
+        Host.create(name='dynamic.example.com', network='net.example',
+                    interface='00:11:22:33:44:02', options={'no_ip': True, 'dhcp': True})
+        Host.create(name='disabled.example.com', network='net.example',
+                    interface='00:11:22:33:44:03', options={'no_ip': False, 'dhcp': False})
+        Host.create(name='nomac.example.com', network='net.example')
+        Host.create(name='fixed6.example.com', address='fd00::10', interface='00:11:22:33:44:04')
+        network = Network.objects.get(name='net.example')
+        network6 = Network.objects.get(name='net6.example')
+        hosts = DhcpHosts([network, network6])
+        # All networks are rendered from one query
+        with self.assertNumQueries(1):
+            fixed, dynamic = IscDhcp(network, hosts, '/tmp').show()
+            fixed6, dynamic6 = IscDhcp(network6, hosts, '/tmp').show()
+        self.assertEqual(fixed, 'host fixed.example.com {\n'
+                                '    hardware ethernet 00:11:22:33:44:01;\n'
+                                '    fixed-address fixed.example.com;\n'
+                                '}\n')
+        self.assertEqual(dynamic, 'class "dynamic-net.example" { match hardware; }\n'
+                                  'subclass "dynamic-net.example" 00:11:22:33:44:02;\n')
+        self.assertEqual(fixed6, 'host fixed6.example.com {\n'
+                                 '    hardware ethernet 00:11:22:33:44:04;\n'
+                                 '    fixed-address6 fd00::10;\n'
+                                 '}\n')
+        self.assertEqual(dynamic6, '')
+
+
+class FreeRadiusTestCase(TestCase):
+    def setUp(self) -> None:
+        Network.create(name='net.example', address='192.168.0.0', prefix='24', vlan=10)
+        Network.create(name='other.example', address='192.168.1.0', prefix='24', vlan=20)
+        Host.create(name='host-1.example.com', network='other.example',
+                    interface='00:11:22:33:44:02')
+        Host.create(name='host-2.example.com', network='net.example',
+                    interface='00:11:22:33:44:01')
+        Host.create(name='host-3.example.com', network='net.example')
+        Host.create(name='host-4.example.com', network='net.example',
+                    interface='00:11:22:33:44:03')
+        # A host w/o network is not authorized
+        Host.objects.filter(name='host-4.example.com').update(network=None)
+
+    def test_freeradius_save(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with self.assertNumQueries(1):
+                FreeRadius(Host.objects.all(), directory, split=False).save()
+            with open(os.path.join(directory, 'users')) as users_file:
+                users = users_file.read()
+            self.assertEqual(users.splitlines()[0::4],
+                             ['00:11:22:33:44:01 Cleartext-Password := 00:11:22:33:44:01',
+                              '00:11:22:33:44:02 Cleartext-Password := 00:11:22:33:44:02',
+                              'DEFAULT Auth-Type := Reject'])
+            self.assertIn('Tunnel-Private-Group-Id = 20\n', users)
+
+    def test_freeradius_split(self):
+        with tempfile.TemporaryDirectory() as directory:
+            open(os.path.join(directory, 'users-vlan-30'), 'w').close()
+            FreeRadius(Host.objects.all(), directory, split=True).save()
+            self.assertEqual(sorted(os.listdir(directory)),
+                             ['users', 'users-vlan-10', 'users-vlan-20'])
+            with open(os.path.join(directory, 'users')) as users_file:
+                self.assertTrue(users_file.read().startswith('$INCLUDE users-vlan-10\n'
+                                                             '$INCLUDE users-vlan-20\n'))
+            with open(os.path.join(directory, 'users-vlan-10')) as users_file:
+                self.assertEqual(users_file.read(),
+                                 FreeRadius.entry('00:11:22:33:44:01', 10))
+
+
+class FilesTestCase(TestCase):
+    def test_write_file(self):
+        manifest = Manifest()
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'example.com.db')
+            self.assertTrue(write_file(filename, (line for line in ['a\n', 'b\n']), manifest))
+            mtime = os.stat(filename).st_mtime_ns
+            # Same content, file is not written
+            self.assertFalse(write_file(filename, 'a\nb\n', manifest))
+            self.assertEqual(os.stat(filename).st_mtime_ns, mtime)
+            self.assertEqual(os.listdir(directory), ['example.com.db'])
+            self.assertTrue(write_file(filename, 'a\n', manifest))
+            # File modified by someone else is written again
+            with open(filename, 'w') as modified_file:
+                modified_file.write('modified\n')
+            self.assertTrue(write_file(filename, 'a\n', manifest))
+            with open(filename) as result_file:
+                self.assertEqual(result_file.read(), 'a\n')
+            # A manifest can be saved and loaded by another process
+            manifest_filename = os.path.join(directory, 'manifest')
+            manifest.save(manifest_filename)
+            manifest = Manifest()
+            manifest.load(manifest_filename)
+            self.assertIn(os.path.abspath(filename), manifest.files)
+            self.assertFalse(write_file(filename, 'a\n', manifest))
+            self.assertEqual(os.stat(filename).st_mode & 0o777, 0o644)
+            # Writers of the same file don't share their temporary file
+            errors = []
+
+            def writer(index):
+                try:
+                    for count in range(50):
+                        write_file(filename, '{} {}\n'.format(index, count), Manifest())
+                except OSError as err:
+                    errors.append(err)
+
+            writers = [threading.Thread(target=writer, args=(index,)) for index in range(4)]
+            for thread in writers:
+                thread.start()
+            for thread in writers:
+                thread.join()
+            self.assertEqual(errors, [])
+            self.assertEqual(sorted(os.listdir(directory)), ['example.com.db', 'manifest'])
+
+
+class SchedulerTestCase(TestCase):
+    def test_schedule(self):
+        def failed():
+            raise ValueError('This is a test')
+
+        with tempfile.TemporaryDirectory() as directory:
+            tasks = []
+            for index in range(10):
+                filename = os.path.join(directory, 'file-{}'.format(index))
+                content = 'line {}\n'.format(index)
+                tasks.append(('test', str(index),
+                              lambda filename=filename, content=content:
+                              write_file(filename, content)))
+            tasks.append(('test', 'failed', failed))
+            result = schedule(tasks)
+            self.assertEqual([task['name'] for task in result], [task[1] for task in tasks])
+            self.assertEqual(result[-1]['status'], 'failed')
+            self.assertEqual(result[-1]['message'], 'This is a test')
+            for index in range(10):
+                with open(os.path.join(directory, 'file-{}'.format(index))) as result_file:
+                    self.assertEqual(result_file.read(), 'line {}\n'.format(index))
+            self.assertEqual(len(os.listdir(directory)), 10)
+
+    def test_schedule_cancelled(self):
+        def cancelled():
+            raise JobCancelled()
+
+        progress = dict()
+        with self.assertRaises(JobCancelled):
+            schedule([('test', 'cancelled', lambda: None)],
+                     progress=progress.__setitem__, cancelled=cancelled)
+        self.assertDictEqual(progress, dict())
+
+
+class JobTestCase(TestCase):
+    def test_job_expired(self):
+        job = Job.objects.create(action='commit', status='running')
+        alive = Job.objects.create(action='commit', status='running')
+        Job.objects.filter(id=job.id).update(
+            heartbeat=timezone.now() - timedelta(seconds=JOB_HEARTBEAT_TIMEOUT + 1))
+        # A job w/o heartbeat will never end
+        self.assertEqual([(result['job'], result['status']) for result in Job.search()],
+                         [(alive.id, 'running'), (job.id, 'failed')])
+        self.assertEqual(Job.get(job.id)['result'], {'message': 'Job has been stopped w/o result'})
+
+    def test_job(self):
+        def function(progress, cancelled, value):
+            progress('step-1', 'done')
+            cancelled()
+            return {'data': value}
+
+        job = Job.objects.create(action='commit')
+        job.run(function, {'value': 'diff'})
+        result = Job.get(job.id)
+        self.assertEqual(result['status'], 'done')
+        self.assertDictEqual(result['progress'], {'step-1': 'done'})
+        self.assertDictEqual(result['result'], {'data': 'diff'})
+        self.assertEqual(Job.remove(job.id)['status'], 'failed')
+        self.assertEqual(len(Job.search()), 1)
+
+    def test_job_cancelled(self):
+        def function(progress, cancelled):
+            progress('step-1', 'done')
+            Job.remove(job.id)
+            cancelled()
+            progress('step-2', 'done')
+
+        job = Job.objects.create(action='commit')
+        job.run(function, dict())
+        result = Job.get(job.id)
+        self.assertEqual(result['status'], 'cancelled')
+        self.assertDictEqual(result['progress'], {'step-1': 'done'})
+
+    def test_job_failed(self):
+        def job_cancelled():
+            raise JobCancelled()
+
+        # A function which return a failed status (per example a commit w/ a failed producer)
+        job = Job.objects.create(action='commit')
+        job.run(lambda progress, cancelled: {'status': 'failed'}, dict())
+        self.assertEqual(Job.get(job.id)['status'], 'failed')
+        # Tasks cancelled by schedule cancel the job
+        job = Job.objects.create(action='commit')
+        job.run(lambda progress, cancelled: schedule([('test', 'next', lambda: None)],
+                                                     cancelled=job_cancelled), dict())
+        self.assertEqual(Job.get(job.id)['status'], 'cancelled')
+
+
+class FakeTransport:
+    """
+    A SSH transport which doesn't need a SSH server. A server named failed-* return a exit code
+    1 and unreachable-* can't be reached.
+    """
+    opened = []
+
+    def __init__(self, server, timeout):
+        if server.startswith('unreachable'):
+            raise TimeoutError('{} is unreachable'.format(server))
+        self.server = server
+        self.is_active = True
+        FakeTransport.opened.append(server)
+
+    def active(self):
+        return self.is_active
+
+    def run(self, command, timeout):
+        if self.server.startswith('failed'):
+            return 1, '', 'error on {}\n'.format(self.server)
+        return 0, '{} on {}\n'.format(command, self.server), ''
+
+    def close(self):
+        self.is_active = False
+
+
+class SshTestCase(TestCase):
+    def setUp(self) -> None:
+        FakeTransport.opened = []
+
+    def test_reload_servers(self):
+        pool = ConnectionPool(FakeTransport)
+        servers = ['dns-{}'.format(index) for index in range(10)] + ['failed-1', 'unreachable-1']
+        result = reload_servers(servers, command='agent', pool=pool)
+        self.assertEqual([server['server'] for server in result], servers)
+        self.assertEqual(result[0]['exit_code'], 0)
+        self.assertEqual(result[0]['stdout'], 'agent on dns-0\n')
+        self.assertEqual(result[-2]['status'], 'failed')
+        self.assertEqual(result[-2]['exit_code'], 1)
+        self.assertEqual(result[-1]['status'], 'failed')
+        self.assertEqual(result[-1]['message'], 'unreachable-1 is unreachable')
+        # Connections are kept alive for the next publish
+        reload_servers(servers, command='agent', pool=pool)
+        self.assertEqual(len(FakeTransport.opened), 11)
+        pool.connections['dns-0'].close()
+        reload_servers(['dns-0'], command='agent', pool=pool)
+        self.assertEqual(len(FakeTransport.opened), 12)
+        pool.close()
+        self.assertDictEqual(pool.connections, dict())
+
+    def test_reload_servers_cancelled(self):
+        def cancelled():
+            raise JobCancelled()
+
+        with self.assertRaises(JobCancelled):
+            reload_servers(['dns-0'], command='agent', pool=ConnectionPool(FakeTransport),
+                           cancelled=cancelled)
+        self.assertEqual(FakeTransport.opened, [])
+
+
+class PublishTestCase(TestCase):
+    def setUp(self) -> None:
+        Domain.create(name='example.com', args={'dns_master': '192.168.0.1'})
+        Domain.create(name='other.com', args={'dns_master': '192.168.0.2'})
+        Network.create(name='net.example', address='10.0.0.0', prefix='23',
+                       dns_master='192.168.0.3', dhcp='192.168.0.4', radius='192.168.0.6')
+        Network.create(name='other.example', address='10.1.0.0', prefix='24',
+                       dns_master='192.168.0.3', dhcp='192.168.0.5', radius='192.168.0.6')
+
+    def test_changed_servers(self):
+        self.assertEqual(changed_servers(['bind/example.com.db']), ['192.168.0.1'])
+        self.assertEqual(changed_servers(['bind/other.com.soa.db', 'bind/10.0.1.0.db']),
+                         ['192.168.0.2', '192.168.0.3'])
+        self.assertEqual(changed_servers(['isc-dhcp/other.example.conf-dynamic']), ['192.168.0.5'])
+        self.assertEqual(changed_servers(['freeradius/users']), ['192.168.0.6'])
+        self.assertEqual(changed_servers(['README']), [])
+
+
+class SearchTestCase(TestCase):
+    def setUp(self) -> None:
+        Domain.create(name='example.com', args={'dns_master': '127.0.0.1'})
+        Domain.create(name='lab.example.com', args={'dns_master': '127.0.0.1'})
+        Network.create(name='net.example', address='192.168.0.0', prefix='24',
+                       description='Web servers')
+        Host.create(name='web-1.lab.example.com', network='net.example',
+                    interface='00:11:22:33:44:55',
+                    dns_entry={'name': 'web-1', 'domain': 'lab.example.com'})
+
+    def test_search(self):
+        hits = SearchToken.search('web-1.lab')
+        self.assertEqual([(hit['type'], hit['name']) for hit in hits],
+                         [('entry', 'web-1.lab.example.com (A)'),
+                          ('entry', 'web-1.lab.example.com (PTR)'),
+                          ('host', 'web-1.lab.example.com')])
+        hits = SearchToken.search('web servers')
+        self.assertEqual([(hit['type'], hit['name']) for hit in hits],
+                         [('network', 'net.example')])
+        hits = SearchToken.search('00:11:22')
+        self.assertEqual([hit['type'] for hit in hits], ['interface'])
+        self.assertEqual(SearchToken.search('192.168.0.1')[0]['name'], '192.168.0.1')
+        Host.remove(name='web-1.lab.example.com')
+        # Hardware is kept when a host is removed
+        self.assertEqual([hit['type'] for hit in SearchToken.search('web-1')], ['hardware'])
+        with self.assertNumQueries(1):
+            SearchToken.search('lab example.com')
+
+    def test_search_operators(self):
+        Host.create(name='db-1.example.com', address='192.168.0.20',
+                    interface='00:11:23:00:00:01',
+                    dns_entry={'name': 'db-1', 'domain': 'example.com'})
+        hits = operator_search('ip in 192.168.0.0/28')
+        self.assertEqual([(hit['type'], hit['name']) for hit in hits],
+                         [('address', '192.168.0.1')])
+        hits = operator_search('ip in 192.168.0.0/16')
+        self.assertEqual([hit['type'] for hit in hits], ['network', 'address', 'address'])
+        hits = operator_search('mac prefix 00:11:22')
+        self.assertEqual([hit['name'] for hit in hits], ['00:11:22:33:44:55'])
+        hits = operator_search('MAC PREFIX 00:11')
+        self.assertEqual(len(hits), 2)
+        hits = operator_search('fqdn suffix .lab.example.com')
+        self.assertEqual([(hit['type'], hit['name']) for hit in hits],
+                         [('host', 'web-1.lab.example.com'),
+                          ('entry', 'web-1.lab.example.com (A)'),
+                          ('entry', 'web-1.lab.example.com (PTR)')])
+        self.assertIsNone(operator_search('web-1'))
+        with self.assertRaises(ValueError):
+            operator_search('ip in 10.0.0.0/99')
+
+
+class CacheTestCase(TestCase):
+    def setUp(self) -> None:
+        Domain.create(name='example.com', args={'dns_master': '127.0.0.1'})
+        Domain.create(name='example.org', args={'dns_master': '127.0.0.1'})
+
+    def test_cache(self):
+        cache = ObjectCache(Domain, size=1)
+        # A object is cached once the transaction is committed
+        with self.captureOnCommitCallbacks(execute=True):
+            domain = cache.get('example.com')
+        with self.assertNumQueries(0):
+            self.assertEqual(cache.get('example.com').id, domain.id)
+        # We get a copy, so the cached object can't be modified
+        cache.get('example.com').description = 'modified'
+        self.assertNotEqual(cache.get('example.com').description, 'modified')
+        # Least recently used object is dropped
+        with self.captureOnCommitCallbacks(execute=True):
+            cache.get('example.org')
+        with self.assertNumQueries(1):
+            cache.get('example.com')
+        self.assertEqual(cache.stats(), {'size': 1, 'hits': 3, 'misses': 3})
+        with self.assertRaises(Domain.DoesNotExist):
+            cache.get('unknown.com')
+        # Objects expire after ttl seconds
+        cache = ObjectCache(Domain, ttl=0)
+        with self.captureOnCommitCallbacks(execute=True):
+            cache.get('example.com')
+        with self.assertNumQueries(1):
+            cache.get('example.com')
+
+    def test_cache_invalidate(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            DOMAIN_CACHE.get('example.com')
+        self.assertEqual(DOMAIN_CACHE.stats()['size'], 1)
+        Domain.update(name='example.com', args={'description': 'updated'})
+        self.assertEqual(DOMAIN_CACHE.stats()['size'], 0)
+        self.assertEqual(DOMAIN_CACHE.get('example.com').description, 'updated')
+        # Objects read in a transaction which is not committed are not cached
+        self.assertEqual(DOMAIN_CACHE.stats()['size'], 0)
+
+
+class FakeDnsServer:
+    """
+    A local DNS server (UDP and TCP) which check TSIG of updates, keep them and answer with rcode.
+    Like named, the serial of a zone is increased on each update.
+    """
+    def __init__(self, key, rcode=0):
+        self.key = key
+        self.rcode = rcode
+        self.updates = []
+        self.sizes = []
+        self.serials = dict()
+        self.serial = int(date.today().strftime('%Y%m%d00')) + 10
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind(('127.0.0.1', 0))
+        self.socket.settimeout(0.1)
+        self.port = self.socket.getsockname()[1]
+        self.tcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.tcp.bind(('127.0.0.1', self.port))
+        self.tcp.listen()
+        self.tcp.settimeout(0.1)
+        self.stopped = threading.Event()
+        self.threads = [threading.Thread(target=self.serve, daemon=True),
+                        threading.Thread(target=self.serve_tcp, daemon=True)]
+        for thread in self.threads:
+            thread.start()
+
+    def answer(self, data):
+        message, mac = self.key.verify(data)
+        zone = message['zone'][0]['name']
+        question = encode_name(zone) + struct.pack('!HH', 6, 1)
+        if message['opcode'] == 0:  # SOA query
+            rdata = encode_name('ns.' + zone) + encode_name('admin.' + zone) + \
+                struct.pack('!5I', self.serials.get(zone, self.serial), 7200, 1200, 3600000, 86400)
+            response = struct.pack('!6H', message['id'], 0x8400, 1, 1, 0, 0) + question + \
+                question + struct.pack('!IH', 7200, len(rdata)) + rdata
+            return self.key.sign(response, request_mac=mac)[0]
+        self.sizes.append(len(data))
+        self.updates.append(message)
+        if self.rcode == 0:
+            self.serials[zone] = self.serials.get(zone, self.serial) + 1
+        response = struct.pack('!6H', message['id'], 0x8000 | 5 << 11 | self.rcode, 1, 0, 0,
+                               0) + question
+        return self.key.sign(response, request_mac=mac)[0]
+
+    def serve(self):
+        while not self.stopped.is_set():
+            try:
+                data, client = self.socket.recvfrom(65535)
+            except socket.timeout:
+                continue
+            self.socket.sendto(self.answer(data), client)
+
+    def serve_tcp(self):
+        while not self.stopped.is_set():
+            try:
+                client, _ = self.tcp.accept()
+            except socket.timeout:
+                continue
+            with client, client.makefile('rb') as stream:
+                size = struct.unpack('!H', stream.read(2))[0]
+                response = self.answer(stream.read(size))
+                client.sendall(struct.pack('!H', len(response)) + response)
+
+    def close(self):
+        self.stopped.set()
+        for thread in self.threads:
+            thread.join()
+        self.socket.close()
+        self.tcp.close()
+
+
+class DnsUpdateTestCase(TestCase):
+    def setUp(self) -> None:
+        self.key = TsigKey('slam', 'hmac-sha256', base64.b64encode(b'secret').decode())
+        Domain.create(name='example.com', args={'dns_master': '127.0.0.1'})
+        Network.create(name='net.example', address='192.168.0.0', prefix='24',
+                       dns_master='127.0.0.1')
+        Change.objects.update(updated=True)
+
+    def test_update(self):
+        server = FakeDnsServer(self.key)
+        try:
+            Host.create(name='host-1.example.com', network='net.example',
+                        dns_entry={'name': 'host-1', 'domain': 'example.com'})
+            result = dns_update(key=self.key, port=server.port)
+            self.assertEqual(result['status'], 'done')
+            self.assertIsNone(Change.pending_updates()['last'])
+            # Changes are still produced by commit
+            self.assertSetEqual(Change.pending()['domain'], {'example.com'})
+            updates = dict((update['zone'][0]['name'], update['update'])
+                           for update in server.updates)
+            self.assertEqual(sorted(updates), ['0.168.192.in-addr.arpa', 'example.com'])
+            # Records of the name are deleted (class ANY) and replaced
+            self.assertEqual([(record['name'], record['type'], record['class'])
+                              for record in updates['example.com']],
+                             [('host-1.example.com', 1, 255), ('host-1.example.com', 28, 255),
+                              ('host-1.example.com', 5, 255), ('host-1.example.com', 1, 1)])
+            self.assertEqual(updates['example.com'][-1]['rdata'], bytes([192, 168, 0, 1]))
+            self.assertEqual(updates['0.168.192.in-addr.arpa'][-1]['rdata'],
+                             encode_name('host-1.example.com'))
+            # Serials increased by the server are kept, the next commit write a greater one
+            self.assertEqual(ZoneSerial.objects.get(zone='example.com').serial, server.serial + 1)
+            self.assertEqual(ZoneSerial.objects.get(zone='192.168.0.0').serial, server.serial + 1)
+            with tempfile.TemporaryDirectory() as directory:
+                Bind(Domain.objects.get(name='example.com'), directory).save()
+            self.assertEqual(ZoneSerial.objects.get(zone='example.com').serial, server.serial + 2)
+            # A removed host only delete its records
+            server.updates = []
+            Host.remove(name='host-1.example.com')
+            self.assertEqual(dns_update(key=self.key, port=server.port)['status'], 'done')
+            for update in server.updates:
+                self.assertTrue(all(record['class'] == 255 for record in update['update']))
+        finally:
+            server.close()
+
+    def test_tsig_vector(self):
+        # A update and its response signed by dnspython 2.9 (message id 0x1234, key slam,
+        # hmac-sha256, secret "secret", signed at 1700000000 w/ a fudge of 300)
+        request = bytes.fromhex(
+            '123428000001000000020001076578616d706c6503636f6d000006000106686f73742d31c00c000100'
+            'ff000000000000c01d0001000100001c200004c0a8000104736c616d0000fa00ff00000000003d0b68'
+            '6d61632d7368613235360000006553f100012c00209360bccac0e1f9ba8cce1cdbbad79588737bdab1'
+            'adf18621ea78b51bab9b091c123400000000')
+        response = bytes.fromhex(
+            '1234a8000001000000000001076578616d706c6503636f6d000006000104736c616d0000fa00ff0000'
+            '0000003d0b686d61632d7368613235360000006553f100012c0020f54cf5da0abd9f3909388c1033e4'
+            '63f54a747cf226625d06098ec40651fa9ede123400000000')
+        with mock.patch('slam_core.producer.dnsupdate.time') as clock:
+            clock.time.return_value = 1700000000
+            message, mac = self.key.verify(request)
+            self.key.verify(response, mac)
+        self.assertEqual(mac.hex(), '9360bccac0e1f9ba8cce1cdbbad79588737bdab1adf18621ea78b51bab'
+                                    '9b091c')
+        # We sign them like dnspython
+        start = message['additional'][-1]['start']
+        self.assertEqual(self.key.sign(request[:10] + b'\x00\x00' + request[12:start],
+                                       time_signed=1700000000)[0], request)
+        start = parse_message(response)['additional'][-1]['start']
+        self.assertEqual(self.key.sign(response[:10] + b'\x00\x00' + response[12:start],
+                                       request_mac=mac, time_signed=1700000000)[0], response)
+        # Our message give the same update
+        update = UpdateMessage('example.com')
+        update.replace('host-1.example.com', (1,), [(1, '192.168.0.1')])
+        self.assertEqual([(record['name'], record['type'], record['class'], record['ttl'],
+                           record['rdata']) for record in
+                          parse_message(update.to_wire())['update']],
+                         [(record['name'], record['type'], record['class'], record['ttl'],
+                           record['rdata']) for record in message['update']])
+
+    def test_update_large_zone(self):
+        names = ['host-{}'.format(index) for index in range(800)]
+        domain = Domain.objects.get(name='example.com')
+        DomainEntry.objects.bulk_create([DomainEntry(name=name, domain=domain, type='A')
+                                         for name in names])
+        Change.log_bulk(('domain', 'example.com', name) for name in names)
+        server = FakeDnsServer(self.key)
+        try:
+            result = dns_update(key=self.key, port=server.port)
+            self.assertEqual(result['status'], 'done')
+            # Names of the zone are split in several messages (sent through TCP)
+            self.assertGreater(len(server.updates), 1)
+            self.assertTrue(all(size < 65535 for size in server.sizes))
+            self.assertEqual(len(result['producers']), 1)
+            self.assertEqual(sorted(set(record['name'] for update in server.updates
+                                        for record in update['update'])),
+                             sorted('{}.example.com'.format(name) for name in names))
+            self.assertIsNone(Change.pending_updates()['last'])
+        finally:
+            server.close()
+
+    def test_update_refused(self):
+        server = FakeDnsServer(self.key, rcode=5)
+        try:
+            Host.create(name='host-1.example.com', network='net.example',
+                        dns_entry={'name': 'host-1', 'domain': 'example.com'})
+            result = dns_update(key=self.key, port=server.port)
+            self.assertEqual(result['status'], 'failed')
+            self.assertIn('REFUSED', result['producers'][0]['message'])
+            # Changes will be sent again
+            self.assertSetEqual(set(Change.pending_updates()['domain']), {'example.com'})
+        finally:
+            server.close()
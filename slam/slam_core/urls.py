@@ -26,7 +26,10 @@ urlpatterns = [
     path('logs', views.logs, name='logs'),
     path('producer/commit/', views.commit, name='commit'),
     path('producer/publish/', views.publish, name='publish'),
+    path('producer/update/', views.update, name='update'),
     path('producer/diff', views.diff, name='diff'),
+    path('producer/jobs', views.jobs, name='jobs'),
+    path('producer/jobs/<int:job_id>', views.job, name='job'),
 
     path('domains/', include('slam_domain.urls')),
     path('networks/', include('slam_network.urls')),
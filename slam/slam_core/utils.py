@@ -1,9 +1,15 @@
 """
 This module provide some usefull function to avoid copy / paste.
 """
+import json
 import re
+from distutils.util import strtobool
 
 from django.core.exceptions import ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import JsonResponse, StreamingHttpResponse
+
+STREAM_CHUNK_SIZE = 2000
 
 
 def error_message(plugin, value, message):
@@ -22,6 +28,30 @@ def error_message(plugin, value, message):
     return result
 
 
+def reversed_name(name):
+    """
+    This function return the reversed lower case version of a name (per example
+    www.example.com give moc.elpmaxe.www). A suffix of name is a prefix of its reversed name, so
+    a suffix search can be done through a index.
+
+    :param name: a name (per example a fqdn)
+    :return:
+    """
+    return name.lower()[::-1]
+
+
+def mac_key(mac_address):
+    """
+    This function return the integer version of a MAC address (per example 00:11:22:33:44:55
+    give 0x001122334455). A MAC prefix (OUI) is a range of integers, so a prefix search can be
+    done through a index.
+
+    :param mac_address: a MAC address (separators : - . are ignored)
+    :return:
+    """
+    return int(re.sub(r'[:\-.]', '', mac_address), 16)
+
+
 def name_validator(name):
     """
     This function check if a name haven't some wierd char
@@ -33,3 +63,128 @@ def name_validator(name):
     pattern = re.compile(regex)
     if not pattern.match(name):
         raise ValidationError('Invalid name not match {}'.format(regex))
+
+
+class Page(list):
+    """
+    This class is a page of a list endpoint. It's a list of dict abstraction of objects with
+    next_after, the cursor of the next page (None if it's the last page).
+    """
+    next_after = None
+
+
+def list_options(data):
+    """
+    This function extract list options from a request query and remove them from it, so the
+    query can be used as filters.
+      - limit: the maximum number of objects we want
+      - after: the cursor returned by the previous page (X-Next-After header)
+      - stream: if set to true, the JSON list is written while objects are read from database
+
+    :param data: a dict of request query
+    :return:
+    """
+    result = {
+        'limit': None,
+        'after': None,
+        'stream': False
+    }
+    if 'limit' in data:
+        result['limit'] = int(data.pop('limit'))
+        if result['limit'] <= 0:
+            raise ValueError('limit must be a positive integer')
+    if 'after' in data:
+        result['after'] = int(data.pop('after'))
+    if 'stream' in data:
+        result['stream'] = bool(strtobool(data.pop('stream')))
+    return result
+
+
+def show_related(objects, level):
+    """
+    This function return objects with all related objects needed by show method for a output
+    level (key, short or full). Each model declare them in SHOW_RELATED as a dict
+    level: (select_related lookups, prefetch_related lookups), so the number of queries doesn't
+    depend on the number of objects.
+
+    :param objects: a QuerySet
+    :param level: the output level (key, short, full)
+    :return:
+    """
+    select, prefetch = getattr(objects.model, 'SHOW_RELATED', dict()).get(level, ([], []))
+    if select:
+        objects = objects.select_related(*select)
+    if prefetch:
+        objects = objects.prefetch_related(*prefetch)
+    return objects
+
+
+def paginate(objects, limit=None, after=None, stream=False):
+    """
+    This function return the short dict abstraction of objects (see show method from modules).
+    We use keyset pagination on primary key, so a page is a index lookup whatever the page
+    number is.
+
+    :param objects: a QuerySet
+    :param limit: the maximum number of objects we want
+    :param after: we only get objects after this primary key
+    :param stream: if set to True, we return a iterator which read objects by chunk from
+                   database instead of a Page
+    :return:
+    """
+    objects = show_related(objects, 'short').order_by('id')
+    if after is not None:
+        objects = objects.filter(id__gt=after)
+    if limit is not None:
+        objects = objects[:limit]
+    if stream:
+        return (item.show(short=True) for item in objects.iterator(chunk_size=STREAM_CHUNK_SIZE))
+    result = Page()
+    last = None
+    for item in objects:
+        result.append(item.show(short=True))
+        last = item.id
+    if limit is not None and len(result) == limit:
+        result.next_after = last
+    return result
+
+
+def stream_json(items):
+    """
+    This function is a generator which write a JSON list from a iterator of dict. If items is a
+    dict of iterators (per example search result), we write a JSON dict of lists.
+
+    :param items: a iterator of dict or a dict of iterators
+    :return:
+    """
+    if isinstance(items, dict):
+        yield '{'
+        separator = ''
+        for name in items:
+            yield '{}{}:'.format(separator, json.dumps(name))
+            yield from stream_json(items[name])
+            separator = ','
+        yield '}'
+        return
+    yield '['
+    separator = ''
+    for item in items:
+        yield separator + json.dumps(item, cls=DjangoJSONEncoder)
+        separator = ','
+    yield ']'
+
+
+def list_response(result):
+    """
+    This function return the HTTP response of a list endpoint. A Page is returned as JSON with
+    the cursor of the next page in X-Next-After header, a iterator is streamed.
+
+    :param result: a list, a Page or a iterator of dict
+    :return:
+    """
+    if isinstance(result, list):
+        response = JsonResponse(result, safe=False)
+        if getattr(result, 'next_after', None) is not None:
+            response['X-Next-After'] = result.next_after
+        return response
+    return StreamingHttpResponse(stream_json(result), content_type='application/json')
@@ -2,10 +2,13 @@
 This module provide HTTP view for SLAM. slam_core just provide basic view like home, login, logout.
 each django's App (slam_*) provide it's own view
 """
+import json
+from distutils.util import strtobool
+
 from django.shortcuts import render, HttpResponseRedirect
 from django.contrib.auth.decorators import login_required
 from django.contrib import auth
-from django.http import JsonResponse
+from django.http import JsonResponse, StreamingHttpResponse
 from django.views.decorators.csrf import ensure_csrf_cookie
 from django.core.exceptions import FieldError
 
@@ -14,7 +17,20 @@ from slam_network.models import Network, Address
 from slam_hardware.models import Hardware, Interface
 from slam_host.models import Host
 
-from slam_core.producer import utils
+from slam_core.models import Job, SearchToken, SEARCH_LIMIT
+from slam_core.producer import utils, dnsupdate
+from slam_core.search import search as operator_search
+from slam_core.utils import error_message, list_options, stream_json
+
+SEARCH_CATEGORIES = [
+    ('domains', Domain),
+    ('entries', DomainEntry),
+    ('networks', Network),
+    ('addresses', Address),
+    ('hardware', Hardware),
+    ('interface', Interface),
+    ('hosts', Host)
+]
 
 
 @login_required
@@ -85,59 +101,80 @@ def search(request):
     """
     This function will return a list of objects that match the filter. We just provide basic
     filter as string filter but searching will be done on all field. If no filter has been provide
-    by user, we get all object database.
+    by user, we get all object database. A special filter "within" (ie within=10.1.0.0/16) can
+    be used to get networks and addresses included in a CIDR.
 
     The output is a dict abstraction of object in short format (see show method from modules for
     more information)
 
+    A special filter "q" (ie q=web lab.example.com) make a full text search through the search
+    index (see slam_core.models.SearchToken). The output is a list of hits ranked by relevance,
+    each hit is the type, the id and the name of a object. Typed operators (ie q=ip in
+    10.3.0.0/16, q=mac prefix 00:11:22 or q=fqdn suffix .lab.example.com) are also supported
+    (see slam_core.search).
+
+    limit and stream options can be used as for other list endpoints (see
+    slam_core.utils.list_options), limit is applied on each list. As each list has its own
+    cursor, X-Next-After header is a JSON dict (ie {"hosts": 42}) and the next page is
+    retrieved with after_<list> options (ie after_hosts=42).
+
     :param request: full HTTP request from user
     :return:
     """
     if request.method == 'GET' and request.headers['Accept'] != 'application/json':
         return render(request, 'core/search.html', dict())
     data = request.GET.dict()
+    if 'q' in data:
+        # Operator queries are done through IP keys, MAC keys or reversed names, full text
+        # search is done through the search index
+        try:
+            limit = int(data.get('limit', SEARCH_LIMIT))
+            hits = operator_search(data['q'], limit=limit)
+        except ValueError as err:
+            return JsonResponse(error_message('search', data['q'], err))
+        if hits is None:
+            hits = SearchToken.search(data['q'], limit=limit)
+        return JsonResponse({'hits': hits})
+    within = data.pop('within', None)
+    try:
+        list_option = list_options(data)
+        after = dict()
+        for category, _ in SEARCH_CATEGORIES:
+            if 'after_{}'.format(category) in data:
+                after[category] = int(data.pop('after_{}'.format(category)))
+    except ValueError as err:
+        return JsonResponse(error_message('search', request.GET.urlencode(), err))
     options = dict()
     for item in data:
         options['{}__contains'.format(item)] = data[item]
-    try:
-        domains = Domain.search(options)
-    except FieldError:
-        domains = []
-    try:
-        entries = DomainEntry.search(options)
-    except FieldError:
-        entries = []
-    try:
-        networks = Network.search(options)
-    except FieldError:
-        networks = []
-    try:
-        addresses = Address.search(options)
-    except FieldError:
-        addresses = []
-    try:
-        hardware = Hardware.search(options)
-    except FieldError:
-        hardware = []
-    try:
-        interface = Interface.search(options)
-    except FieldError:
-        interface = []
-    try:
-        hosts = Host.search(options)
-    except FieldError:
-        hosts = []
-
-    result = {
-        'domains': domains,
-        'entries': entries,
-        'networks': networks,
-        'addresses': addresses,
-        'hardware': hardware,
-        'interface': interface,
-        'hosts': hosts
-    }
-    return JsonResponse(result, safe=False)
+    result = dict()
+    for category, model in SEARCH_CATEGORIES:
+        result[category] = []
+        if within is not None and model not in [Network, Address]:
+            # If we look for IP addresses in a CIDR, only networks and addresses are relevant.
+            # It's done by the database through IP keys.
+            continue
+        search_options = {
+            'limit': list_option['limit'],
+            'after': after.get(category),
+            'stream': list_option['stream']
+        }
+        if within is not None:
+            search_options['within'] = within
+        try:
+            result[category] = model.search(options, **search_options)
+        except (FieldError, ValueError):
+            pass
+    if list_option['stream']:
+        return StreamingHttpResponse(stream_json(result), content_type='application/json')
+    response = JsonResponse(result, safe=False)
+    next_after = dict()
+    for category in result:
+        if getattr(result[category], 'next_after', None) is not None:
+            next_after[category] = result[category].next_after
+    if next_after:
+        response['X-Next-After'] = json.dumps(next_after)
+    return response
 
 
 @login_required
@@ -158,31 +195,91 @@ def diff(request):
 
 @login_required
 def commit(request):
-    # As django need view to have request option but we don't need it, we need to exclude pylint
-    # unused-argument for this method
-    # pylint: disable=W0613
     """
-    This function trig DNS/DHCP and freeradius rendering. It will return a raw git diff.
+    This function trig DNS/DHCP and freeradius rendering. By default, only configuration which
+    changed since last commit is produced, full=true can be used to produce everything.
+
+    Rendering is done by a background job (see slam_core.models.Job), we return the job id which
+    can be followed through https://slam.example.com/producer/jobs/<job_id>. The job result is
+    a raw git diff. wait=true can be used to wait for the result.
 
     :param request: full HTTP request from user
     :return:
     """
-    result = utils.commit()
+    full = strtobool(request.GET.get('full', 'false'))
+    if strtobool(request.GET.get('wait', 'false')):
+        return JsonResponse(utils.commit(full=full))
+    result = Job.start('commit', utils.commit, user=str(request.user), args={'full': full})
     return JsonResponse(result)
 
 
 @login_required
 def publish(request):
+    """
+    This function trig a git push command to publish DNS/DHCP and freeradius rendering available.
+    By default, only servers which use a file that changed are reloaded, full=true can be used to
+    reload all servers.
+
+    As commit, publish is done by a background job and we return the job id. wait=true can be
+    used to wait for the result.
+
+    :param request: full HTTP request from user
+    :return:
+    """
+    full = strtobool(request.GET.get('full', 'false'))
+    if strtobool(request.GET.get('wait', 'false')):
+        return JsonResponse(utils.publish(full=full))
+    result = Job.start('publish', utils.publish, user=str(request.user), args={'full': full})
+    return JsonResponse(result)
+
+
+@login_required
+def update(request):
+    """
+    This function send changes to DNS servers as dynamic updates (see
+    slam_core.producer.dnsupdate). Changes are still produced by commit.
+
+    As commit, update is done by a background job and we return the job id. wait=true can be
+    used to wait for the result.
+
+    :param request: full HTTP request from user
+    :return:
+    """
+    if strtobool(request.GET.get('wait', 'false')):
+        return JsonResponse(dnsupdate.update())
+    result = Job.start('dnsupdate', dnsupdate.update, user=str(request.user))
+    return JsonResponse(result)
+
+
+@login_required
+def jobs(request):
     # As django need view to have request option but we don't need it, we need to exclude pylint
     # unused-argument for this method
     # pylint: disable=W0613
     """
-    This function trig a git push command to publish DNS/DHCP and freeradius rendering available.
+    This function return the history of commit and publish jobs.
+
+    :param request: full HTTP request from user
+    :return:
+    """
+    return JsonResponse(Job.search(), safe=False)
+
+
+@login_required
+def job(request, job_id):
+    """
+    This function manage a specific job
+      - GET: to retrieve the job status, its progress and its result
+      - DELETE: to cancel the job
 
     :param request: full HTTP request from user
+    :param job_id: the job id from URI
     :return:
     """
-    result = utils.publish()
+    if request.method == 'DELETE':
+        result = Job.remove(job_id)
+    else:
+        result = Job.get(job_id)
     return JsonResponse(result)
 
 
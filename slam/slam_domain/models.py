@@ -9,10 +9,16 @@ This module provide model for domains. There are 2 models
 # test E1101 (no-member)
 # pylint: disable=E1101,R0903
 from django.db import models
+from django.db.models import Count, Q
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 from django.core.exceptions import ValidationError, ObjectDoesNotExist
 from django.db.utils import IntegrityError
 
-from slam_core.utils import error_message, name_validator
+from slam_core.cache import ObjectCache
+from slam_core.models import Change
+from slam_core.utils import error_message, name_validator, paginate, show_related, \
+    reversed_name
 
 DOMAIN_FIELD = [
     'description',
@@ -29,13 +35,35 @@ class Domain(models.Model):
       - dns_master: IP of DNS master (used to push data in production)
       - contact: a contact email for the domain
       - creation_date: when domain has been created
+
+    SHOW_RELATED is the list of related objects needed by show method for each output level
+    (see slam_core.utils.show_related)
     """
+    SHOW_RELATED = {
+        'full': ([], ['domainentry_set__domain', 'domainentry_set__entries__domain',
+                      'domainentry_set__address_set'])
+    }
+
+    SEARCH_KIND = 'domain'
+
     name = models.CharField(max_length=50, unique=True, validators=[name_validator])
     description = models.CharField(max_length=120, blank=True, null=True)
     dns_master = models.GenericIPAddressField()
     contact = models.EmailField(blank=True, null=True)
     creation_date = models.DateTimeField(auto_now_add=True, null=True)
 
+    def search_fields(self):
+        """
+        This method return fields of the domain which are indexed for search (see
+        slam_core.models.SearchToken) as a list of (field, value, weight)
+
+        :return:
+        """
+        return [
+            ('name', self.name, 3),
+            ('description', self.description, 1)
+        ]
+
     def show(self, key=False, short=False):
         """
         This method return a dict construction of the object. We have 3 types of output,
@@ -56,13 +84,14 @@ class Domain(models.Model):
             result = {
                 'name': self.name,
                 'description': self.description,
-                'entries_count': DomainEntry.objects.filter(domain=self).exclude(type='PTR').count()
+                'entries_count': self.entries_count()
             }
         else:
             result_entries = []
-            entries = DomainEntry.objects.filter(domain=self).exclude(type='PTR')
-            for entry in entries:
-                result_entries.append(entry.show(key=True))
+            for entry in self.domainentry_set.all():
+                # PTR entries are shown with their addresses
+                if entry.type != 'PTR':
+                    result_entries.append(entry.show(key=True))
             result = {
                 'name': self.name,
                 'description': self.description,
@@ -73,6 +102,18 @@ class Domain(models.Model):
             }
         return result
 
+    def entries_count(self):
+        """
+        This method return the number of entries (w/o PTR) of the domain. Domain.search annotate
+        domains with this number (non_ptr_count) so we don't need a query per domain.
+
+        :return:
+        """
+        non_ptr_count = getattr(self, 'non_ptr_count', None)
+        if non_ptr_count is None:
+            non_ptr_count = self.domainentry_set.exclude(type='PTR').count()
+        return non_ptr_count
+
     @staticmethod
     def create(name, args=None):
         """
@@ -92,6 +133,7 @@ class Domain(models.Model):
         except (IntegrityError, ValidationError) as err:
             return error_message('domain', name, err)
         domain.save()
+        Change.log('domain', name)
         result = domain.show()
         result['status'] = 'done'
         return result
@@ -118,6 +160,7 @@ class Domain(models.Model):
         except (ValidationError, IntegrityError) as err:
             error_message('domain', name, err)
         domain.save()
+        Change.log('domain', name)
         result = domain.show()
         result['status'] = 'done'
         return result
@@ -136,6 +179,7 @@ class Domain(models.Model):
         except ObjectDoesNotExist as err:
             return error_message('domain', name, err)
         domain.delete()
+        Change.log('domain', name)
         return {
             'domain': name,
             'status': 'done'
@@ -151,28 +195,36 @@ class Domain(models.Model):
         :return:
         """
         try:
-            domain = Domain.objects.get(name=name)
+            domain = show_related(Domain.objects.all(), 'short' if short else 'full').\
+                get(name=name)
         except ObjectDoesNotExist as err:
             return error_message('domain', name, err)
         result = domain.show(short=short)
         return result
 
     @staticmethod
-    def search(filters=None):
+    def search(filters=None, limit=None, after=None, stream=False):
         """
         This is a custom way to get all domains that match the filters
 
         :param filters: a dict of field / regex
+        :param limit: the maximum number of objects we want (see slam_core.utils.paginate)
+        :param after: we only get objects after this cursor
+        :param stream: if set to True, we return a iterator instead of a list
         :return:
         """
         if filters is None:
             domains = Domain.objects.all()
         else:  # We suppose filters as been construct outside models class.
             domains = Domain.objects.filter(**filters)
-        result = []
-        for domain in domains:
-            result.append(domain.show(short=True))
-        return result
+        # We count entries of all domains in the same query
+        domains = domains.annotate(non_ptr_count=Count('domainentry',
+                                                       filter=~Q(domainentry__type='PTR')))
+        return paginate(domains, limit, after, stream)
+
+
+# Per process cache of domains by name (see slam_core.cache)
+DOMAIN_CACHE = ObjectCache(Domain)
 
 
 class DomainEntry(models.Model):
@@ -184,13 +236,31 @@ class DomainEntry(models.Model):
       - entries: In some cases (CNAME, NS, ...) entry refered to another entry
       - description: a short description of the entry
       - creation_date: when entry as been created
+      - reversed_fqdn: the reversed fqdn of the entry (see slam_core.utils.reversed_name), it is
+        computed on save
+
+    SHOW_RELATED is the list of related objects needed by show method for each output level
+    (see slam_core.utils.show_related)
     """
+    SHOW_RELATED = {
+        'key': (['domain'], ['entries__domain', 'address_set']),
+        'short': (['domain'], ['entries__domain', 'entries__entries__domain',
+                               'entries__address_set', 'address_set']),
+        'full': (['domain'], ['entries__domain', 'entries__entries__domain',
+                              'entries__entries__entries__domain', 'entries__entries__address_set',
+                              'entries__address_set', 'address_set'])
+    }
+
+    SEARCH_KIND = 'entry'
+
     name = models.CharField(max_length=50, validators=[name_validator])
     domain = models.ForeignKey(Domain, on_delete=models.PROTECT)
     type = models.CharField(max_length=5, default='A')
     entries = models.ManyToManyField('self')
     description = models.CharField(max_length=150, blank=True, default='', null=True)
     creation_date = models.DateField(auto_now_add=True, null=True)
+    reversed_fqdn = models.CharField(max_length=101, default='', blank=True, editable=False,
+                                     db_index=True)
 
     class Meta:
         """
@@ -199,6 +269,37 @@ class DomainEntry(models.Model):
         """
         unique_together = ('name', 'domain', 'type')
 
+    def save(self, *args, **kwargs):
+        # pylint: disable=W0221
+        """
+        We keep reversed_fqdn in sync with name and domain
+
+        :return:
+        """
+        self.reversed_fqdn = reversed_name('{}.{}'.format(self.name, self.domain.name))
+        super().save(*args, **kwargs)
+
+    def search_fields(self):
+        """
+        This method return fields of the entry which are indexed for search (see
+        slam_core.models.SearchToken) as a list of (field, value, weight)
+
+        :return:
+        """
+        return [
+            ('fqdn', '{}.{}'.format(self.name, self.domain.name), 3),
+            ('description', self.description, 1)
+        ]
+
+    def search_label(self):
+        """
+        This method return the name of the entry in search results. As a fqdn can have more
+        than one entry (A, PTR, ...), we add the entry type.
+
+        :return:
+        """
+        return '{}.{} ({})'.format(self.name, self.domain.name, self.type)
+
     def show(self, key=False, short=False):
         """
 
@@ -269,12 +370,12 @@ class DomainEntry(models.Model):
         if ' ' in name:
             return error_message('domain', name, 'Space not allowed in name')
         try:  # First, we get the domain
-            entry_domain = Domain.objects.get(name=domain)
+            entry_domain = DOMAIN_CACHE.get(domain)
         except ObjectDoesNotExist as err:
             return error_message('entry', '{}.{} {}'.format(name, domain, ns_type), err)
         if sub_entry is not None:
             try:
-                sub_entry_domain = Domain.objects.get(name=sub_entry['domain'])
+                sub_entry_domain = DOMAIN_CACHE.get(sub_entry['domain'])
                 sub_entry_obj = DomainEntry.objects.get(name=sub_entry['name'],
                                                         domain=sub_entry_domain,
                                                         type=sub_entry['type'])
@@ -306,6 +407,7 @@ class DomainEntry(models.Model):
         entry.save()
         if sub_entry_obj is not None:
             entry.entries.add(sub_entry_obj)
+        Change.log('domain', domain, name)
         return {
             'entry': '{}.{} {}'.format(name, domain, ns_type),
             'status': 'done'
@@ -337,6 +439,7 @@ class DomainEntry(models.Model):
             sub_entry_obj.full_clean()
             sub_entry_obj.save()
             entry.entries.add(sub_entry_obj)
+        Change.log('domain', domain, name)
         return {
             'entry': '{}.{} {}'.format(name, domain, ns_type),
             'status': 'done'
@@ -360,6 +463,7 @@ class DomainEntry(models.Model):
             sub_entry_obj = DomainEntry.get(name=sub_entry['name'], domain=sub_entry['domain'],
                                             type=sub_entry['type'])
             entry.entries.remove(sub_entry_obj)
+        Change.log('domain', domain, name)
         return {
             'entry': '{}.{} {}'.format(name, domain, ns_type),
             'status': 'done'
@@ -377,11 +481,18 @@ class DomainEntry(models.Model):
         :return:
         """
         try:
-            entry_domain = Domain.objects.get(name=domain)
+            entry_domain = DOMAIN_CACHE.get(domain)
             entry = DomainEntry.objects.get(name=name, domain=entry_domain, type=ns_type)
         except ObjectDoesNotExist as err:
             return error_message('entry', '{}.{} {}'.format(name, domain, ns_type), err)
+        # Records which refer to this entry (CNAME, ...) and reverse zones of its addresses will
+        # also change
+        for address_ip, network_name in entry.address_set.values_list('ip', 'network__name'):
+            Change.log('network', network_name, address_ip)
+        for entry_name, domain_name in entry.entries.values_list('name', 'domain__name'):
+            Change.log('domain', domain_name, entry_name)
         entry.delete()
+        Change.log('domain', domain, name)
         return {
             'entry': '{}.{} {}'.format(name, domain, ns_type),
             'status': 'done'
@@ -397,27 +508,41 @@ class DomainEntry(models.Model):
         :return:
         """
         try:
-            domain_entry = Domain.objects.get(name=domain)
+            domain_entry = DOMAIN_CACHE.get(domain)
         except ObjectDoesNotExist as err:
             return error_message('entry', '{}.{} {}'.format(name, domain, ns_type), err)
         try:
-            entry = DomainEntry.objects.get(name=name, domain=domain_entry, type=ns_type)
+            entry = show_related(DomainEntry.objects.all(), 'full').\
+                get(name=name, domain=domain_entry, type=ns_type)
         except ObjectDoesNotExist as err:
             return error_message('entry', '{}.{} {}'.format(name, domain, ns_type), err)
         return entry.show()
 
     @staticmethod
-    def search(filters=None):
+    def search(filters=None, limit=None, after=None, stream=False):
         """
         This is a custom method to get all entries
         :param filters: the filter we will use
+        :param limit: the maximum number of objects we want (see slam_core.utils.paginate)
+        :param after: we only get objects after this cursor
+        :param stream: if set to True, we return a iterator instead of a list
         :return:
         """
-        result = []
         if filters is None:
             entries = DomainEntry.objects.all()
         else:
             entries = DomainEntry.objects.filter(**filters)
-        for entry in entries:
-            result.append(entry.show(short=True))
-        return result
+        return paginate(entries, limit, after, stream)
+
+
+@receiver(post_save, sender=Domain)
+@receiver(post_delete, sender=Domain)
+def domain_cache_invalidate(sender, **kwargs):
+    # pylint: disable=W0613
+    """
+    This function drop cached domains when a domain is saved or deleted.
+
+    :param sender: the model class (Domain)
+    :return:
+    """
+    DOMAIN_CACHE.invalidate()
@@ -23,6 +23,7 @@ from django.shortcuts import render
 from django.http import JsonResponse, QueryDict
 from django.contrib.auth.decorators import login_required
 
+from slam_core.utils import error_message, list_options, list_response
 from slam_domain.models import Domain, DomainEntry
 
 LOGGER = logging.getLogger('api')
@@ -34,12 +35,20 @@ def domains_view(request):
     This function manage interaction between user and SLAM for all domains management. URI is
     represented by https://slam.example.com/domains
 
+    limit, after and stream options can be used to get a page of the list or to stream it (see
+    slam_core.utils.list_options).
+
     :param request: full HTTP request from user
     """
-    result = Domain.search()
     if request.headers['Accept'] == 'application/json' or \
             request.GET.get('format') == 'json':
-        return JsonResponse(result, safe=False)
+        data = request.GET.dict()
+        data.pop('format', None)
+        try:
+            options = list_options(data)
+        except ValueError as err:
+            return JsonResponse(error_message('domains', request.GET.urlencode(), err))
+        return list_response(Domain.search(**options))
     return render(request, 'domains/index.html', dict())
 
 
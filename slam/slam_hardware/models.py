@@ -29,7 +29,7 @@ from django.utils import timezone
 from django.core.exceptions import ValidationError, ObjectDoesNotExist
 from django.db.utils import IntegrityError
 
-from slam_core.utils import error_message, name_validator
+from slam_core.utils import error_message, name_validator, paginate, show_related, mac_key
 
 HARDWARE_FIELD = [
     'name',
@@ -76,7 +76,17 @@ class Hardware(models.Model):
       - serial_number: unique serial number from manifacturer
       - inventory: local inventory identifier
       - warranty: warranty duration
+
+    SHOW_RELATED is the list of related objects needed by show method for each output level
+    (see slam_core.utils.show_related)
     """
+    SHOW_RELATED = {
+        'short': ([], ['interface_set']),
+        'full': ([], ['interface_set__hardware__interface_set'])
+    }
+
+    SEARCH_KIND = 'hardware'
+
     name = models.CharField(max_length=50, unique=True, validators=[name_validator])
     buying_date = models.DateField(default=timezone.now)
     description = models.CharField(max_length=150, default='', blank=True)
@@ -96,6 +106,23 @@ class Hardware(models.Model):
         """
         return self.interface_set.all()
 
+    def search_fields(self):
+        """
+        This method return fields of the hardware which are indexed for search (see
+        slam_core.models.SearchToken) as a list of (field, value, weight)
+
+        :return:
+        """
+        return [
+            ('name', self.name, 3),
+            ('serial_number', self.serial_number, 3),
+            ('inventory', self.inventory, 3),
+            ('owner', self.owner, 2),
+            ('vendor', self.vendor, 1),
+            ('model', self.model, 1),
+            ('description', self.description, 1)
+        ]
+
     def show(self, key=False, short=False):
         """
         This method return a dict construction of the object. We have 3 types of output,
@@ -232,44 +259,78 @@ class Hardware(models.Model):
         :return:
         """
         try:
-            hardware = Hardware.objects.get(name=name)
+            hardware = show_related(Hardware.objects.all(), 'full').get(name=name)
         except ObjectDoesNotExist as err:
             return error_message('hardware', name, err)
         return hardware.show()
 
     @staticmethod
-    def search(filters=None):
+    def search(filters=None, limit=None, after=None, stream=False):
         """
         This is a custom way to get all hardware match the filter
 
         :param filters:
+        :param limit: the maximum number of objects we want (see slam_core.utils.paginate)
+        :param after: we only get objects after this cursor
+        :param stream: if set to True, we return a iterator instead of a list
         :return:
         """
         if filters is None:
             inventory = Hardware.objects.all()
         else:
             inventory = Hardware.objects.filter(**filters)
-        result = []
-        for hardware in inventory:
-            result.append(hardware.show(short=True))
-        return result
+        return paginate(inventory, limit, after, stream)
 
 
 class Interface(models.Model):
     """
     A interface represent a specific hardware device. A physical machine can have more than one
     interface device but a device is only attached to one and only one hardware.
+      - mac_key: the integer version of the MAC address (see slam_core.utils.mac_key), it is
+        computed on save
+
+    SHOW_RELATED is the list of related objects needed by show method for each output level
+    (see slam_core.utils.show_related)
     """
+    SHOW_RELATED = {
+        'short': (['hardware'], ['hardware__interface_set']),
+        'full': (['hardware'], ['hardware__interface_set'])
+    }
+
     INTERFACE_TYPE = (
         ('copper', 'Copper interface'),
         ('fiber', 'Fiber interface'),
         ('wireless', 'Wireless interface')
     )
+    SEARCH_KIND = 'interface'
+
     mac_address = models.CharField(max_length=17, unique=True,
                                    validators=[mac_address_validator])
     type = models.CharField(max_length=8, choices=INTERFACE_TYPE, null=True, default='copper')
     speed = models.IntegerField(null=True, blank=True)
     hardware = models.ForeignKey(Hardware, on_delete=models.CASCADE)
+    mac_key = models.BigIntegerField(null=True, blank=True, editable=False, db_index=True)
+
+    def save(self, *args, **kwargs):
+        # pylint: disable=W0221
+        """
+        We keep mac_key in sync with mac_address
+
+        :return:
+        """
+        self.mac_key = mac_key(self.mac_address)
+        super().save(*args, **kwargs)
+
+    def search_fields(self):
+        """
+        This method return fields of the interface which are indexed for search (see
+        slam_core.models.SearchToken) as a list of (field, value, weight)
+
+        :return:
+        """
+        return [
+            ('mac_address', self.mac_address, 3)
+        ]
 
     def show(self, key=False, short=False):
         """
@@ -354,24 +415,25 @@ class Interface(models.Model):
         :return:
         """
         try:
-            interface = Interface.objects.get(mac_address=mac_address)
+            interface = show_related(Interface.objects.all(), 'short' if short else 'full').\
+                get(mac_address=mac_address)
         except ObjectDoesNotExist as err:
             return error_message('interface', mac_address, err)
         return interface.show(short)
 
     @staticmethod
-    def search(filters=None):
+    def search(filters=None, limit=None, after=None, stream=False):
         """
         This is a custom way to get all hardware match the filter
 
         :param filters:
+        :param limit: the maximum number of objects we want (see slam_core.utils.paginate)
+        :param after: we only get objects after this cursor
+        :param stream: if set to True, we return a iterator instead of a list
         :return:
         """
         if filters is None:
             interface = Interface.objects.all()
         else:
             interface = Interface.objects.filter(**filters)
-        result = []
-        for interface in interface:
-            result.append(interface.show(short=True))
-        return result
+        return paginate(interface, limit, after, stream)
@@ -22,21 +22,26 @@ following nomenclature
 from django.http import JsonResponse, QueryDict
 from django.contrib.auth.decorators import login_required
 
+from slam_core.utils import error_message, list_options, list_response
 from slam_hardware.models import Hardware, Interface
 
 
 @login_required
 def inventory_view(request):
-    # As we use django view that need request as argument but we not use it, we disable pylint.
-    # pylint: disable=W0613
     """
     This function manage interaction between user and SLAM for hardware management. URI is
     represented by https://slam.example.com/hardware
 
+    limit, after and stream options can be used to get a page of the list or to stream it (see
+    slam_core.utils.list_options).
+
     :param request: full HTTP request from user
     """
-    result = Hardware.search()
-    return JsonResponse(result, safe=False)
+    try:
+        options = list_options(request.GET.dict())
+    except ValueError as err:
+        return JsonResponse(error_message('hardware', request.GET.urlencode(), err))
+    return list_response(Hardware.search(**options))
 
 
 @login_required
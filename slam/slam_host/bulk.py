@@ -0,0 +1,536 @@
+"""
+This module provide a bulk import of hosts. A import is a list of rows, each row is a dict with
+the same options than a host creation (see slam_host.views.host_view):
+  - name: the name of the host (required)
+  - interface: the MAC address of the host
+  - network: the network where a IP address is allocated
+  - ip_address: a specific IP address
+  - owner: the owner of the hardware created for the interface
+  - ns, domain: the A and PTR records of the host
+  - no_ip: if set to true, we don't allocate a IP address
+  - dhcp: if set to false, the host is not in DHCP configuration
+
+All rows are validated before anything is written. Objects are created with bulk_create by batch
+of batch_size rows, in one transaction per batch which lock networks of the batch (like
+Host.create) while IP addresses are allocated and reserved in FreeRange index. As bulk_create
+don't call save nor send signals, computed columns (keys, reversed names), search index and change
+journal are done here.
+
+import_hosts return a report with created hosts and a error for each rejected row.
+
+remove_hosts delete a list of hosts (selected by names, network or name pattern) with their
+addresses, orphan DNS entries and, optionally, their hardware in one transaction. The number of
+queries doesn't depend on the number of hosts.
+"""
+# As we use django models.Model, pylint fail to find objects method. We must disable pylint
+# test E1101 (no-member)
+# pylint: disable=E1101
+import csv
+import io
+import ipaddress
+import json
+import re
+from distutils.util import strtobool
+
+from django.core.exceptions import ValidationError
+from django.db import transaction, DatabaseError
+from django.db.models import Q
+
+from slam_core.models import Change, SearchToken
+from slam_core.utils import error_message, reversed_name, mac_key
+from slam_domain.models import Domain, DomainEntry
+from slam_hardware.models import Hardware, Interface
+from slam_host.models import Host
+from slam_network.models import Network, Address, FreeRange
+from slam_network.utils import ip_key, key_ip, ipv4_mapped_validator
+
+BULK_BATCH_SIZE = 500
+
+BULK_FIELDS = [
+    'name',
+    'interface',
+    'network',
+    'ip_address',
+    'owner',
+    'ns',
+    'domain',
+    'no_ip',
+    'dhcp'
+]
+
+
+class RowError(Exception):
+    """
+    Raised when a row of a import is rejected
+    """
+
+
+def parse_rows(content, content_format='json'):
+    """
+    This function return the list of rows of a import. content is a JSON list of dict or a CSV
+    file with a header line (see BULK_FIELDS for column names). Empty values are ignored.
+
+    :param content: the import as a string
+    :param content_format: the format of content (json, csv)
+    :return:
+    """
+    if content_format == 'csv':
+        rows = list(csv.DictReader(io.StringIO(content)))
+    elif content_format == 'json':
+        rows = json.loads(content)
+        if not isinstance(rows, list):
+            raise ValueError('A JSON import must be a list of hosts')
+    else:
+        raise ValueError('Unknown import format {}'.format(content_format))
+    result = []
+    for row in rows:
+        if not isinstance(row, dict):
+            raise ValueError('A host must be a dict, not {}'.format(row))
+        result.append({
+            field: '{}'.format(value).strip() for field, value in row.items()
+            if field in BULK_FIELDS and value is not None and '{}'.format(value).strip() != ''
+        })
+    return result
+
+
+def clean_row(row):
+    """
+    This function return a normalized version of a row w/o looking at database. RowError is
+    raised if a value is invalid.
+
+    :param row: a row of the import
+    :return:
+    """
+    if 'name' not in row:
+        raise RowError('Host name is required')
+    try:
+        no_ip = bool(strtobool(row.get('no_ip', 'false')))
+        dhcp = bool(strtobool(row.get('dhcp', 'true')))
+    except ValueError as err:
+        raise RowError(err)
+    if 'network' not in row and 'ip_address' not in row:
+        raise RowError('Integrity error Address or Network should be provide')
+    if ('ns' in row) != ('domain' in row):
+        raise RowError('ns and domain must be provide together')
+    plan = {
+        'name': row['name'],
+        'interface': row.get('interface'),
+        'network': row.get('network'),
+        'ip': row.get('ip_address'),
+        'owner': row.get('owner', ''),
+        'dns_entry': None,
+        'no_ip': no_ip,
+        'dhcp': dhcp,
+        'hardware': None
+    }
+    try:
+        Host(name=plan['name'], dhcp=dhcp).clean_fields(exclude=['interface', 'network'])
+        if plan['interface'] is not None:
+            Interface(mac_address=plan['interface']).clean_fields(exclude=['hardware'])
+            plan['hardware'] = '{}-{}'.format(plan['name'].split('.', 1)[0],
+                                              plan['interface'].replace(':', '-'))
+            Hardware(name=plan['hardware'], owner=plan['owner']).clean_fields()
+        if plan['ip'] is not None:
+            plan['ip'] = str(ipaddress.ip_address(plan['ip']))
+            ipv4_mapped_validator(plan['ip'])
+        if 'ns' in row:
+            DomainEntry(name=row['ns']).clean_fields(exclude=['domain'])
+            plan['dns_entry'] = (row['domain'], row['ns'])
+    except (ValidationError, ValueError) as err:
+        raise RowError(err)
+    return plan
+
+
+def free_ips(network, reserved):
+    """
+    This function is a generator of unused IP addresses of a network (lowest first). It walk
+    through FreeRange index and skip IP addresses in reserved.
+
+    :param network: the network
+    :param reserved: a set of IP address keys we must not use
+    :return:
+    """
+    version = ipaddress.ip_network('{}/{}'.format(network.ip, network.prefix)).version
+    if not FreeRange.objects.filter(network=network).exists():
+        # Network has been created before FreeRange index, we need to build it.
+        FreeRange.rebuild(network)
+    for free_range in FreeRange.objects.filter(network=network).order_by('first'):
+        for value in range(int(free_range.first, 16), int(free_range.last, 16) + 1):
+            key = '{:032x}'.format(value)
+            if key not in reserved:
+                yield str(key_ip(key, version))
+
+
+def validate(rows):
+    """
+    This function check all rows against database. It return the list of accepted rows (see
+    clean_row) and a dict of errors (row index: message). The number of queries doesn't depend
+    on the number of rows. IP addresses are allocated later, by batch (see create_batch).
+
+    :param rows: the rows of the import
+    :return:
+    """
+    plans = []
+    errors = dict()
+    for index, row in enumerate(rows):
+        try:
+            plan = clean_row(row)
+            plan['row'] = index
+            plans.append(plan)
+        except RowError as err:
+            errors[index] = '{}'.format(err)
+
+    names = [plan['name'] for plan in plans]
+    macs = [plan['interface'] for plan in plans if plan['interface'] is not None]
+    ips = [plan['ip'] for plan in plans if plan['ip'] is not None]
+    existing_hosts = set(Host.objects.filter(name__in=names).values_list('name', flat=True))
+    networks = {network.name: network for network in
+                Network.objects.filter(name__in=[plan['network'] for plan in plans
+                                                 if plan['network'] is not None])}
+    domains = {domain.name: domain for domain in
+               Domain.objects.filter(name__in=[plan['dns_entry'][0] for plan in plans
+                                               if plan['dns_entry'] is not None])}
+    used_macs = set(Host.objects.filter(interface__mac_address__in=macs).
+                    values_list('interface__mac_address', flat=True))
+    addresses = {address.ip: address for address in Address.objects.filter(ip__in=ips)}
+    used_ips = set(Host.objects.filter(addresses__ip__in=ips).
+                   values_list('addresses__ip', flat=True))
+    cnames = set(DomainEntry.objects.filter(
+        domain__in=domains.values(), type='CNAME',
+        name__in=[plan['dns_entry'][1] for plan in plans if plan['dns_entry'] is not None]).
+                 values_list('domain__name', 'name'))
+    ip_networks = Address.match_networks([ip for ip in ips if ip not in addresses])
+
+    accepted = []
+    seen = {
+        'name': set(),
+        'interface': set(),
+        'ip': set()
+    }
+    for plan in plans:
+        try:
+            for field in ['name', 'interface', 'ip']:
+                if plan[field] is not None and plan[field] in seen[field]:
+                    raise RowError('{} {} is used twice in import'.format(field, plan[field]))
+            if plan['name'] in existing_hosts:
+                raise RowError('Host with this Name already exists.')
+            if plan['interface'] in used_macs:
+                raise RowError('Integrity error Interface still exist !')
+            if plan['network'] is not None:
+                if plan['network'] not in networks:
+                    raise RowError('Network {} does not exist'.format(plan['network']))
+                plan['network'] = networks[plan['network']]
+            if plan['ip'] is not None:
+                if plan['ip'] in used_ips:
+                    raise RowError('Address is used by another host')
+                if plan['ip'] in addresses:
+                    ip_network_id = addresses[plan['ip']].network_id
+                else:
+                    if ip_networks[plan['ip']] is None:
+                        raise RowError('No network found for {}'.format(plan['ip']))
+                    ip_network_id = ip_networks[plan['ip']].id
+                if plan['network'] is not None and plan['network'].id != ip_network_id:
+                    raise RowError('Address {} is not in network {}'.format(
+                        plan['ip'], plan['network'].name))
+                if plan['ip'] not in addresses:
+                    plan['network'] = ip_networks[plan['ip']]
+            if plan['dns_entry'] is not None:
+                if plan['dns_entry'][0] not in domains:
+                    raise RowError('Domain {} does not exist'.format(plan['dns_entry'][0]))
+                if plan['dns_entry'] in cnames:
+                    raise RowError('A similar CNAME record exist !')
+                plan['dns_entry'] = (domains[plan['dns_entry'][0]], plan['dns_entry'][1])
+        except RowError as err:
+            errors[plan['row']] = '{}'.format(err)
+            continue
+        for field in ['name', 'interface', 'ip']:
+            seen[field].add(plan[field])
+        accepted.append(plan)
+
+    return accepted, errors
+
+
+def allocate(plans, reserved, errors):
+    """
+    This function allocate a IP address to rows which need one and return rows which can be
+    created. A row is rejected if its network is full. It must be run in a transaction which
+    hold a lock on networks (see create_batch).
+
+    :param plans: the validated rows (see validate)
+    :param reserved: keys of IP addresses which must not be allocated (provided by the import)
+    :param errors: a dict of errors (row index: message)
+    :return:
+    """
+    allocators = dict()
+    result = []
+    for plan in plans:
+        if plan['ip'] is None and plan['network'] is not None and not plan['no_ip']:
+            if plan['network'].id not in allocators:
+                allocators[plan['network'].id] = free_ips(plan['network'], reserved)
+            plan['ip'] = next(allocators[plan['network'].id], None)
+            if plan['ip'] is None:
+                errors[plan['row']] = 'Network have not usued IP address'
+                continue
+        result.append(plan)
+    return result
+
+
+def create_batch(plans, reserved, errors):
+    """
+    This function create all objects of a batch of validated rows. It must be run in a
+    transaction. Networks of the batch are locked (like Host.create), so a IP address we
+    allocate can't be allocated by someone else before we created it.
+
+    :param plans: the validated rows (see validate)
+    :param reserved: keys of IP addresses which must not be allocated (provided by the import)
+    :param errors: a dict of errors (row index: message)
+    :return:
+    """
+    changes = set()
+    tokens = []
+    networks = dict()
+    # Networks are locked in the same order by all batches to avoid deadlocks
+    list(Network.objects.select_for_update().order_by('id').filter(
+        id__in=set(plan['network'].id for plan in plans if plan['network'] is not None)))
+    plans = allocate(plans, reserved, errors)
+
+    # Hardware and interfaces
+    macs = [plan['interface'] for plan in plans if plan['interface'] is not None]
+    interfaces = {interface.mac_address: interface for interface in
+                  Interface.objects.filter(mac_address__in=macs)}
+    hardware_names = [plan['hardware'] for plan in plans
+                      if plan['interface'] is not None and plan['interface'] not in interfaces]
+    hardware = {item.name: item for item in Hardware.objects.filter(name__in=hardware_names)}
+    new_hardware = [Hardware(name=plan['hardware'], owner=plan['owner']) for plan in plans
+                    if plan['hardware'] in hardware_names and plan['hardware'] not in hardware]
+    Hardware.objects.bulk_create(new_hardware)
+    hardware = {item.name: item for item in Hardware.objects.filter(name__in=hardware_names)}
+    tokens += [hardware[item.name] for item in new_hardware]
+    new_interfaces = [Interface(mac_address=plan['interface'], hardware=hardware[plan['hardware']],
+                                mac_key=mac_key(plan['interface'])) for plan in plans
+                      if plan['interface'] is not None and plan['interface'] not in interfaces]
+    Interface.objects.bulk_create(new_interfaces)
+    interfaces = {interface.mac_address: interface for interface in
+                  Interface.objects.filter(mac_address__in=macs)}
+    tokens += [interfaces[interface.mac_address] for interface in new_interfaces]
+
+    # A and PTR records of new addresses
+    ips = [plan['ip'] for plan in plans if plan['ip'] is not None]
+    addresses = {address.ip: address for address in Address.objects.filter(ip__in=ips)}
+    new_ips = [plan for plan in plans if plan['ip'] is not None and plan['ip'] not in addresses]
+    dns_plans = [plan for plan in new_ips if plan['dns_entry'] is not None]
+
+    def dns_entries():
+        return {(entry.domain_id, entry.name, entry.type): entry for entry in
+                DomainEntry.objects.filter(
+                    domain__in=[plan['dns_entry'][0] for plan in dns_plans],
+                    name__in=[plan['dns_entry'][1] for plan in dns_plans],
+                    type__in=['A', 'PTR']).select_related('domain')}
+
+    entries = dns_entries()
+    new_entries = dict()
+    for plan in dns_plans:
+        domain, name = plan['dns_entry']
+        for ns_type in ['A', 'PTR']:
+            if (domain.id, name, ns_type) not in entries:
+                new_entries[(domain.id, name, ns_type)] = DomainEntry(
+                    name=name, domain=domain, type=ns_type,
+                    reversed_fqdn=reversed_name('{}.{}'.format(name, domain.name)))
+                changes.add(('domain', domain.name, name))
+    DomainEntry.objects.bulk_create(new_entries.values())
+    entries = dns_entries()
+    tokens += [entries[key] for key in new_entries]
+
+    # Addresses
+    Address.objects.bulk_create([Address(ip=plan['ip'], network=plan['network'],
+                                         key=ip_key(plan['ip'])) for plan in new_ips])
+    addresses = {address.ip: address for address in
+                 Address.objects.filter(ip__in=ips).select_related('network')}
+    address_entries = []
+    for plan in new_ips:
+        tokens.append(addresses[plan['ip']])
+        networks.setdefault(plan['network'].id, (plan['network'], []))[1].append(plan['ip'])
+        changes.add(('network', plan['network'].name, plan['ip']))
+        if plan['dns_entry'] is not None:
+            domain, name = plan['dns_entry']
+            for ns_type in ['A', 'PTR']:
+                address_entries.append(Address.ns_entries.through(
+                    address_id=addresses[plan['ip']].id,
+                    domainentry_id=entries[(domain.id, name, ns_type)].id))
+            changes.add(('domain', domain.name, name))
+    Address.ns_entries.through.objects.bulk_create(address_entries)
+
+    # Hosts
+    Host.objects.bulk_create([Host(name=plan['name'], interface=interfaces.get(plan['interface']),
+                                   network=plan['network'], dhcp=plan['dhcp'],
+                                   reversed_name=reversed_name(plan['name']))
+                              for plan in plans])
+    hosts = {host.name: host for host in
+             Host.objects.filter(name__in=[plan['name'] for plan in plans])}
+    host_addresses = []
+    for plan in plans:
+        host = hosts[plan['name']]
+        tokens.append(host)
+        if plan['ip'] is not None:
+            address = addresses[plan['ip']]
+            host_addresses.append(Host.addresses.through(host_id=host.id, address_id=address.id))
+            changes.add(('network', address.network.name, host.name))
+        if plan['network'] is not None:
+            changes.add(('network', plan['network'].name, host.name))
+        if plan['interface'] is not None:
+            changes.add(('freeradius', '', host.name))
+    Host.addresses.through.objects.bulk_create(host_addresses)
+
+    for network, network_ips in networks.values():
+        FreeRange.reserve_many(network, network_ips)
+    Change.log_bulk(sorted(changes))
+    search_tokens = []
+    for instance in tokens:
+        search_tokens += SearchToken.tokens(instance)
+    SearchToken.objects.bulk_create(search_tokens, batch_size=1000)
+    return [plan['name'] for plan in plans]
+
+
+def import_hosts(rows, batch_size=BULK_BATCH_SIZE):
+    """
+    This function create hosts from a list of rows (see parse_rows) and return a report:
+      - status: done if all rows have been imported, failed if not
+      - created: names of created hosts
+      - errors: a list of dict (row, host, message) for each rejected row, row is the position
+        of the row in the import (starting at 1)
+
+    A batch is imported in a transaction, so if a batch failed (per example a address allocated
+    by another user in the meantime), none of its rows are imported.
+
+    :param rows: the rows of the import
+    :param batch_size: number of rows imported in the same transaction
+    :return:
+    """
+    if batch_size <= 0:
+        raise ValueError('batch_size must be a positive integer')
+    plans, errors = validate(rows)
+    # IP addresses provided by the import are reserved before we allocate new ones
+    reserved = set(ip_key(plan['ip']) for plan in plans if plan['ip'] is not None)
+    created = []
+    for start in range(0, len(plans), batch_size):
+        batch = plans[start:start + batch_size]
+        try:
+            with transaction.atomic():
+                created += create_batch(batch, reserved, errors)
+        except (DatabaseError, ValidationError) as err:
+            for plan in batch:
+                errors[plan['row']] = '{}'.format(err)
+    result_errors = []
+    for index in sorted(errors):
+        result_errors.append({
+            'row': index + 1,
+            'host': rows[index].get('name', ''),
+            'message': errors[index]
+        })
+    return {
+        'status': 'done' if not result_errors else 'failed',
+        'created': created,
+        'errors': result_errors
+    }
+
+
+def pattern_regex(pattern):
+    """
+    This function return a regular expression from a name pattern where * match any string
+    (per example node-*.lab.example.com)
+
+    :param pattern: a name pattern
+    :return:
+    """
+    return '^{}$'.format('.*'.join(re.escape(part) for part in pattern.split('*')))
+
+
+def remove_hosts(names=None, network=None, pattern=None, addresses=True, hardware=False,
+                 dns_entry=True):
+    """
+    This function delete all hosts which match the selection (names, network and pattern, at
+    least one must be provided, if more than one is provided a host must match all of them).
+    Like Host.remove, we also delete addresses of hosts (unless they are shared with another
+    host) and their A and PTR entries if they are not used by another address. Everything is
+    deleted in one transaction.
+
+    :param names: a list of host names
+    :param network: a network name, we select hosts which are on it or have a address on it
+    :param pattern: a name pattern (see pattern_regex)
+    :param addresses: if set to True, we also delete all addresses (default: True)
+    :param hardware: if set to True, we also delete hardware (default: False)
+    :param dns_entry: if set to True, we also delete orphan A and PTR entries (default: True)
+    :return:
+    """
+    selection = {
+        'names': names,
+        'network': network,
+        'pattern': pattern
+    }
+    selection = {key: value for key, value in selection.items() if value is not None}
+    if not selection:
+        return error_message('hosts', selection, 'names, network or pattern should be provide')
+    condition = Q()
+    if names is not None:
+        condition &= Q(name__in=names)
+    if network is not None:
+        condition &= Q(id__in=Host.objects.filter(Q(network__name=network) |
+                                                  Q(addresses__network__name=network)).
+                       values('id'))
+    if pattern is not None:
+        condition &= Q(name__regex=pattern_regex(pattern))
+    try:
+        with transaction.atomic(), SearchToken.bulk_unindex():
+            hosts = Host.objects.filter(condition).select_for_update()
+            host_list = list(hosts.values_list('id', 'name', 'network__name', 'interface_id'))
+            host_ids = [host_id for host_id, _, _, _ in host_list]
+            changes = set()
+            for _, name, network_name, interface_id in host_list:
+                if network_name is not None:
+                    changes.add(('network', network_name, name))
+                if interface_id is not None:
+                    changes.add(('freeradius', '', name))
+            host_addresses = Address.objects.filter(host__id__in=host_ids).distinct()
+            for network_name, name in host_addresses.values_list('network__name', 'host__name'):
+                changes.add(('network', network_name, name))
+            interface_ids = [interface_id for _, _, _, interface_id in host_list
+                             if interface_id is not None]
+            address_list = []
+            entry_ids = []
+            if addresses:
+                # Addresses shared with a host we don't remove are kept
+                host_addresses = host_addresses.exclude(
+                    host__in=Host.objects.exclude(id__in=host_ids))
+                address_list = list(host_addresses.values_list('ip', 'network_id',
+                                                               'network__name'))
+                entries = DomainEntry.objects.filter(address__in=host_addresses)
+                changes.update(('domain', domain_name, entry_name) for domain_name, entry_name in
+                               entries.values_list('domain__name', 'name'))
+                for ip, _, network_name in address_list:
+                    changes.add(('network', network_name, ip))
+                if dns_entry:
+                    entry_ids = list(entries.filter(type__in=['A', 'PTR']).
+                                     values_list('id', flat=True).distinct())
+                address_ids = list(host_addresses.values_list('id', flat=True))
+            Host.objects.filter(id__in=host_ids).delete()
+            if addresses:
+                Address.objects.filter(id__in=address_ids).delete()
+                # Entries are orphan if no other address use them. Records which refer to them
+                # (CNAME, ...), maybe in another domain, will also change
+                orphans = DomainEntry.objects.filter(id__in=entry_ids, address__isnull=True)
+                changes.update(('domain', domain_name, entry_name) for domain_name, entry_name in
+                               orphans.values_list('entries__domain__name', 'entries__name')
+                               if entry_name is not None)
+                orphans.delete()
+                for network_obj in Network.objects.filter(
+                        id__in=set(network_id for _, network_id, _ in address_list)):
+                    FreeRange.rebuild(network_obj)
+            if hardware:
+                Hardware.objects.filter(interface__id__in=interface_ids).delete()
+            Change.log_bulk(sorted(changes))
+    except DatabaseError as err:
+        return error_message('hosts', selection, err)
+    return {
+        'hosts': [name for _, name, _, _ in host_list],
+        'status': 'done'
+    }
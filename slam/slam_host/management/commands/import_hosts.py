@@ -0,0 +1,39 @@
+"""
+This module provide a django command to import hosts from a CSV or a JSON file (see
+slam_host.bulk for the file format):
+
+    python manage.py import_hosts hosts.csv --batch-size 500
+"""
+from django.core.management.base import BaseCommand, CommandError
+
+from slam_host.bulk import BULK_BATCH_SIZE, parse_rows, import_hosts
+
+
+class Command(BaseCommand):
+    """
+    import_hosts command
+    """
+    help = 'Import hosts from a CSV or a JSON file'
+
+    def add_arguments(self, parser):
+        parser.add_argument('filename', help='the file to import')
+        parser.add_argument('--format', choices=['csv', 'json'], default=None,
+                            help='file format (default is guessed from file extension)')
+        parser.add_argument('--batch-size', type=int, default=BULK_BATCH_SIZE,
+                            help='number of hosts created in a transaction')
+
+    def handle(self, *args, **options):
+        content_format = options['format']
+        if content_format is None:
+            content_format = 'csv' if options['filename'].endswith('.csv') else 'json'
+        try:
+            with open(options['filename']) as import_file:
+                rows = parse_rows(import_file.read(), content_format)
+            result = import_hosts(rows, batch_size=options['batch_size'])
+        except (OSError, ValueError) as err:
+            raise CommandError(err)
+        for error in result['errors']:
+            self.stderr.write('row {} ({}): {}'.format(error['row'], error['host'],
+                                                       error['message']))
+        self.stdout.write('{} hosts imported, {} rejected'.format(len(result['created']),
+                                                                  len(result['errors'])))
@@ -1,7 +1,8 @@
 """
 This module provide a Host model and all associated method.
   - Host.show: method to return a dict abstraction of a Host
-  - Host.create: a staticmethod to create a Host w/ some check associated to it
+  - Host.create: a staticmethod to create a Host w/ some check associated to it, in a
+    transaction which lock the network
   - Host.update: a staticmethod to update Host field
   - Host.remove: a staticmethod to delete a Host w/ some check associated to it
   - Host.add: a staticmethod to add a IP to a Host
@@ -11,17 +12,25 @@ This module provide a Host model and all associated method.
 # As we use django models.Model, pylint fail to find objects method. We must disable pylint
 # test E1101 (no-member)
 # pylint: disable=E1101
+import random
+import time
 from distutils.util import strtobool
 
-from django.db import models
+from django.db import models, transaction
 from django.core.exceptions import ValidationError, ObjectDoesNotExist
-from django.db.utils import IntegrityError
+from django.db.utils import IntegrityError, OperationalError
 
-from slam_core.utils import error_message, name_validator
+from slam_core.models import Change
+from slam_core.utils import error_message, name_validator, paginate, show_related, \
+    reversed_name
 from slam_hardware.models import Interface
-from slam_network.models import Network, Address
+from slam_network.models import Network, Address, NETWORK_CACHE
 from slam_network.exceptions import NetworkFull
-from slam_domain.models import DomainEntry, Domain
+from slam_domain.models import DomainEntry, DOMAIN_CACHE
+
+HOST_CREATE_RETRY = 10
+# Maximum wait (in seconds) before the first retry, it's doubled on each retry
+HOST_CREATE_BACKOFF = 0.05
 
 
 class Host(models.Model):
@@ -34,7 +43,22 @@ class Host(models.Model):
       - network: the main network for the host (ie. where it will be put by freeradius)
       - creation_date: When Host has been created
       - dhcp: a flag to enable, disable DHCP configuration.
+      - reversed_name: the reversed name of the host (see slam_core.utils.reversed_name), it is
+        computed on save
+
+    SHOW_RELATED is the list of related objects needed by show method for each output level
+    (see slam_core.utils.show_related)
     """
+    SHOW_RELATED = {
+        'short': (['interface', 'network'], ['addresses']),
+        'full': (['interface__hardware', 'network'],
+                 ['addresses__network', 'addresses__ns_entries__domain',
+                  'addresses__ns_entries__entries__domain', 'addresses__ns_entries__address_set',
+                  'interface__hardware__interface_set'])
+    }
+
+    SEARCH_KIND = 'host'
+
     name = models.CharField(max_length=150, unique=True, validators=[name_validator])
     addresses = models.ManyToManyField(Address)
     interface = models.ForeignKey(Interface, on_delete=models.PROTECT, null=True, blank=True,
@@ -42,6 +66,29 @@ class Host(models.Model):
     network = models.ForeignKey(Network, on_delete=models.PROTECT, null=True, blank=True)
     creation_date = models.DateTimeField(auto_now_add=True, null=True)
     dhcp = models.BooleanField(default=True)
+    reversed_name = models.CharField(max_length=150, default='', blank=True, editable=False,
+                                     db_index=True)
+
+    def save(self, *args, **kwargs):
+        # pylint: disable=W0221
+        """
+        We keep reversed_name in sync with name
+
+        :return:
+        """
+        self.reversed_name = reversed_name(self.name)
+        super().save(*args, **kwargs)
+
+    def search_fields(self):
+        """
+        This method return fields of the host which are indexed for search (see
+        slam_core.models.SearchToken) as a list of (field, value, weight)
+
+        :return:
+        """
+        return [
+            ('name', self.name, 3)
+        ]
 
     def show(self, short=False, key=False):
         """
@@ -99,11 +146,65 @@ class Host(models.Model):
             }
         return result
 
+    def log_change(self):
+        """
+        This method add into change journal all configurations that depend on the host: DHCP
+        configuration of its networks and freeradius configuration.
+
+        :return:
+        """
+        networks = set(self.addresses.values_list('network__name', flat=True))
+        if self.network is not None:
+            networks.add(self.network.name)
+        for network in networks:
+            Change.log('network', network, self.name)
+        if self.interface is not None:
+            Change.log('freeradius', entry=self.name)
+
     @staticmethod
     def create(name, address=None, interface=None, network=None, owner=None, dns_entry=None,
                options=None):
         """
-        This is a custom method to create a host w/ some check like.
+        This is a custom method to create a host (see Host.create_unlocked for parameters).
+        Creation is atomic: the network row is locked (select_for_update) so two requests can't
+        allocate the same IP address, and everything (interface, hardware, address, entries) is
+        rolled back if creation failed. If the database reject the transaction anyway (per
+        example a IP address used by a concurrent request or a locked database), creation is
+        retried HOST_CREATE_RETRY times.
+
+        :return:
+        """
+        lock_name = network
+        if lock_name is None and address is not None:
+            try:  # We look at the network outside of the transaction as we cache the index
+                lock_network = Address.match_network(address)
+            except ValueError as err:
+                return error_message('host', name, err)
+            if lock_network is not None:
+                lock_name = lock_network.name
+        for attempt in range(HOST_CREATE_RETRY):
+            try:
+                with transaction.atomic():
+                    if lock_name is not None:  # Concurrent creations on the network wait here
+                        list(Network.objects.select_for_update().filter(name=lock_name))
+                    result = Host.create_unlocked(name, address=address, interface=interface,
+                                                  network=network, owner=owner,
+                                                  dns_entry=dns_entry, options=options)
+                    if result['status'] != 'done':  # We don't keep a half created host
+                        transaction.set_rollback(True)
+                    return result
+            except (IntegrityError, OperationalError) as err:
+                if attempt == HOST_CREATE_RETRY - 1:
+                    return error_message('host', name, err)
+                time.sleep(random.uniform(0, HOST_CREATE_BACKOFF * 2 ** attempt))
+        return error_message('host', name, 'Host creation failed')
+
+    @staticmethod
+    def create_unlocked(name, address=None, interface=None, network=None, owner=None,
+                        dns_entry=None, options=None):
+        """
+        This is a custom method to create a host w/ some check like. It must be run through
+        Host.create which provide transaction and lock.
           - Interface: check if it exist and it s free. If not, create a new one.
           - Address: check if it exist,it s free and in the network. If no address as been provide,
             get a free IP from the network
@@ -115,7 +216,9 @@ class Host(models.Model):
         :param network: network associated to this Host
         :param owner: the owner of this Host
         :param dns_entry: NS record for the Host
-        :param options: Some other options like 'no_ip' to force not get IP (Host w/o IP)
+        :param options: Some other options like 'no_ip' to force not get IP (Host w/o IP),
+          'strategy' to choose how IP is allocated (lowest, random), 'first_ip' and 'last_ip' to
+          allocate IP from a sub-range of the network
         :return:
         """
         interface_host = None
@@ -158,16 +261,20 @@ class Host(models.Model):
                 interface_host = Interface.objects.get(mac_address=interface)
         if network is not None:  # If we just provided network name information
             try:  # We get the network based on network name
-                network_host = Network.objects.get(name=network)
+                network_host = NETWORK_CACHE.get(network)
             except ObjectDoesNotExist as err:  # If network doesn't exist, we return a error
                 return error_message('host', name, err)
         if address is None and\
                 network is not None and\
                 not options['no_ip']:  # If we didn't provide address and ask for it
             try:  # We try to get a new IP from network
-                address = str(network_host.get_free_ip())
+                address = str(network_host.get_free_ip(strategy=options.get('strategy', 'lowest'),
+                                                       first=options.get('first_ip'),
+                                                       last=options.get('last_ip')))
             except NetworkFull:  # If network is full, we return a error
                 return error_message('host', name, 'Network have not usued IP address')
+            except ValueError as err:  # If strategy or IP range are wrong
+                return error_message('host', name, err)
         if address is not None:  # If we provide a specific IP address
             try:  # We get the address
                 address_host = Address.objects.get(ip=address)
@@ -202,6 +309,7 @@ class Host(models.Model):
             host.save()
             if address_host is not None:
                 host.addresses.add(address_host)
+            host.log_change()
             # We will return a dict representation and a status
             result = host.show()
             result['status'] = 'done'
@@ -224,6 +332,7 @@ class Host(models.Model):
         """
         try:
             host = Host.objects.get(name=name)
+            host.log_change()  # DHCP configuration of the previous network will change
             if interface is not None:
                 if interface == '':  # If interface name is '' then, we want to remove interface
                     host.interface = None
@@ -240,9 +349,9 @@ class Host(models.Model):
                         else:
                             return error_message('host', name, result_interface['message'])
             if network is not None:  # If we want to update the network, we need to get it.
-                host.network = Network.objects.get(name=network)
+                host.network = NETWORK_CACHE.get(network)
             if dns_entry is not None:  # If we want to update the NS record, we need to get.
-                domain_entry = Domain.objects.get(name=dns_entry['domain'])
+                domain_entry = DOMAIN_CACHE.get(dns_entry['domain'])
                 host.dns_entry = DomainEntry.objects.get(name=dns_entry['ns'], domain=domain_entry)
             if dhcp is not None:  # If we want to update DHCP flag
                 host.dhcp = strtobool(dhcp)
@@ -251,6 +360,7 @@ class Host(models.Model):
             except ValidationError as err:
                 return error_message('host', name, err)
             host.save()  # We save it
+            host.log_change()
         except ObjectDoesNotExist as err:  # If any object we try to get not exist, we return a
             # error.
             return error_message('host', name, err)
@@ -289,6 +399,7 @@ class Host(models.Model):
                 })
         if hardware:  # We get the interface, far more easiest as it s a one-to-one relation
             hardware_host = host.interface.hardware
+        host.log_change()
         try:  # Now we can try to remove the Host
             host.delete()
         except IntegrityError as err:  # If for some reason, it s not possible.
@@ -346,6 +457,7 @@ class Host(models.Model):
                 return result
             address = Address.objects.get(ip=address)  # We get the address created
         host.addresses.add(address)  # We add it.
+        host.log_change()
         return {
             'status': 'done',
             'host': name
@@ -361,26 +473,26 @@ class Host(models.Model):
         :return:
         """
         try:
-            host = Host.objects.get(name=name)
+            host = show_related(Host.objects.all(), 'full').get(name=name)
         except ObjectDoesNotExist as err:
             return error_message('host', name, err)
         result = host.show()
         return result
 
     @staticmethod
-    def search(filters=None):
+    def search(filters=None, limit=None, after=None, stream=False):
         """
         This is a custom method to get a dict abstraction of all Host on database. We get a
         short version of Host (see show method comment).
 
         :param filters: a dict of field as QuerySet
+        :param limit: the maximum number of objects we want (see slam_core.utils.paginate)
+        :param after: we only get objects after this cursor
+        :param stream: if set to True, we return a iterator instead of a list
         :return:
         """
         if filters is None:  # If no filters, we get all Host
             hosts = Host.objects.all()
         else:  # We suppose filter as been construct outside models class
             hosts = Host.objects.filter(**filters)
-        result = []
-        for host in hosts:  # We create the dict abstraction
-            result.append(host.show(short=True))
-        return result
+        return paginate(hosts, limit, after, stream)
@@ -2,11 +2,24 @@
 As this is a django internal template, we disable pylint
 """
 # pylint: disable=W0611
-from django.test import TestCase
+import json
+import tempfile
+
+import threading
+from unittest import mock
+
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.db import connection, connections
+from django.contrib.auth.models import User
 from django.core.exceptions import ObjectDoesNotExist
 from slam_domain.models import Domain, DomainEntry
-from slam_network.models import Network, Address
+from slam_network.models import Network, Address, FreeRange
 from slam_host.models import Host
+from slam_host.bulk import import_hosts, remove_hosts
+from slam_hardware.models import Hardware, Interface
+from slam_core.models import Change, SearchToken
+from slam_core.producer import dnsupdate
 
 DOMAIN_EXAMPLE_OPTIONS = {
     'dns_master': '127.0.0.1'
@@ -116,3 +129,241 @@ class DomainTestCase(TestCase):
         # We try to delete a host which not exist
         result = Host.remove(name='dynamic.example.com')
         self.assertDictEqual(result, RETURN_HOST_DELETE_NOT_EXIST)
+
+    @mock.patch('slam_host.views.LOGGER')
+    @mock.patch('slam_core.producer.dnsupdate.Job')
+    def test_host_view_dnsupdate(self, job, logger):
+        user = User.objects.create_user(username='test', password='test')
+        self.client.force_login(user)
+        with tempfile.NamedTemporaryFile() as key_file, \
+                mock.patch('slam_core.producer.dnsupdate.DNSUPDATE_KEY_FILE', key_file.name):
+            # A update job is started once the host is created or removed
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.client.post('/hosts/new.example.com', {'network': 'net.example'})
+            self.assertEqual(response.json()['status'], 'done')
+            job.start.assert_called_once_with('dnsupdate', dnsupdate.update, user='test')
+            with self.captureOnCommitCallbacks(execute=True):
+                self.client.delete('/hosts/new.example.com')
+            self.assertEqual(job.start.call_count, 2)
+            # Nothing is started if the host has not been created
+            with self.captureOnCommitCallbacks(execute=True):
+                self.client.post('/hosts/new.example.com', {'network': 'unknown'})
+            self.assertEqual(job.start.call_count, 2)
+        # Dynamic updates are not used w/o key
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post('/hosts/new.example.com', {'network': 'net.example'})
+        self.assertEqual(job.start.call_count, 2)
+
+    def test_hosts_view_pagination(self):
+        user = User.objects.create_user(username='test', password='test')
+        self.client.force_login(user)
+        response = self.client.get('/hosts/', {'limit': 1}, HTTP_ACCEPT='application/json')
+        self.assertEqual([host['name'] for host in response.json()], ['dynamic.example.com'])
+        response = self.client.get('/hosts/', {'limit': 1, 'after': response['X-Next-After']},
+                                   HTTP_ACCEPT='application/json')
+        self.assertEqual([host['name'] for host in response.json()], ['fixed.example.com'])
+        response = self.client.get('/hosts/', {'limit': 1, 'after': response['X-Next-After']},
+                                   HTTP_ACCEPT='application/json')
+        self.assertEqual(response.json(), [])
+        self.assertNotIn('X-Next-After', response)
+        response = self.client.get('/hosts/', {'stream': 'true'}, HTTP_ACCEPT='application/json')
+        result = json.loads(b''.join(response.streaming_content))
+        self.assertEqual([host['name'] for host in result],
+                         ['dynamic.example.com', 'fixed.example.com'])
+        response = self.client.get('/search', {'limit': 1, 'name': 'example'},
+                                   HTTP_ACCEPT='application/json')
+        self.assertEqual(len(response.json()['hosts']), 1)
+        self.assertIn('hosts', json.loads(response['X-Next-After']))
+
+    def test_host_search_queries(self):
+        Host.create(name='interface.example.com', network='net.example',
+                    interface='00:11:22:33:44:55',
+                    dns_entry={'name': 'interface', 'domain': 'example.com'})
+        expected = [host.show(short=True) for host in Host.objects.order_by('id')]
+        with self.assertNumQueries(2):
+            result = Host.search()
+        self.assertEqual(result, expected)
+        for index in range(10):
+            Host.create(name='host-{}.example.com'.format(index), network='net.example',
+                        interface='00:11:22:33:44:{:02d}'.format(index),
+                        dns_entry={'name': 'host-{}'.format(index), 'domain': 'example.com'})
+        # Number of queries doesn't depend on number of hosts
+        with self.assertNumQueries(2):
+            Host.search()
+        expected = Host.objects.get(name='interface.example.com').show()
+        with self.assertNumQueries(8):
+            result = Host.get(name='interface.example.com')
+        self.assertEqual(result, expected)
+        expected = Interface.objects.get(mac_address='00:11:22:33:44:55').show()
+        with self.assertNumQueries(2):
+            result = Interface.get('00:11:22:33:44:55')
+        self.assertEqual(result, expected)
+
+    @mock.patch('slam_host.views.LOGGER')  # Views must not write on ./slam.log
+    def test_import_hosts(self, logger):
+        Address.create(ip='192.168.0.5', network='net.example')
+        Network.create(name='other.example', address='10.0.0.0', prefix=24)
+        rows = [
+            {'name': 'bulk-0.example.com', 'network': 'net.example', 'ns': 'bulk-0',
+             'domain': 'example.com', 'interface': '00:11:22:33:44:00', 'owner': 'me'},
+            {'name': 'bulk-1.example.com', 'network': 'net.example', 'dhcp': 'false'},
+            {'name': 'bulk-2.example.com', 'ip_address': '192.168.0.3', 'ns': 'bulk-2',
+             'domain': 'example.com'},
+            {'name': 'dynamic.example.com', 'network': 'net.example'},
+            {'name': 'bulk-3.example.com', 'network': 'unknown'},
+            {'name': 'bulk-4.example.com', 'ip_address': '192.168.0.2'},
+            {'name': 'bulk-5.example.com', 'ip_address': '192.168.0.5'},
+            {'name': 'bulk-7.example.com', 'ip_address': '192.168.0.8', 'network': 'other.example'},
+            {'name': 'bulk-8.example.com', 'ip_address': '::ffff:192.168.0.9'},
+        ]
+        result = import_hosts(rows, batch_size=2)
+        self.assertEqual(result['created'], ['bulk-0.example.com', 'bulk-1.example.com',
+                                             'bulk-2.example.com', 'bulk-5.example.com'])
+        self.assertEqual([(error['row'], error['message']) for error in result['errors']],
+                         [(4, 'Host with this Name already exists.'),
+                          (5, 'Network unknown does not exist'),
+                          (6, 'Address is used by another host'),
+                          (8, 'Address 192.168.0.8 is not in network other.example'),
+                          (9, mock.ANY)])
+        self.assertIn('IPv4-mapped IPv6 address', result['errors'][-1]['message'])
+        # IP addresses are allocated in one pass, w/o the IP address provided by the import
+        self.assertEqual(Host.get('bulk-0.example.com')['addresses'][0]['ip'], '192.168.0.4')
+        self.assertEqual(Host.get('bulk-1.example.com')['addresses'][0]['ip'], '192.168.0.6')
+        self.assertFalse(Host.objects.get(name='bulk-1.example.com').dhcp)
+        entry = DomainEntry.objects.get(name='bulk-0', domain__name='example.com', type='PTR')
+        self.assertEqual(entry.address_set.get().ip, '192.168.0.4')
+        self.assertEqual(entry.reversed_fqdn, 'moc.elpmaxe.0-klub')
+        host = Host.objects.get(name='bulk-0.example.com')
+        self.assertEqual(host.interface.hardware.name, 'bulk-0-00-11-22-33-44-00')
+        self.assertEqual(host.interface.mac_key, 0x001122334400)
+        self.assertTrue(Change.objects.filter(target='freeradius',
+                                              entry='bulk-0.example.com').exists())
+        self.assertEqual({hit['name'] for hit in SearchToken.search('bulk-0')},
+                         {'bulk-0.example.com', 'bulk-0-00-11-22-33-44-00',
+                          'bulk-0.example.com (A)', 'bulk-0.example.com (PTR)'})
+        # FreeRange index is updated by the import like a rebuild would do
+        network = Network.objects.get(name='net.example')
+        ranges = list(FreeRange.objects.filter(network=network).order_by('first').
+                      values_list('first', 'last'))
+        FreeRange.rebuild(network)
+        self.assertEqual(list(FreeRange.objects.filter(network=network).order_by('first').
+                              values_list('first', 'last')), ranges)
+        # Next free IP address is found by FreeRange index
+        result = Host.create(name='next.example.com', network='net.example')
+        self.assertEqual(result['addresses'][0]['ip'], '192.168.0.7')
+
+        user = User.objects.create_user(username='test', password='test')
+        self.client.force_login(user)
+        response = self.client.post('/hosts/', 'name,network\nbulk-6.example.com,net.example\n'
+                                    'bulk-6.example.com,net.example\n',
+                                    content_type='text/csv', HTTP_ACCEPT='application/json')
+        self.assertEqual(response.json()['created'], ['bulk-6.example.com'])
+        self.assertEqual(response.json()['errors'][0]['row'], 2)
+        self.assertIn('imported 1 hosts (1 rejected)', logger.info.call_args[0][0])
+
+    @mock.patch('slam_host.views.LOGGER')
+    def test_remove_hosts(self, logger):
+        def create(prefix, count):
+            for index in range(count):
+                Host.create(name='{}-{}.example.com'.format(prefix, index), network='net.example',
+                            interface='00:11:22:33:{:02d}:{:02d}'.format(count, index),
+                            dns_entry={'name': '{}-{}'.format(prefix, index),
+                                       'domain': 'example.com'})
+
+        self.assertEqual(remove_hosts()['status'], 'failed')
+        create('rack', 5)
+        # A record of rack-0 is also used by another address, so it's not a orphan entry
+        Address.include('192.168.0.2', 'net.example', 'rack-0.example.com')
+        # A CNAME of another domain refer to rack-4, its zone will change
+        Domain.create(name='example.org', args=DOMAIN_EXAMPLE_OPTIONS)
+        DomainEntry.create('www', 'example.org', 'CNAME',
+                           sub_entry={'name': 'rack-4', 'domain': 'example.com', 'type': 'A'})
+        Change.objects.filter(name='example.org').delete()
+        with CaptureQueriesContext(connection) as small:
+            result = remove_hosts(pattern='rack-*.example.com', hardware=True)
+        self.assertEqual(result, {
+            'hosts': ['rack-{}.example.com'.format(index) for index in range(5)],
+            'status': 'done'
+        })
+        self.assertFalse(Host.objects.filter(name__startswith='rack-').exists())
+        self.assertEqual(Address.objects.count(), 2)
+        self.assertEqual(list(DomainEntry.objects.filter(name__startswith='rack-').
+                              values_list('name', 'type')), [('rack-0', 'A')])
+        self.assertFalse(Hardware.objects.filter(name__startswith='rack-').exists())
+        self.assertEqual([hit['name'] for hit in SearchToken.search('rack')],
+                         ['rack-0.example.com (A)'])
+        self.assertTrue(Change.objects.filter(target='domain', entry='rack-4').exists())
+        self.assertTrue(Change.objects.filter(target='domain', name='example.org',
+                                              entry='www').exists())
+        # Addresses are free again
+        result = Host.create(name='next.example.com', network='net.example')
+        self.assertEqual(result['addresses'][0]['ip'], '192.168.0.3')
+
+        # A address shared with a host we don't remove is kept with its entries
+        create('shared', 1)
+        Host.objects.get(name='next.example.com').addresses.add(
+            Address.objects.get(host__name='shared-0.example.com'))
+        remove_hosts(names=['shared-0.example.com'])
+        shared = Host.objects.get(name='next.example.com').addresses.get(ip='192.168.0.4')
+        self.assertTrue(shared.ns_entries.filter(name='shared-0', type='A').exists())
+
+        create('node', 20)
+        with CaptureQueriesContext(connection) as large:
+            result = remove_hosts(network='net.example', names=['node-{}.example.com'.format(
+                index) for index in range(20)] + ['dynamic.example.com'], hardware=True)
+        self.assertEqual(len(result['hosts']), 21)
+        # Number of queries doesn't depend on number of hosts
+        self.assertEqual(len(small.captured_queries), len(large.captured_queries))
+        self.assertEqual(sorted(Host.objects.values_list('name', flat=True)),
+                         ['fixed.example.com', 'next.example.com'])
+
+        user = User.objects.create_user(username='test', password='test')
+        self.client.force_login(user)
+        response = self.client.delete('/hosts/?names=next.example.com,fixed.example.com',
+                                      HTTP_ACCEPT='application/json')
+        self.assertEqual(response.json()['status'], 'done')
+        self.assertFalse(Host.objects.exists())
+
+
+class HostConcurrencyTestCase(TransactionTestCase):
+    def setUp(self) -> None:
+        Domain.create(name=DOMAIN_EXAMPLE_NAME, args=DOMAIN_EXAMPLE_OPTIONS)
+        Network.create(name=NETWORK_OPTIONS['name'],
+                       address=NETWORK_OPTIONS['ip'],
+                       prefix=NETWORK_OPTIONS['prefix'])
+
+    def test_host_create_concurrency(self):
+        threads = 8
+        hosts = 5
+        results = []
+        barrier = threading.Barrier(threads)
+
+        def worker(thread):
+            try:
+                barrier.wait()
+                for index in range(hosts):
+                    name = 'host-{}-{}'.format(thread, index)
+                    results.append(Host.create(
+                        name='{}.example.com'.format(name), network='net.example',
+                        interface='00:11:22:33:{:02d}:{:02d}'.format(thread, index),
+                        dns_entry={'name': name, 'domain': 'example.com'}))
+            finally:
+                connections.close_all()
+
+        workers = [threading.Thread(target=worker, args=(thread,)) for thread in range(threads)]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        self.assertEqual([result['status'] for result in results], ['done'] * threads * hosts)
+        # No IP address is allocated twice
+        ips = [result['addresses'][0]['ip'] for result in results]
+        self.assertEqual(len(set(ips)), threads * hosts)
+        self.assertEqual(Address.objects.count(), threads * hosts)
+        # No orphan interface, hardware or entry
+        self.assertFalse(Interface.objects.filter(host__isnull=True).exists())
+        self.assertEqual(Hardware.objects.count(), threads * hosts)
+        self.assertFalse(DomainEntry.objects.filter(address__isnull=True).exists())
+        # Free ranges don't include a used IP address
+        result = Host.create(name='next.example.com', network='net.example')
+        self.assertEqual(result['addresses'][0]['ip'], '192.168.0.{}'.format(threads * hosts + 1))
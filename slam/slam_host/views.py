@@ -30,7 +30,10 @@ from django.shortcuts import render
 from django.http import JsonResponse, QueryDict
 from django.contrib.auth.decorators import login_required
 
+from slam_core.utils import error_message, list_options, list_response
+from slam_core.producer.dnsupdate import schedule_update
 from slam_host.models import Host
+from slam_host.bulk import BULK_BATCH_SIZE, parse_rows, import_hosts, remove_hosts
 
 LOGGER = logging.getLogger('api')
 
@@ -41,15 +44,66 @@ def hosts_view(request):
     This function manage interaction between user and SLAM for hosts management. URI is
     represented by https://slam.example.com/hosts
 
-    We currently support only GET method.
+    We support the following method:
+      - GET: to get the list of hosts. limit, after and stream options can be used to get a page
+        of the list or to stream it (see slam_core.utils.list_options).
+      - POST: to import a list of hosts (see slam_host.bulk). Body is a JSON list or, if
+        Content-Type is text/csv, a CSV file. batch_size option set the number of hosts created
+        in a transaction.
+      - DELETE: to remove a list of hosts selected by names (comma separated list), network
+        and/or pattern (see slam_host.bulk.remove_hosts). addresses, hardware and dns_entry
+        options are the same than a host removal.
 
     :param request: full HTTP request from user
     :return:
     """
     if request.method == 'GET' and request.headers['Accept'] != 'application/json':
         return render(request, 'host/hosts.html', dict())
-    result = Host.search()
-    return JsonResponse(result, safe=False)
+    if request.method == 'POST':  # If we request to import hosts
+        content_format = 'json'
+        if request.content_type == 'text/csv':
+            content_format = 'csv'
+        try:
+            batch_size = int(request.GET.get('batch_size', BULK_BATCH_SIZE))
+            rows = parse_rows(request.body.decode(), content_format)
+            result = import_hosts(rows, batch_size=batch_size)
+        except ValueError as err:
+            return JsonResponse(error_message('hosts', 'import', err))
+        if result['created']:
+            schedule_update(str(request.user))
+        LOGGER.info('{}: {} imported {} hosts ({} rejected)'.format(
+            datetime.now(),
+            request.user,
+            len(result['created']),
+            len(result['errors'])))
+        return JsonResponse(result)
+    if request.method == 'DELETE':  # If we request to remove a list of hosts
+        options = dict()
+        if request.GET.get('names') is not None:
+            options['names'] = [name for name in request.GET.get('names').split(',') if name]
+        for arg in ['network', 'pattern']:
+            if request.GET.get(arg) is not None:
+                options[arg] = request.GET.get(arg)
+        try:
+            for arg in ['addresses', 'hardware', 'dns_entry']:
+                if request.GET.get(arg) is not None:
+                    options[arg] = bool(strtobool(request.GET.get(arg)))
+        except ValueError as err:
+            return JsonResponse(error_message('hosts', request.GET.urlencode(), err))
+        result = remove_hosts(**options)
+        if result['status'] == 'done':
+            schedule_update(str(request.user))
+        LOGGER.info('{}: {} removed hosts {} with options {}'.format(
+            datetime.now(),
+            request.user,
+            result.get('hosts'),
+            request.GET.urlencode()))
+        return JsonResponse(result)
+    try:
+        options = list_options(request.GET.dict())
+    except ValueError as err:
+        return JsonResponse(error_message('hosts', request.GET.urlencode(), err))
+    return list_response(Host.search(**options))
 
 
 @login_required
@@ -93,11 +147,17 @@ def host_view(request, uri_host):
             options['options']['no_ip'] = strtobool(request.POST.get('no_ip'))
         else:
             options['options']['no_ip'] = False
+        for arg in ['strategy', 'first_ip', 'last_ip']:  # If we provide any info about IP
+            # allocation
+            if request.POST.get(arg) is not None:
+                options['options'][arg] = request.POST.get(arg)
         if request.POST.get('dhcp') is not None:  # If we provide any info about DHCP generation
             options['options']['dhcp'] = strtobool(request.POST.get('dhcp'))
         else:
             options['options']['dhcp'] = True
         result = Host.create(**options)
+        if result['status'] == 'done':  # New records are sent to DNS servers
+            schedule_update(str(request.user))
         LOGGER.info('{}: {} created host {} with options {}'.format(
             datetime.now(),
             request.user,
@@ -111,6 +171,8 @@ def host_view(request, uri_host):
 
     elif request.method == 'DELETE':  # If we request to delete a Host
         result = Host.remove(uri_host)
+        if result['status'] == 'done':
+            schedule_update(str(request.user))
         LOGGER.info('{}: {} deleted host {}'.format(
             datetime.now(),
             request.user,
@@ -0,0 +1,106 @@
+"""
+This module provide a lookup index for networks. It's a binary trie over the integer form of
+network prefixes (one trie for IPv4, one for IPv6). Looking for the network of a IP address is
+a longest-prefix match which cost at most 32 (IPv4) or 128 (IPv6) steps whatever the number of
+networks.
+
+The index only keep network ids: a index is shared by all threads of a process, so callers get
+their own network objects (see slam_network.models.Network.index).
+"""
+import ipaddress
+
+
+class PrefixTrie:
+    """
+    This class is a binary trie. Each node is a list [child for bit 0, child for bit 1, value].
+    """
+    def __init__(self, bits):
+        """
+        Just a constructor, we need to know the number of bits of keys
+
+        :param bits: number of bits (32 for IPv4, 128 for IPv6)
+        """
+        self.bits = bits
+        self.root = [None, None, None]
+
+    def insert(self, prefix, prefixlen, value):
+        """
+        This method add a value for a prefix
+
+        :param prefix: integer form of the prefix
+        :param prefixlen: length of the prefix
+        :param value: value associated to the prefix
+        :return:
+        """
+        node = self.root
+        for position in range(prefixlen):
+            bit = (prefix >> (self.bits - 1 - position)) & 1
+            if node[bit] is None:
+                node[bit] = [None, None, None]
+            node = node[bit]
+        node[2] = value
+
+    def lookup(self, key):
+        """
+        This method return the value of the longest prefix which include key. If no prefix
+        include key, it return None
+
+        :param key: integer form of the IP address
+        :return:
+        """
+        node = self.root
+        result = node[2]
+        for position in range(self.bits):
+            node = node[(key >> (self.bits - 1 - position)) & 1]
+            if node is None:
+                break
+            if node[2] is not None:
+                result = node[2]
+        return result
+
+
+class NetworkIndex:
+    """
+    This class manage a IPv4 and a IPv6 trie of networks.
+    """
+    def __init__(self, networks, fingerprint=None):
+        """
+        Build the index from a list of networks
+
+        :param networks: objects with id, ip and prefix attributes (like
+          slam_network.models.Network)
+        :param fingerprint: something that identify the state of networks used to build the index
+        """
+        self.fingerprint = fingerprint
+        self.tries = {
+            4: PrefixTrie(32),
+            6: PrefixTrie(128)
+        }
+        for network in networks:
+            ip_network = ipaddress.ip_network('{}/{}'.format(network.ip, network.prefix),
+                                              strict=False)
+            self.tries[ip_network.version].insert(int(ip_network.network_address),
+                                                  ip_network.prefixlen, network.id)
+
+    def match(self, ip):
+        """
+        This method return the id of the most specific network which include the IP address
+
+        :param ip: IP address
+        :return:
+        """
+        address = ipaddress.ip_address(ip)
+        return self.tries[address.version].lookup(int(address))
+
+    def classify(self, ips):
+        """
+        This method return a dict which associate each IP address to the id of its most specific
+        network
+
+        :param ips: a list of IP addresses
+        :return:
+        """
+        result = dict()
+        for ip in ips:
+            result[ip] = self.match(ip)
+        return result
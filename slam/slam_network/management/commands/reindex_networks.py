@@ -0,0 +1,40 @@
+"""
+This module provide a django command to (re)build network indexes
+  - first_key / last_key of Network and key of Address
+  - FreeRange of each network
+
+It must be run once after upgrading a existing database:
+
+    python manage.py reindex_networks
+"""
+# As we use django models.Model, pylint fail to find objects method. We must disable pylint
+# test E1101 (no-member)
+# pylint: disable=E1101
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from slam_network.models import Network, Address, FreeRange
+from slam_network.utils import ip_key, cidr_keys
+
+
+class Command(BaseCommand):
+    """
+    reindex_networks command
+    """
+    help = 'Rebuild IP keys and free ranges of all networks'
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            networks = list(Network.objects.all())
+            for network in networks:
+                network.first_key, network.last_key = cidr_keys('{}/{}'.format(network.ip,
+                                                                               network.prefix))
+            Network.objects.bulk_update(networks, ['first_key', 'last_key'], batch_size=500)
+            addresses = list(Address.objects.all())
+            for address in addresses:
+                address.key = ip_key(address.ip)
+            Address.objects.bulk_update(addresses, ['key'], batch_size=500)
+            for network in networks:
+                FreeRange.rebuild(network)
+        self.stdout.write('{} networks and {} addresses reindexed'.format(len(networks),
+                                                                          len(addresses)))
@@ -1,6 +1,7 @@
 """
-This module provide model for networks. There are 2 models
+This module provide model for networks. There are 3 models
  - Network: which represent a IPv6 or IPv4 network
+ - FreeRange: which represent a range of unused IP addresses in a network
  - Address: which represent a IPv6 or IPv5
 
 As we use django models.Model, pylint fail to find objects method. We must disable pylint
@@ -9,14 +10,33 @@ test E1101 (no-member)
 # We need to remove C0103 form pylint as ip is not reconnized as a valid snake cas naming.
 # pylint: disable=E1101, C0103
 import ipaddress
+import random
 
 from django.db import models
+from django.db.models import Count, Max
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 from django.core.exceptions import ValidationError, ObjectDoesNotExist
 from django.db.utils import IntegrityError
 
-from slam_core.utils import error_message, name_validator
-from slam_domain.models import DomainEntry, Domain
+from slam_core.cache import ObjectCache
+from slam_core.models import Change
+from slam_core.utils import error_message, name_validator, paginate, show_related
+from slam_domain.models import DomainEntry, DOMAIN_CACHE
 from slam_network.exceptions import NetworkFull
+from slam_network.utils import ip_key, key_ip, key_offset, host_bounds, cidr_keys, \
+    ipv4_mapped_validator
+from slam_network.index import NetworkIndex
+
+ALLOCATION_STRATEGY = [
+    'lowest',
+    'random'
+]
+
+# Per process cache of the network lookup index (see Network.index)
+NETWORK_INDEX = {
+    'index': None
+}
 
 
 class Network(models.Model):
@@ -32,10 +52,27 @@ class Network(models.Model):
       - dhcp: the IP of DHCP server (used to push data in production)
       - freeradius: the IP of freeradius server (used to push data in production)
       - vlan: the VLAN id of the network
+      - first_key / last_key: key of the first and the last address of the network (see
+        slam_network.utils.ip_key), they are computed on save
+
+    SHOW_RELATED is the list of related objects needed by show method for each output level
+    (see slam_core.utils.show_related)
     """
+    SHOW_RELATED = {
+        'full': ([], ['address_set__network', 'address_set__ns_entries__domain',
+                      'address_set__ns_entries__entries__domain',
+                      'address_set__ns_entries__address_set'])
+    }
+
+    SEARCH_KIND = 'network'
+
     name = models.CharField(max_length=50, unique=True, validators=[name_validator])
-    ip = models.GenericIPAddressField(unique=True)
+    ip = models.GenericIPAddressField(unique=True, validators=[ipv4_mapped_validator])
     prefix = models.IntegerField(default=24)
+    first_key = models.CharField(max_length=32, default='', blank=True, editable=False,
+                                 db_index=True)
+    last_key = models.CharField(max_length=32, default='', blank=True, editable=False,
+                                db_index=True)
     description = models.CharField(max_length=150, default='')
     gateway = models.GenericIPAddressField(blank=True, null=True)
     dns_master = models.GenericIPAddressField(blank=True, null=True)
@@ -44,6 +81,30 @@ class Network(models.Model):
     vlan = models.IntegerField(default=1)
     contact = models.EmailField(blank=True, null=True)
 
+    def save(self, *args, **kwargs):
+        # pylint: disable=W0221
+        """
+        We keep first_key and last_key in sync with ip and prefix
+
+        :return:
+        """
+        self.first_key, self.last_key = cidr_keys('{}/{}'.format(self.ip, self.prefix))
+        super().save(*args, **kwargs)
+
+    def search_fields(self):
+        """
+        This method return fields of the network which are indexed for search (see
+        slam_core.models.SearchToken) as a list of (field, value, weight)
+
+        :return:
+        """
+        return [
+            ('name', self.name, 3),
+            ('address', '{}/{}'.format(self.ip, self.prefix), 3),
+            ('description', self.description, 1),
+            ('contact', self.contact, 1)
+        ]
+
     def show(self, key=False, short=False):
         """
         This method return a dict construction of the object. We have 3 types of output,
@@ -61,25 +122,19 @@ class Network(models.Model):
                 'name': self.name
             }
         elif short:
-            addresses_used = len(self.addresses())
-            addresses_total = ipaddress.ip_network('{}/{}'.format(self.ip,
-                                                                  self.prefix)).num_addresses
             result = {
                 'name': self.name,
                 'address': self.ip,
                 'prefix': self.prefix,
                 'version': ipaddress.ip_address(self.ip).version,
                 'description': self.description,
-                'used_addresses': addresses_used,
-                'total': addresses_total
+                'used_addresses': self.used_addresses(),
+                'total': self.total_addresses()
             }
         else:
             result_addresses = []
             for address in self.addresses():
                 result_addresses.append(address.show(short=True))
-            addresses_used = len(self.addresses())
-            addresses_total = ipaddress.ip_network('{}/{}'.format(self.ip,
-                                                                  self.prefix)).num_addresses
             result = {
                 'name': self.name,
                 'address': self.ip,
@@ -92,8 +147,8 @@ class Network(models.Model):
                 'radius': self.radius,
                 'vlan': self.vlan,
                 'contact': self.contact,
-                'used_addresses': addresses_used,
-                'total': addresses_total,
+                'used_addresses': len(result_addresses),
+                'total': self.total_addresses(),
                 'addresses': result_addresses
             }
         return result
@@ -120,19 +175,60 @@ class Network(models.Model):
         result = self.address_set.all()
         return result
 
-    def get_free_ip(self):
+    def used_addresses(self):
+        """
+        This method return the number of addresses used in the network. Network.search annotate
+        networks with this number (address_count) so we don't need a query per network.
+
+        :return:
+        """
+        address_count = getattr(self, 'address_count', None)
+        if address_count is None:
+            address_count = self.address_set.count()
+        return address_count
+
+    def total_addresses(self):
         """
+        This method return the number of addresses of the network (including network and
+        broadcast address). It's computed from keys w/o building a ipaddress object, or from the
+        network if keys are not computed yet (network not saved or not indexed by
+        reindex_networks).
 
         :return:
         """
+        if not self.first_key or not self.last_key:
+            return ipaddress.ip_network('{}/{}'.format(self.ip, self.prefix),
+                                        strict=False).num_addresses
+        return int(self.last_key, 16) - int(self.first_key, 16) + 1
+
+    def get_free_ip(self, strategy='lowest', first=None, last=None):
+        """
+        This method return a unused IP address of the network. It rely on FreeRange index so we
+        don't need to look at all addresses of the network.
+
+        :param strategy: how we choose the IP address (lowest, random)
+        :param first: if set, we only look at IP address greater or equal to first
+        :param last: if set, we only look at IP address lower or equal to last
+        :return:
+        """
+        if strategy not in ALLOCATION_STRATEGY:
+            raise ValueError('Unknown allocation strategy {}'.format(strategy))
         network = ipaddress.ip_network('{}/{}'.format(self.ip, self.prefix))
-        addresses = []
-        for address in self.addresses():
-            addresses.append(ipaddress.ip_address(address.ip))
-        for result_address in network.hosts():
-            if result_address not in addresses:
-                return result_address
-        raise NetworkFull()
+        first_host, last_host = host_bounds(network)
+        if not FreeRange.objects.filter(network=self).exists() and \
+                self.address_set.count() < int(last_host) - int(first_host) + 1:
+            # Network has been created before FreeRange index, we need to build it.
+            FreeRange.rebuild(self)
+        lower = ip_key(first_host)
+        upper = ip_key(last_host)
+        if first is not None:
+            lower = max(lower, ip_key(first))
+        if last is not None:
+            upper = min(upper, ip_key(last))
+        key = FreeRange.lookup(self, lower, upper, strategy)
+        if key is None:
+            raise NetworkFull()
+        return key_ip(key, network.version)
 
     def version(self):
         """
@@ -141,6 +237,24 @@ class Network(models.Model):
         """
         return ipaddress.ip_network('{}/{}'.format(self.ip, self.prefix)).version
 
+    @staticmethod
+    def index():
+        """
+        This method return the network lookup index. The index is cached per process and dropped
+        when a network is saved or deleted. As other process can also create or delete networks,
+        we check the number of networks and the last network id (network prefix can't be
+        updated) before using the cached index. The index only give network ids, networks are
+        read again from database so callers never share (or see stale) network objects.
+
+        :return:
+        """
+        fingerprint = Network.objects.aggregate(count=Count('id'), last=Max('id'))
+        index = NETWORK_INDEX['index']
+        if index is None or index.fingerprint != fingerprint:
+            index = NetworkIndex(Network.objects.all(), fingerprint)
+            NETWORK_INDEX['index'] = index
+        return index
+
     @staticmethod
     def create(name, address, prefix, description='A short description', gateway=None,
                dns_master=None, dhcp=None, radius=None, vlan=1, contact=None):
@@ -168,6 +282,8 @@ class Network(models.Model):
             return error_message('network', name, err)
         network.full_clean()
         network.save()
+        FreeRange.rebuild(network)
+        Change.log('network', network.name)
         return {
             'network': network.name,
             'status': 'done'
@@ -205,6 +321,7 @@ class Network(models.Model):
             network.radius = radius
         if vlan is not None:
             network.vlan = vlan
+            Change.log('freeradius')
         if contact is not None:
             network.contact = contact
         try:
@@ -212,6 +329,7 @@ class Network(models.Model):
         except ValidationError as err:
             return error_message('network', name, err)
         network.save()
+        Change.log('network', name)
         return {
             'network': name,
             'status': 'done'
@@ -231,6 +349,7 @@ class Network(models.Model):
             network.delete()
         except (ObjectDoesNotExist, IntegrityError) as err:
             return error_message('network', name, err)
+        Change.log('network', name)
         return {
             'network': name,
             'status': 'done'
@@ -245,28 +364,227 @@ class Network(models.Model):
         :return:
         """
         try:
-            network = Network.objects.get(name=name)
+            network = show_related(Network.objects.all(), 'full').get(name=name)
         except ObjectDoesNotExist as err:
             return error_message('network', name, err)
         result = network.show()
         return result
 
     @staticmethod
-    def search(filters=None):
+    def search(filters=None, within=None, limit=None, after=None, stream=False):
         """
         This is a custom method to get all networks that match the filters
 
         :param filters: a dict of field / regex
+        :param within: if set, we only get networks included in this CIDR (ie 10.0.0.0/8)
+        :param limit: the maximum number of objects we want (see slam_core.utils.paginate)
+        :param after: we only get objects after this cursor
+        :param stream: if set to True, we return a iterator instead of a list
         :return:
         """
         if filters is None:
             networks = Network.objects.all()
         else:
             networks = Network.objects.filter(**filters)
-        result = []
-        for network in networks:
-            result.append(network.show(short=True))
-        return result
+        if within is not None:
+            first, last = cidr_keys(within)
+            networks = networks.filter(first_key__gte=first, last_key__lte=last)
+        # We count addresses of all networks in the same query
+        networks = networks.annotate(address_count=Count('address'))
+        return paginate(networks, limit, after, stream)
+
+
+# Per process cache of networks by name (see slam_core.cache)
+NETWORK_CACHE = ObjectCache(Network)
+
+
+class FreeRange(models.Model):
+    """
+    FreeRange class represent a range of unused IP addresses in a network. All ranges of a network
+    are disjoint and sorted by their first key, so looking for a free IP is just a index lookup.
+      - network: the network where the range is
+      - first: key of the first unused IP address (see slam_network.utils.ip_key)
+      - last: key of the last unused IP address
+    """
+    network = models.ForeignKey(Network, on_delete=models.CASCADE)
+    first = models.CharField(max_length=32)
+    last = models.CharField(max_length=32)
+
+    class Meta:
+        """
+        We always look for a range from a network and a key
+        """
+        indexes = [
+            models.Index(fields=['network', 'first']),
+            models.Index(fields=['network', 'last'])
+        ]
+
+    @staticmethod
+    def rebuild(network):
+        """
+        This method (re)build all free ranges of a network from addresses used on it.
+
+        :param network: the network
+        :return:
+        """
+        ip_network = ipaddress.ip_network('{}/{}'.format(network.ip, network.prefix))
+        first_host, last_host = host_bounds(ip_network)
+        used = sorted(ip_key(address.ip) for address in network.address_set.all())
+        ranges = []
+        first = ip_key(first_host)
+        last = ip_key(last_host)
+        for key in used:
+            if key < first or key > last:  # Address is not a host address (network, ...)
+                continue
+            if key > first:
+                ranges.append(FreeRange(network=network, first=first,
+                                        last=key_offset(key, -1)))
+            first = key_offset(key, 1)
+        if first <= last:
+            ranges.append(FreeRange(network=network, first=first, last=last))
+        FreeRange.objects.filter(network=network).delete()
+        FreeRange.objects.bulk_create(ranges)
+
+    @staticmethod
+    def at(network, key):
+        """
+        This method return the free range which include key or, if key is used, the next free
+        range after key.
+
+        :param network: the network
+        :param key: the key of a IP address
+        :return:
+        """
+        free_range = FreeRange.objects.filter(network=network, first__lte=key).\
+            order_by('-first').first()
+        if free_range is not None and free_range.last >= key:
+            return free_range
+        return FreeRange.objects.filter(network=network, first__gt=key).order_by('first').first()
+
+    @staticmethod
+    def lookup(network, lower, upper, strategy='lowest'):
+        """
+        This method return the key of a unused IP address between lower and upper key. If no IP
+        address is available, it return None
+
+        :param network: the network
+        :param lower: the key of the lowest IP address we accept
+        :param upper: the key of the highest IP address we accept
+        :param strategy: how we choose the IP address (lowest, random)
+        :return:
+        """
+        if lower > upper:
+            return None
+        start = lower
+        if strategy == 'random':
+            start = '{:032x}'.format(random.randint(int(lower, 16), int(upper, 16)))
+        free_range = FreeRange.at(network, start)
+        if free_range is None or free_range.first > upper:
+            if start == lower:
+                return None
+            # Nothing after our random start, we wrap around to the lowest one
+            start = lower
+            free_range = FreeRange.at(network, start)
+            if free_range is None or free_range.first > upper:
+                return None
+        return max(free_range.first, start)
+
+    @staticmethod
+    def reserve(network, ip):
+        """
+        This method remove a IP address from free ranges of the network
+
+        :param network: the network
+        :param ip: the IP address which is now used
+        :return:
+        """
+        key = ip_key(ip)
+        free_range = FreeRange.objects.filter(network=network, first__lte=key).\
+            order_by('-first').first()
+        if free_range is None or free_range.last < key:  # IP is not free (or not a host address)
+            return
+        if free_range.first == free_range.last:
+            free_range.delete()
+        elif free_range.first == key:
+            free_range.first = key_offset(key, 1)
+            free_range.save()
+        elif free_range.last == key:
+            free_range.last = key_offset(key, -1)
+            free_range.save()
+        else:  # We split the range in 2 ranges
+            FreeRange.objects.create(network=network, first=key_offset(key, 1),
+                                     last=free_range.last)
+            free_range.last = key_offset(key, -1)
+            free_range.save()
+
+    @staticmethod
+    def reserve_many(network, ips):
+        """
+        This method remove a list of IP addresses from free ranges of the network (per example
+        on a bulk import). Only ranges which include one of them are read and replaced, so the
+        cost doesn't depend on the size of the network.
+
+        :param network: the network
+        :param ips: the IP addresses which are now used
+        :return:
+        """
+        keys = sorted(set(ip_key(ip) for ip in ips))
+        if not keys:
+            return
+        removed = []
+        ranges = []
+        index = 0
+        for free_range in FreeRange.objects.filter(network=network, last__gte=keys[0],
+                                                   first__lte=keys[-1]).order_by('first'):
+            while index < len(keys) and keys[index] < free_range.first:
+                index += 1
+            first = free_range.first
+            while index < len(keys) and keys[index] <= free_range.last:
+                if keys[index] > first:
+                    ranges.append(FreeRange(network=network, first=first,
+                                            last=key_offset(keys[index], -1)))
+                first = key_offset(keys[index], 1)
+                index += 1
+            if first == free_range.first:  # No IP address in this range
+                continue
+            removed.append(free_range.id)
+            if first <= free_range.last:
+                ranges.append(FreeRange(network=network, first=first, last=free_range.last))
+        FreeRange.objects.filter(id__in=removed).delete()
+        FreeRange.objects.bulk_create(ranges)
+
+    @staticmethod
+    def release(network, ip):
+        """
+        This method add a IP address into free ranges of the network, merging it with adjacent
+        ranges.
+
+        :param network: the network
+        :param ip: the IP address which is now unused
+        :return:
+        """
+        ip_network = ipaddress.ip_network('{}/{}'.format(network.ip, network.prefix))
+        first_host, last_host = host_bounds(ip_network)
+        key = ip_key(ip)
+        if key < ip_key(first_host) or key > ip_key(last_host):
+            return
+        if FreeRange.objects.filter(network=network, first__lte=key, last__gte=key).exists():
+            return
+        previous_range = FreeRange.objects.filter(network=network,
+                                                  last=key_offset(key, -1)).first()
+        next_range = FreeRange.objects.filter(network=network, first=key_offset(key, 1)).first()
+        if previous_range is not None and next_range is not None:
+            previous_range.last = next_range.last
+            previous_range.save()
+            next_range.delete()
+        elif previous_range is not None:
+            previous_range.last = key
+            previous_range.save()
+        elif next_range is not None:
+            next_range.first = key
+            next_range.save()
+        else:
+            FreeRange.objects.create(network=network, first=key, last=key)
 
 
 class Address(models.Model):
@@ -274,12 +592,49 @@ class Address(models.Model):
     Address class represent a specific address on a network.
       - ip: IPv4 or IPv6 address
       - ns_entries: all other NS entries for this IP (CNAME, A, ...)
+      - key: key of the IP address (see slam_network.utils.ip_key), it is computed on save
+
+    SHOW_RELATED is the list of related objects needed by show method for each output level
+    (see slam_core.utils.show_related)
     """
-    ip = models.GenericIPAddressField(unique=True)
+    SHOW_RELATED = {
+        'short': (['network'], ['ns_entries__domain', 'ns_entries__entries__domain',
+                                'ns_entries__address_set']),
+        'full': ([], ['ns_entries__domain', 'ns_entries__entries__domain',
+                      'ns_entries__entries__entries__domain', 'ns_entries__entries__address_set',
+                      'ns_entries__address_set'])
+    }
+
+    SEARCH_KIND = 'address'
+
+    ip = models.GenericIPAddressField(unique=True, validators=[ipv4_mapped_validator])
+    key = models.CharField(max_length=32, default='', blank=True, editable=False,
+                           db_index=True)
     ns_entries = models.ManyToManyField(DomainEntry)
     creation_date = models.DateTimeField(auto_now_add=True, null=True)
     network = models.ForeignKey(Network, on_delete=models.PROTECT)
 
+    def save(self, *args, **kwargs):
+        # pylint: disable=W0221
+        """
+        We keep key in sync with ip
+
+        :return:
+        """
+        self.key = ip_key(self.ip)
+        super().save(*args, **kwargs)
+
+    def search_fields(self):
+        """
+        This method return fields of the address which are indexed for search (see
+        slam_core.models.SearchToken) as a list of (field, value, weight)
+
+        :return:
+        """
+        return [
+            ('ip', self.ip, 3)
+        ]
+
     def show(self, key=False, short=True):
         """
 
@@ -332,7 +687,7 @@ class Address(models.Model):
         """
         try:
             try:
-                network_address = Network.objects.get(name=network)
+                network_address = NETWORK_CACHE.get(network)
             except ObjectDoesNotExist as err:
                 return error_message('address', ip, err)
             if network_address is not None and not network_address.is_include(ip):
@@ -343,9 +698,11 @@ class Address(models.Model):
         except (IntegrityError, ValueError, ValidationError) as err:
             return error_message('address', ip, err)
         address.save()
+        FreeRange.reserve(network_address, ip)
+        Change.log('network', network_address.name, ip)
         if ns_entry is not None:
             try:
-                domain = Domain.objects.get(name=ns_entry['domain'])
+                domain = DOMAIN_CACHE.get(ns_entry['domain'])
             except ObjectDoesNotExist as err:
                 return error_message('address', ip, err)
             try:
@@ -368,6 +725,7 @@ class Address(models.Model):
                                                     type='PTR')
             address.ns_entries.add(entry)
             address.ns_entries.add(entry_ptr)
+            Change.log('domain', ns_entry['domain'], ns_entry['name'])
         return {
             'address': address.ip,
             'status': 'done'
@@ -388,18 +746,20 @@ class Address(models.Model):
         ns = fqdn[0]
         domain = fqdn[1]
         try:
-            network_entry = Network.objects.get(name=network)
+            network_entry = NETWORK_CACHE.get(network)
             if network_entry is not None and not network_entry.is_include(ip):
                 return error_message('entry', ns_entry, 'Address {} not in Network {}/{}'.format(
                     ip, network_entry.address, network_entry.prefix))
             address_entry = Address.objects.get(ip=ip)
-            domain_entry = Domain.objects.get(name=domain)
+            domain_entry = DOMAIN_CACHE.get(domain)
             ns_entry_obj = DomainEntry.objects.get(name=ns, domain=domain_entry, type=ns_type)
             if ns_type == 'PTR' and len(ns_entry_obj.address_set.all()) != 0:
                 return error_message('entry', ip, 'PTR record is used')
         except ObjectDoesNotExist as err:
             return error_message('entry', ns_entry, err)
         address_entry.ns_entries.add(ns_entry_obj)
+        Change.log('domain', domain, ns)
+        Change.log('network', address_entry.network.name, ip)
         return {
             'entry': ns_entry,
             'status': 'done'
@@ -421,11 +781,13 @@ class Address(models.Model):
         domain_entry = fqdn[1]
         try:
             address_entry = Address.objects.get(ip=ip)
-            domain_entry = Domain.objects.get(name=domain_entry)
+            domain_entry = DOMAIN_CACHE.get(domain_entry)
             ns_entry_entry = DomainEntry.objects.get(name=ns, domain=domain_entry, type=ns_type)
         except ObjectDoesNotExist as err:
             return error_message('entry', ns_entry, err)
         address_entry.ns_entries.remove(ns_entry_entry)
+        Change.log('domain', domain_entry.name, ns)
+        Change.log('network', address_entry.network.name, ip)
         return {
             'entry': ns_entry,
             'status': 'done'
@@ -443,7 +805,7 @@ class Address(models.Model):
         """
         try:
             try:
-                network_address = Network.objects.get(name=network)
+                network_address = NETWORK_CACHE.get(network)
             except ObjectDoesNotExist:
                 network_address = None
             if network_address is not None and not network_address.is_include(ip):
@@ -458,9 +820,15 @@ class Address(models.Model):
                 entry_a = address.ns_entries.get(type='A')
             except ObjectDoesNotExist:
                 entry_a = None
+            # We keep records which will change to add them into change journal
+            entries_changed = list(address.ns_entries.values_list('domain__name', 'name'))
             address.delete()
         except (ObjectDoesNotExist, IntegrityError) as err:
             return error_message('address', ip, err)
+        FreeRange.release(address.network, ip)
+        Change.log('network', address.network.name, ip)
+        for domain_name, entry_name in entries_changed:
+            Change.log('domain', domain_name, entry_name)
         if ns_entry:
             if entry_ptr is not None:
                 try:
@@ -491,42 +859,76 @@ class Address(models.Model):
         :return:
         """
         try:
-            network = Network.objects.get(name=network)
+            network = NETWORK_CACHE.get(network)
         except ObjectDoesNotExist as err:
             network = None
         try:
-            address = Address.objects.get(ip=ip)
+            # Address.show return a short output by default
+            address = show_related(Address.objects.all(), 'short').get(ip=ip)
         except ObjectDoesNotExist as err:
             return error_message('address', ip, err)
         result = address.show()
         return result
 
     @staticmethod
-    def search(filters=None):
+    def search(filters=None, within=None, limit=None, after=None, stream=False):
         """
         This is a custom method to get all networks that match the filters
 
         :param filters: a dict of field / regex
+        :param within: if set, we only get addresses included in this CIDR (ie 10.1.0.0/16)
+        :param limit: the maximum number of objects we want (see slam_core.utils.paginate)
+        :param after: we only get objects after this cursor
+        :param stream: if set to True, we return a iterator instead of a list
         :return:
         """
         if filters is None:
             addresses = Address.objects.all()
         else:
             addresses = Address.objects.filter(**filters)
-        result = []
-        for address in addresses:
-            result.append(address.show(short=True))
-        return result
+        if within is not None:
+            first, last = cidr_keys(within)
+            addresses = addresses.filter(key__gte=first, key__lte=last)
+        return paginate(addresses, limit, after, stream)
 
     @staticmethod
     def match_network(ip):
         """
-        This method return the network associated with the address
+        This method return the most specific network associated with the address
 
+        :param ip: IP address
         :return:
         """
-        networks = Network.objects.all()
-        for network in networks:
-            if network.is_include(ip):
-                return network
-        return None
+        network_id = Network.index().match(ip)
+        if network_id is None:
+            return None
+        return Network.objects.filter(id=network_id).first()
+
+    @staticmethod
+    def match_networks(ips):
+        """
+        This method return a dict which associate each IP address with its most specific
+        network (or None if no network include it). It's useful to classify a lot of IP
+        addresses (per example on import) as we only look at networks once.
+
+        :param ips: a list of IP addresses
+        :return:
+        """
+        network_ids = Network.index().classify(ips)
+        networks = Network.objects.in_bulk(set(network_ids.values()) - {None})
+        return dict((ip, networks.get(network_id)) for ip, network_id in network_ids.items())
+
+
+@receiver(post_save, sender=Network)
+@receiver(post_delete, sender=Network)
+def network_index_invalidate(sender, **kwargs):
+    # pylint: disable=W0613
+    """
+    This function drop the cached network lookup index and cached networks when a network is
+    saved or deleted.
+
+    :param sender: the model class (Network)
+    :return:
+    """
+    NETWORK_INDEX['index'] = None
+    NETWORK_CACHE.invalidate()
@@ -2,6 +2,143 @@
 As this is a django internal template, we disable pylint
 """
 # pylint: disable=W0611
+import ipaddress
+
+from django.core.exceptions import ValidationError
 from django.test import TestCase
+from slam_network.models import Network, Address, FreeRange
+from slam_network.exceptions import NetworkFull
+
+NETWORK_OPTIONS = {
+    'name': 'net.example',
+    'address': '192.168.0.0',
+    'prefix': '24'
+}
+
+NETWORK_SMALL_OPTIONS = {
+    'name': 'small.example',
+    'address': '10.0.0.0',
+    'prefix': '30'
+}
+
+NETWORK_V6_OPTIONS = {
+    'name': 'net6.example',
+    'address': 'fd00::',
+    'prefix': '64'
+}
+
+
+class NetworkTestCase(TestCase):
+    def setUp(self) -> None:
+        Network.create(**NETWORK_OPTIONS)
+        Network.create(**NETWORK_SMALL_OPTIONS)
+        Network.create(**NETWORK_V6_OPTIONS)
+
+    def test_free_ip_lowest(self):
+        network = Network.objects.get(name=NETWORK_OPTIONS['name'])
+        self.assertEqual(network.get_free_ip(), ipaddress.ip_address('192.168.0.1'))
+        Address.create(ip='192.168.0.1', network=NETWORK_OPTIONS['name'])
+        Address.create(ip='192.168.0.3', network=NETWORK_OPTIONS['name'])
+        self.assertEqual(network.get_free_ip(), ipaddress.ip_address('192.168.0.2'))
+        self.assertEqual(FreeRange.objects.filter(network=network).count(), 2)
+        network_v6 = Network.objects.get(name=NETWORK_V6_OPTIONS['name'])
+        self.assertEqual(network_v6.get_free_ip(), ipaddress.ip_address('fd00::1'))
+
+    def test_free_ip_range(self):
+        network = Network.objects.get(name=NETWORK_OPTIONS['name'])
+        self.assertEqual(network.get_free_ip(first='192.168.0.100', last='192.168.0.101'),
+                         ipaddress.ip_address('192.168.0.100'))
+        Address.create(ip='192.168.0.100', network=NETWORK_OPTIONS['name'])
+        Address.create(ip='192.168.0.101', network=NETWORK_OPTIONS['name'])
+        with self.assertRaises(NetworkFull):
+            network.get_free_ip(first='192.168.0.100', last='192.168.0.101')
+        for _ in range(20):
+            address = network.get_free_ip(strategy='random', first='192.168.0.99',
+                                          last='192.168.0.102')
+            self.assertIn(str(address), ['192.168.0.99', '192.168.0.102'])
+
+    def test_free_ip_full(self):
+        network = Network.objects.get(name=NETWORK_SMALL_OPTIONS['name'])
+        Address.create(ip='10.0.0.1', network=NETWORK_SMALL_OPTIONS['name'])
+        Address.create(ip='10.0.0.2', network=NETWORK_SMALL_OPTIONS['name'])
+        with self.assertRaises(NetworkFull):
+            network.get_free_ip()
+        Address.remove(ip='10.0.0.1', network=NETWORK_SMALL_OPTIONS['name'])
+        self.assertEqual(network.get_free_ip(), ipaddress.ip_address('10.0.0.1'))
+
+    def test_free_ip_release(self):
+        network = Network.objects.get(name=NETWORK_OPTIONS['name'])
+        for ip in ['192.168.0.1', '192.168.0.2', '192.168.0.3']:
+            Address.create(ip=ip, network=NETWORK_OPTIONS['name'])
+        Address.remove(ip='192.168.0.2', network=NETWORK_OPTIONS['name'])
+        self.assertEqual(FreeRange.objects.filter(network=network).count(), 2)
+        Address.remove(ip='192.168.0.1', network=NETWORK_OPTIONS['name'])
+        Address.remove(ip='192.168.0.3', network=NETWORK_OPTIONS['name'])
+        # All ranges should be merged back into one
+        self.assertEqual(FreeRange.objects.filter(network=network).count(), 1)
+
+    def test_free_ip_rebuild(self):
+        network = Network.objects.get(name=NETWORK_OPTIONS['name'])
+        Address.create(ip='192.168.0.1', network=NETWORK_OPTIONS['name'])
+        FreeRange.objects.filter(network=network).delete()
+        self.assertEqual(network.get_free_ip(), ipaddress.ip_address('192.168.0.2'))
+
+    def test_match_network(self):
+        Network.create(name='subnet.example', address='192.168.0.128', prefix='25')
+        self.assertEqual(Address.match_network('192.168.0.1').name, NETWORK_OPTIONS['name'])
+        # We want the most specific network
+        self.assertEqual(Address.match_network('192.168.0.200').name, 'subnet.example')
+        self.assertEqual(Address.match_network('fd00::10').name, NETWORK_V6_OPTIONS['name'])
+        self.assertIsNone(Address.match_network('172.16.0.1'))
+        Network.remove(name='subnet.example')
+        self.assertEqual(Address.match_network('192.168.0.200').name, NETWORK_OPTIONS['name'])
+        result = Address.match_networks(['10.0.0.1', '172.16.0.1'])
+        self.assertEqual(result['10.0.0.1'].name, NETWORK_SMALL_OPTIONS['name'])
+        self.assertIsNone(result['172.16.0.1'])
+        # Callers get their own network objects, up to date even if another process update it
+        Address.match_network('192.168.0.1').vlan = 42
+        Network.objects.filter(name=NETWORK_OPTIONS['name']).update(dns_master='192.168.0.53')
+        network = Address.match_network('192.168.0.1')
+        self.assertEqual(network.vlan, 1)
+        self.assertEqual(network.dns_master, '192.168.0.53')
+
+    def test_total_addresses(self):
+        # Keys are not computed for networks created before they have been added
+        Network.objects.filter(name=NETWORK_OPTIONS['name']).update(first_key='', last_key='')
+        network = Network.objects.get(name=NETWORK_OPTIONS['name'])
+        self.assertEqual(network.total_addresses(), 256)
+        self.assertEqual(Network(ip='fd00::', prefix=64).total_addresses(), 2 ** 64)
+        network.save()
+        self.assertEqual(network.total_addresses(), 256)
+
+    def test_ipv4_mapped(self):
+        # A IPv4-mapped IPv6 address would have the key of the IPv4 address
+        result = Network.create(name='mapped', address='::ffff:10.0.0.0', prefix=120)
+        self.assertEqual(result['status'], 'failed')
+        self.assertIn('IPv4-mapped', '{}'.format(result['message']))
+        address = Address(ip='::ffff:192.168.0.5',
+                          network=Network.objects.get(name=NETWORK_OPTIONS['name']))
+        with self.assertRaises(ValidationError):
+            address.full_clean()
+
+    def test_search_within(self):
+        Address.create(ip='192.168.0.10', network=NETWORK_OPTIONS['name'])
+        Address.create(ip='10.0.0.1', network=NETWORK_SMALL_OPTIONS['name'])
+        Address.create(ip='fd00::a', network=NETWORK_V6_OPTIONS['name'])
+        result = Address.search(within='192.168.0.0/16')
+        self.assertEqual([address['ip'] for address in result], ['192.168.0.10'])
+        result = Address.search(within='fd00::/16')
+        self.assertEqual([address['ip'] for address in result], ['fd00::a'])
+        result = Network.search(within='10.0.0.0/8')
+        self.assertEqual([network['name'] for network in result], [NETWORK_SMALL_OPTIONS['name']])
 
-# Create your tests here.
+    def test_search_counters(self):
+        for index in range(1, 6):
+            Address.create(ip='192.168.0.{}'.format(index), network=NETWORK_OPTIONS['name'])
+        with self.assertNumQueries(1):
+            result = Network.search()
+        counters = dict((network['name'], (network['used_addresses'], network['total']))
+                        for network in result)
+        self.assertEqual(counters[NETWORK_OPTIONS['name']], (5, 256))
+        self.assertEqual(counters[NETWORK_SMALL_OPTIONS['name']], (0, 4))
+        self.assertEqual(counters[NETWORK_V6_OPTIONS['name']], (0, 2 ** 64))
@@ -0,0 +1,106 @@
+"""
+This module provide some useful functions to manipulate IP addresses as sortable keys. A key is a
+fixed width (32 hexadecimal digits) representation of the 128 bits integer form of a IP address.
+IPv4 addresses are mapped into IPv6 (::ffff:0:0/96), so a IPv4-mapped IPv6 address
+(::ffff:a.b.c.d) would have the same key than a.b.c.d. Models reject IPv4-mapped IPv6 addresses and
+networks (see ipv4_mapped_validator), so keys of stored IPv4 and IPv6 addresses never collide.
+
+As all keys have the same width, lexicographic order is the same as numeric order. So keys can be
+indexed and compared by the database itself (per example key__gte / key__lte for a range).
+"""
+import ipaddress
+
+from django.core.exceptions import ValidationError
+
+IPV4_MAPPED = 0xffff << 32
+
+
+def ip_key(ip):
+    """
+    This function return the key of a IP address
+
+    :param ip: IPv4 or IPv6 address (string or ipaddress object)
+    :return:
+    """
+    address = ipaddress.ip_address(ip)
+    value = int(address)
+    if address.version == 4:
+        value |= IPV4_MAPPED
+    return '{:032x}'.format(value)
+
+
+def ipv4_mapped_validator(ip):
+    """
+    This function check that a IP address is not a IPv4-mapped IPv6 address (its key would be the
+    key of the IPv4 address)
+
+    :param ip: IPv4 or IPv6 address
+    :return:
+    """
+    try:
+        address = ipaddress.ip_address(ip)
+    except ValueError:
+        return  # Not a IP address, GenericIPAddressField will tell it
+    if address.version == 6 and address.ipv4_mapped is not None:
+        raise ValidationError('IPv4-mapped IPv6 address {} is not supported, use {}'.format(
+            ip, address.ipv4_mapped))
+
+
+def key_ip(key, version):
+    """
+    This function return the IP address associated to a key
+
+    :param key: the key of the IP address
+    :param version: IP version (4 or 6)
+    :return:
+    """
+    value = int(key, 16)
+    if version == 4:
+        return ipaddress.IPv4Address(value & 0xffffffff)
+    return ipaddress.IPv6Address(value)
+
+
+def key_offset(key, offset):
+    """
+    This function return the key of the IP address shifted by offset (per example, key of the
+    next IP address is key_offset(key, 1))
+
+    :param key: the key of the IP address
+    :param offset: the shift we want to apply
+    :return:
+    """
+    return '{:032x}'.format(int(key, 16) + offset)
+
+
+def host_bounds(network):
+    """
+    This function return the first and the last usable IP address of a network as ipaddress
+    objects. It follow the same rules than ipaddress.ip_network.hosts() w/o iterating over
+    all addresses.
+
+    :param network: a ipaddress network object
+    :return:
+    """
+    address_class = type(network.network_address)
+    first = int(network.network_address)
+    last = int(network.broadcast_address)
+    if network.version == 4 and network.prefixlen < 31:
+        # We exclude network and broadcast addresses
+        first += 1
+        last -= 1
+    elif network.version == 6 and network.prefixlen < 127:
+        # We exclude Subnet-Router anycast address
+        first += 1
+    return address_class(first), address_class(last)
+
+
+def cidr_keys(cidr):
+    """
+    This function return the key of the first and the last IP address of a network (all
+    addresses, including network and broadcast address)
+
+    :param cidr: a network (per example 192.168.0.0/24)
+    :return:
+    """
+    network = ipaddress.ip_network(cidr, strict=False)
+    return ip_key(network.network_address), ip_key(network.broadcast_address)
@@ -16,20 +16,26 @@ from django.shortcuts import render
 from django.http import JsonResponse, QueryDict
 from django.contrib.auth.decorators import login_required
 
+from slam_core.utils import error_message, list_options, list_response
 from slam_network.models import Network, Address
 
 
 @login_required
 def networks_view(request):
-    # pylint: disable=W0613
     """
     This function manage interaction between user and SLAM for all network management. URI is
     represented by https://slam.example.com/networks
 
+    limit, after and stream options can be used to get a page of the list or to stream it (see
+    slam_core.utils.list_options).
+
     :param request: full HTTP request from user
     """
-    result = Network.search()
-    return JsonResponse(result, safe=False)
+    try:
+        options = list_options(request.GET.dict())
+    except ValueError as err:
+        return JsonResponse(error_message('networks', request.GET.urlencode(), err))
+    return list_response(Network.search(**options))
 
 
 @login_required